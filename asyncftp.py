@@ -0,0 +1,816 @@
+import re
+import os
+import sys
+import socket
+import asyncore
+import asynchat
+import traceback
+
+from collections import deque
+from datetime import datetime as dt
+from ftplib import FTP_PORT, error_perm, error_temp, parse257
+
+from filetransfer_abc import filetransfer_abc, parse_features
+from hashing import parse_hash_reply
+from listing import parse_mlsd_line, parse_list_line, parse_timestamp
+
+
+# Address in the reply to PASV, '227 Entering Passive Mode (h1,h2,h3,h4,p1,p2)'.
+PASV_ADDRESS = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+
+
+def report_error():
+    """Prints the exception being handled, just a line for socket errors."""
+
+    if isinstance(sys.exc_info()[1], socket.error):
+        print 'Connection error, %s' % sys.exc_info()[1]
+        return
+    info = traceback.format_exception(*sys.exc_info())
+    for i in info: sys.stderr.write(i)
+
+class ControlChannel(asynchat.async_chat):
+    """
+    Control connection to the server. Commands are written as soon as they
+    are given and the replies handed to their callbacks, in order. Replies
+    of the 1xx kind also go to the callback of the command in progress,
+    which keeps waiting for its final reply. Callbacks get `None` when the
+    connection is lost.
+    """
+
+    def __init__(self, host, port, map, lost):
+        """
+        :param host: Location of the FTP server
+        :param port: Port of the FTP server
+        :param map: Socket map of the event loop
+        :param lost: Called when the connection is closed
+        """
+
+        asynchat.async_chat.__init__(self, map=map)
+
+        self.set_terminator('\r\n')
+        self.incoming = []
+        # Lines of the multiline reply being received.
+        self.lines = []
+        # Callbacks of the commands waiting for a reply, the
+        # first one is given the greeting of the server.
+        self.waiting = deque()
+        self.lost = lost
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming)
+        self.incoming = []
+        self.lines.append(line)
+        code = self.lines[0][:3]
+        if self.lines[0][3:4] == '-' and (len(self.lines) == 1 or line[:4] != code + ' '):
+            # Multiline replies end with the code followed by a space.
+            return
+
+        reply = '\n'.join(self.lines)
+        self.lines = []
+        if len(self.waiting) == 0:
+            return
+        if reply.startswith('1'):
+            self.waiting[0](reply)
+        else:
+            self.waiting.popleft()(reply)
+
+    def expect(self, callback):
+        """Waits for a reply without sending a command, like the greeting."""
+
+        self.waiting.append(callback)
+
+    def command(self, line, callback):
+        """
+        Sends `line` to the server, `callback` gets the reply.
+
+        :param line: Command, without the line ending
+        :param callback: Callable taking the reply
+        """
+
+        if isinstance(line, unicode):
+            # `push` would send the internal representation of the string.
+            line = line.encode('utf-8')
+        self.waiting.append(callback)
+        self.push('%s\r\n' % line)
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        self.close()
+        # Told first, so that the task in progress is retried
+        # instead of failing with the callbacks below.
+        self.lost()
+        waiting = list(self.waiting)
+        self.waiting.clear()
+        for callback in waiting:
+            callback(None)
+
+    def handle_error(self):
+        report_error()
+        self.handle_close()
+
+
+class DataChannel(asyncore.dispatcher):
+    """
+    Data connection of one transfer, opened to the address given by PASV.
+    Received data goes to `receive`, and once `source` is set its contents
+    are sent. `finished` is called when the connection is closed.
+    """
+
+    BLOCKSIZE = 8192
+
+    def __init__(self, address, map, receive=None, finished=None):
+        """
+        :param address: `(host, port)` tuple from the PASV reply
+        :param map: Socket map of the event loop
+        :param receive: Callable taking the blocks of received data
+        :param finished: Called once the connection is closed
+        """
+
+        asyncore.dispatcher.__init__(self, map=map)
+
+        self.receive = receive
+        self.finished = finished
+        self.source = None
+        self.outgoing = ''
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def readable(self):
+        return self.receive is not None
+
+    def writable(self):
+        return self.connecting or self.source is not None
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        data = self.recv(DataChannel.BLOCKSIZE)
+        if data:
+            self.receive(data)
+
+    def handle_write(self):
+        if self.source is None:
+            # Just connected, nothing to send yet.
+            return
+        if not self.outgoing:
+            self.outgoing = self.source.read(DataChannel.BLOCKSIZE)
+            if not self.outgoing:
+                # All sent, closing tells the server the file is complete.
+                self.handle_close()
+                return
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_close(self):
+        self.close()
+        finished, self.finished = self.finished, None
+        if finished is not None:
+            finished()
+
+    def handle_error(self):
+        report_error()
+        self.handle_close()
+
+
+class Session(object):
+    """
+    One logged in control connection of `AsyncFTPTransport`,
+    running one task at a time.
+    """
+
+    def __init__(self, transport):
+        super(Session, self).__init__()
+
+        self.transport = transport
+        self.task = None
+        self.loggedIn = False
+        self.control = ControlChannel(transport.host, transport.port,
+                                      transport.map, self.lost)
+        self.control.expect(self.greeted)
+
+    def greeted(self, reply):
+        if reply is not None and reply.startswith('2'):
+            self.control.command('USER %s' % self.transport.username, self.userSent)
+
+    def userSent(self, reply):
+        if reply is not None and reply.startswith('3'):
+            self.control.command('PASS %s' % self.transport.passwd, self.passSent)
+        else:
+            self.passSent(reply)
+
+    def passSent(self, reply):
+        if reply is not None and reply.startswith('2'):
+            self.control.command('TYPE I', self.ready)
+        elif reply is not None:
+            self.transport.rejected(self, reply)
+
+    def ready(self, reply):
+        if reply is not None:
+            self.loggedIn = True
+            self.transport.failures = 0
+            self.transport.idle(self)
+
+    def lost(self):
+        self.transport.lost(self)
+
+    def command(self, line, done):
+        """
+        Sends `line`, `done` gets the reply if it's not an error
+        reply, `None` otherwise.
+        """
+
+        def replied(reply):
+            if reply is not None and reply[:1] in '23':
+                done(reply)
+            else:
+                print 'Error running %s, %s' % (line, reply)
+                done(None)
+
+        self.control.command(line, replied)
+
+    def transfer(self, line, done, receive=None, source=None, rest=0):
+        """
+        Runs the command `line` over a data connection opened with PASV.
+        `done` gets the final reply once both the reply and the end of the
+        data have been received, `None` on errors.
+
+        :param line: Command that transfers data, like RETR or LIST
+        :param done: Callable taking the final reply
+        :param receive: Callable taking the blocks of received data
+        :param source: File object whose contents are sent once the server is ready
+        :param rest: Offset given with REST before the command, if not zero
+        """
+
+        state = {'pending': 2, 'reply': None, 'over': False, 'channel': None}
+
+        def finish(reply=None):
+            if state['over']:
+                return
+            if reply is not None:
+                state['reply'] = reply
+            state['pending'] -= 1
+            if state['pending'] == 0:
+                state['over'] = True
+                done(state['reply'])
+
+        def fail(reply):
+            if state['over']:
+                return
+            state['over'] = True
+            if state['channel'] is not None:
+                state['channel'].finished = None
+                state['channel'].close()
+            print 'Error running %s, %s' % (line, reply)
+            done(None)
+
+        def passive(reply):
+            match = PASV_ADDRESS.search(reply or '')
+            if reply is None or not reply.startswith('227') or match is None:
+                fail(reply)
+                return
+            numbers = [int(number) for number in match.groups()]
+            address = ('.'.join(str(number) for number in numbers[:4]),
+                       numbers[4] * 256 + numbers[5])
+            state['channel'] = DataChannel(address, self.transport.map, receive, finish)
+            if rest > 0:
+                self.control.command('REST %d' % rest, restarted)
+            else:
+                self.control.command(line, replied)
+
+        def restarted(reply):
+            if reply is None or not reply.startswith('3'):
+                fail(reply)
+            else:
+                self.control.command(line, replied)
+
+        def replied(reply):
+            if reply is not None and reply.startswith('1'):
+                # The server is ready for the data.
+                state['channel'].source = source
+            elif reply is None or not reply.startswith('2'):
+                fail(reply)
+            else:
+                finish(reply)
+
+        self.control.command('PASV', passive)
+
+
+class AsyncFTPTransport(filetransfer_abc):
+    """
+    FTP client multiplexing up to `connections` control connections, and
+    their data connections, on one `asyncore` event loop. Work is handed out
+    in batches with the same interface as `ftppool.Batch`, the loop runs in
+    the thread iterating over a batch so no thread per connection is needed.
+    Plain FTP only, `asyncore` can't do the TLS handshake.
+    """
+
+    # Times a task is retried after its connection was lost.
+    RETRIES = 3
+    # Seconds the event loop waits for sockets in each round.
+    POLL_TIMEOUT = 0.1
+
+    def __init__(self, host, port=FTP_PORT, connections=8):
+        """
+        :param host: Location of the FTP server
+        :param port: Port of the FTP server
+        :param connections: Maximum number of control connections
+        """
+
+        super(AsyncFTPTransport, self).__init__()
+
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.username = ''
+        self.passwd = ''
+        self.map = dict()
+        self.sessions = []
+        self.idleSessions = deque()
+        # Tasks waiting for a session, `(func, args, results, attempt)` tuples.
+        self.tasks = deque()
+        # Reply to the last rejected login, tasks fail while it's set.
+        self.loginError = None
+        # Connections lost in a row before logging in.
+        self.failures = 0
+        # Whether the server understands MLSD, `None` until the first listing.
+        self.mlsdSupported = None
+
+    def login(self, username, passwd):
+        """
+        Stores the credentials used by the connections, they
+        log in by themselves as soon as there are tasks.
+
+        :param username: Username to log in into the FTP server
+        :param passwd: Password to log in into the FTP server
+        """
+
+        self.username = username
+        self.passwd = passwd
+        self.loginError = None
+
+    def connect(self, username, passwd):
+        """
+        Same as `login`, but logs in one of the connections right away.
+        Returns an error message, empty if the login succeeded.
+
+        :param username: Username to log in into the FTP server
+        :param passwd: Password to log in into the FTP server
+        """
+
+        self.login(username, passwd)
+        if self.call(self.command, 'NOOP') is None:
+            return self.loginError or 'Server could not be reached.'
+
+        return ''
+
+    def close(self):
+        """Closes every connection."""
+
+        for session in self.sessions:
+            session.control.close()
+        self.sessions = []
+        self.idleSessions.clear()
+
+    def batch(self, func):
+        """
+        Returns an `AsyncBatch` running `func`, one of the task methods
+        of this class.
+
+        :param func: Task method, like `listDir` or `retrieve`
+        """
+
+        return AsyncBatch(self, func)
+
+    def call(self, func, *args):
+        """Runs a single task and returns its result."""
+
+        batch = self.batch(func)
+        batch.put(*args)
+        for args, result in batch:
+            return result
+
+    def submit(self, func, args, results, attempt=0):
+        """Queues a task, its `(args, result)` tuple is appended to `results`."""
+
+        if self.loginError is not None:
+            results.append((args, None))
+            return
+        self.tasks.append((func, args, results, attempt))
+        self.schedule()
+
+    def schedule(self):
+        """Hands the queued tasks to the idle sessions, opening new ones if allowed."""
+
+        while len(self.tasks) > 0 and len(self.idleSessions) > 0:
+            self.run(self.idleSessions.popleft(), self.tasks.popleft())
+
+        starting = len([session for session in self.sessions if not session.loggedIn])
+        while len(self.tasks) > starting and len(self.sessions) < self.connections:
+            try:
+                self.sessions.append(Session(self))
+            except socket.error as err:
+                print 'Error connecting to %s, %s' % (self.host, err)
+                self.failed()
+                return
+            starting += 1
+
+    def failed(self):
+        """
+        Counts a connection that was lost before logging in, queued
+        tasks fail after `RETRIES` of them in a row.
+        """
+
+        self.failures += 1
+        if self.failures <= AsyncFTPTransport.RETRIES:
+            return
+        self.failures = 0
+        while len(self.tasks) > 0:
+            func, args, results, attempt = self.tasks.popleft()
+            results.append((args, None))
+
+    def run(self, session, task):
+        """Starts `task` on `session`."""
+
+        func, args, results, attempt = task
+        session.task = task
+
+        def done(result):
+            if session.task is not task:
+                # The connection was lost, the task was given to another one.
+                return
+            session.task = None
+            results.append((args, result))
+            self.idle(session)
+
+        func(session, done, *args)
+
+    def poll(self):
+        """Runs one round of the event loop."""
+
+        self.schedule()
+        if len(self.map) == 0:
+            return
+        asyncore.loop(timeout=AsyncFTPTransport.POLL_TIMEOUT, map=self.map, count=1)
+
+    def idle(self, session):
+        """Called by `session` when it's ready for the next task."""
+
+        if session not in self.sessions:
+            return
+        if len(self.tasks) > 0:
+            self.run(session, self.tasks.popleft())
+        else:
+            self.idleSessions.append(session)
+
+    def lost(self, session):
+        """Called by `session` when its connection is closed."""
+
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if session in self.idleSessions:
+            self.idleSessions.remove(session)
+        if not session.loggedIn:
+            self.failed()
+        task, session.task = session.task, None
+        if task is None:
+            return
+
+        func, args, results, attempt = task
+        print 'Connection lost running %s%s' % (func.__name__, args)
+        if attempt < AsyncFTPTransport.RETRIES:
+            self.submit(func, args, results, attempt + 1)
+        else:
+            results.append((args, None))
+
+    def rejected(self, session, reply):
+        """Called by `session` when the server refused the login, queued tasks fail."""
+
+        print 'Login failed, %s' % reply
+        self.loginError = reply
+        while len(self.tasks) > 0:
+            func, args, results, attempt = self.tasks.popleft()
+            results.append((args, None))
+        session.control.close()
+        session.lost()
+
+    # Task methods, the ones given to `batch`. They take the session
+    # to run on and a callable that gets their result, followed
+    # by the arguments given to `put`.
+
+    def command(self, session, done, line):
+        """Sends the command `line`, the result is the reply or `None` on errors."""
+
+        session.command(line, done)
+
+    def delete(self, session, done, filename):
+        """Deletes the file `filename`, the result is `True` or `None` on errors."""
+
+        session.command('DELE %s' % filename, lambda reply: done(reply and True))
+
+    def listDir(self, session, done, path):
+        """
+        Lists the directory `path` with MLSD, or LIST on servers that
+        don't support it. The result is a list of `ListItem` objects,
+        `None` if the listing failed.
+        """
+
+        lines = ['']
+        def receive(data):
+            lines[-1:] = (lines[-1] + data).split('\n')
+
+        def parsed(parse):
+            items = list()
+            for line in lines:
+                item = parse(line.rstrip('\r'))
+                if item is not None:
+                    items.append(item)
+            return items
+
+        def listed(reply):
+            if reply is not None:
+                done(parsed(parse_list_line))
+            else:
+                done(None)
+
+        def mlsdListed(reply):
+            if reply is not None:
+                self.mlsdSupported = True
+                done(parsed(parse_mlsd_line))
+            elif self.mlsdSupported is None:
+                # Probably not understood, LIST will be used from now on.
+                self.mlsdSupported = False
+                lines[:] = ['']
+                session.transfer('LIST %s' % path, listed, receive=receive)
+            else:
+                done(None)
+
+        if self.mlsdSupported is not False:
+            session.transfer('MLSD %s' % path, mlsdListed, receive=receive)
+        else:
+            session.transfer('LIST %s' % path, listed, receive=receive)
+
+    def retrieve(self, session, done, filename, localpath, offset=0):
+        """
+        Downloads `filename` into `localpath`, appending to it when `offset`
+        is not zero. The result is the size of `localpath` afterwards,
+        `None` if the download failed.
+        """
+
+        try:
+            if offset > 0 and os.path.exists(localpath):
+                # Retries get the same `offset`, the download resumes
+                # from wherever the previous attempt stopped.
+                offset = os.path.getsize(localpath)
+                f = open(localpath, 'ab')
+                f.seek(0, os.SEEK_END)
+            else:
+                offset = 0
+                f = open(localpath, 'wb')
+        except (IOError, OSError):
+            done(None)
+            return
+
+        def retrieved(reply):
+            size = f.tell()
+            f.close()
+            done(size if reply is not None else None)
+
+        session.transfer('RETR %s' % filename, retrieved, receive=f.write, rest=offset)
+
+    def store(self, session, done, filename, localpath, offset=0, callback=None):
+        """
+        Uploads `localpath` to `filename`, from `offset` when it's not zero.
+        `callback` gets the blocks sent. The result is the number of bytes
+        of the file, `None` if the upload failed.
+        """
+
+        try:
+            f = open(localpath, 'rb')
+            f.seek(offset)
+        except (IOError, OSError):
+            done(None)
+            return
+
+        def stored(reply):
+            size = f.tell()
+            f.close()
+            done(size if reply is not None else None)
+
+        session.transfer('STOR %s' % filename, stored, source=ProgressReader(f, callback),
+                         rest=offset)
+
+    def reply(self, session, done, *lines):
+        """
+        Sends the commands `lines` one after the other. The result is the
+        reply to the last one, or to the first one that failed, `None`
+        if the connection was lost.
+        """
+
+        def replied(reply, remaining):
+            if reply is None or reply[:1] not in '23' or len(remaining) == 0:
+                done(reply)
+            else:
+                session.control.command(remaining[0], lambda reply: replied(reply, remaining[1:]))
+
+        session.control.command(lines[0], lambda reply: replied(reply, lines[1:]))
+
+    def lines(self, session, done, line):
+        """
+        Runs the listing command `line`, the result is the list
+        of lines received, `None` if the listing failed.
+        """
+
+        lines = ['']
+        def receive(data):
+            lines[-1:] = (lines[-1] + data).split('\n')
+
+        def listed(reply):
+            done([line.rstrip('\r') for line in lines if line] if reply is not None else None)
+
+        session.transfer(line, listed, receive=receive)
+
+    def stream(self, session, done, line, status, receive=None, source=None):
+        """
+        Runs the transfer command `line` from the offset `status['offset']`,
+        received data goes to `receive` and `source` is sent. Only
+        `status['remaining']` bytes are received when it's not `None`.
+        `status` keeps track of the progress, so a retry after a lost
+        connection starts where the previous attempt stopped.
+        """
+
+        def received(data):
+            if status['remaining'] is not None:
+                data = data[:status['remaining']]
+                status['remaining'] -= len(data)
+            status['offset'] += len(data)
+            if data:
+                receive(data)
+
+        if source is not None:
+            source.seek(status['offset'])
+        session.transfer(line, done, receive=received if receive is not None else None,
+                         source=source, rest=status['offset'])
+
+    # `filetransfer_abc` operations, each one runs a task and waits for it.
+
+    def sendcmd(self, *lines):
+        """
+        Runs `lines` on one of the connections and returns the last reply.
+        Error replies are raised as the `ftplib` errors.
+        """
+
+        reply = self.call(self.reply, *lines)
+        if reply is None:
+            raise EOFError('Connection lost running %s' % lines[0])
+        if reply[:1] == '4':
+            raise error_temp(reply)
+        if reply[:1] == '5':
+            raise error_perm(reply)
+
+        return reply
+
+    def transfer(self, line, status, receive=None, source=None):
+        """Runs the `stream` task, the error reply is not known when it fails."""
+
+        if self.call(self.stream, line, status, receive, source) is None:
+            raise error_perm('550 %s failed.' % line)
+
+    def setdir(self, path):
+        self.sendcmd('CWD %s' % path)
+
+    @property
+    def currentdir(self):
+        return parse257(self.sendcmd('PWD'))
+
+    def listfiles_mlsd(self, path, callback_function):
+        lines = self.call(self.lines, 'MLSD %s' % path)
+        if lines is None:
+            raise error_perm('550 MLSD %s failed.' % path)
+        for line in lines:
+            callback_function(line)
+
+    def listfiles_ftpdetails(self, path, callback_function):
+        lines = self.call(self.lines, 'LIST %s' % path)
+        if lines is None:
+            raise error_perm('550 LIST %s failed.' % path)
+        for line in lines:
+            callback_function(line)
+
+    def deleteFile(self, filename):
+        self.sendcmd('DELE %s' % filename)
+
+    def rename(self, src, dest):
+        self.sendcmd('RNFR %s' % src, 'RNTO %s' % dest)
+
+    def makeDir(self, path):
+        self.sendcmd('MKD %s' % path)
+
+    def fileSize(self, filename):
+        return int(self.sendcmd('SIZE %s' % filename).split(' ')[-1])
+
+    def fileExists(self, filepath):
+        try:
+            self.sendcmd('SIZE %s' % filepath)
+        except (error_perm, error_temp):
+            return False
+
+        return True
+
+    def lastModified(self, filename):
+        return parse_timestamp(self.sendcmd('MDTM %s' % filename).split(' ')[-1]) or dt.utcnow()
+
+    def setLastModified(self, serverpath, newtime):
+        try:
+            self.sendcmd('MFMT %s %s' % (newtime.strftime('%Y%m%d%H%M%S'), serverpath))
+        except error_perm:
+            self.sendcmd('MDTM %s %s' % (newtime.strftime('%Y%m%d%H%M%S'), serverpath))
+
+    # Transfers on the event loop are all MODE S, `compressed` is ignored.
+
+    def downloadFile(self, filename, callback_function, rest=0, length=None, compressed=False):
+        # Data past `length` is dropped, the transfer isn't aborted.
+        self.transfer('RETR %s' % filename, {'offset': rest, 'remaining': length},
+                      receive=callback_function)
+
+    def uploadFile(self, filename, f, callback_function=None, rest=0, compressed=False):
+        self.transfer('STOR %s' % filename, {'offset': rest, 'remaining': None},
+                      source=ProgressReader(f, callback_function))
+
+    def appendFile(self, filename, f, callback_function=None):
+        # APPE takes no offset, `stream` seeks to the current position.
+        self.transfer('APPE %s' % filename, {'offset': 0, 'remaining': None},
+                      source=ProgressReader(f, callback_function, f.tell()))
+
+    def features(self):
+        try:
+            return parse_features(self.sendcmd('FEAT'))
+        except (error_perm, error_temp):
+            return dict()
+
+    def fileHash(self, filename, command, algorithm):
+        return parse_hash_reply(self.sendcmd('%s %s' % (command, filename)), algorithm)
+
+
+class ProgressReader(object):
+    """
+    Read only view of a file object that hands the blocks read to
+    `callback`, the offsets given to `seek` are relative to `start`.
+    """
+
+    def __init__(self, f, callback=None, start=0):
+        super(ProgressReader, self).__init__()
+
+        self.f = f
+        self.callback = callback
+        self.start = start
+
+    def seek(self, offset):
+        self.f.seek(self.start + offset)
+
+    def read(self, size):
+        data = self.f.read(size)
+        if data and self.callback is not None:
+            self.callback(data)
+        return data
+
+
+class AsyncBatch(object):
+    """
+    Group of calls to the same task method of `AsyncFTPTransport`, whose
+    results are collected by iterating over the batch. Same interface
+    as `ftppool.Batch`: more calls can be added while iterating, iteration
+    ends when every call added so far has returned. The event loop runs
+    while iterating.
+    """
+
+    def __init__(self, transport, func):
+        super(AsyncBatch, self).__init__()
+
+        self.transport = transport
+        self.func = func
+        self.pending = 0
+        self.results = deque()
+
+    def put(self, *args):
+        """Schedules a call to the batch task with the arguments `args`."""
+
+        self.pending += 1
+        self.transport.submit(self.func, args, self.results)
+
+    def __iter__(self):
+        """Yields `(args, result)` tuples, in completion order."""
+
+        while self.pending > 0:
+            while len(self.results) == 0:
+                self.transport.poll()
+            args, result = self.results.popleft()
+            self.pending -= 1
+            yield args, result
@@ -0,0 +1,118 @@
+import os
+import zlib
+
+
+# Extensions of files sent with MODE Z without looking at them.
+COMPRESSIBLE = frozenset([
+    'txt', 'csv', 'tsv', 'log', 'xml', 'json', 'html', 'htm', 'css', 'js',
+    'sql', 'md', 'rst', 'ini', 'cfg', 'conf', 'yaml', 'yml', 'py', 'c', 'h',
+    'cpp', 'java', 'php', 'sh', 'bat', 'svg', 'rtf', 'tex', 'bmp', 'tif',
+    'tiff', 'wav', 'dat'])
+
+# Extensions of formats that are already compressed.
+INCOMPRESSIBLE = frozenset([
+    'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'cab', 'jar', 'apk',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'mp3', 'ogg', 'aac', 'flac', 'm4a',
+    'mp4', 'm4v', 'avi', 'mkv', 'mov', 'wmv', 'docx', 'xlsx', 'pptx',
+    'odt', 'ods', 'odp', 'iqz'])
+
+# Smaller files are sent as they are, switching modes
+# takes longer than what compression saves.
+MIN_SIZE = 4 * 1024
+
+# Bytes of the file compressed to decide on unknown extensions.
+SAMPLE_SIZE = 64 * 1024
+
+# The sample must shrink to this fraction of its size.
+MAX_RATIO = 0.8
+
+# zlib compression level of the uploads.
+LEVEL = 6
+
+
+def worth_compressing(filename, size, localpath=None):
+    """
+    Tells whether `filename` should be transferred with MODE Z. The
+    extension decides when it's a known one, other files are decided by
+    compressing a sample of `localpath`, when there's a local copy.
+
+    :param filename: Path of the file, only the extension is used
+    :param size: Size of the file in bytes, `None` if not known
+    :param localpath: Absolute local path of the file, if it exists
+    """
+
+    if size is not None and size < MIN_SIZE:
+        return False
+
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    if extension in COMPRESSIBLE:
+        return True
+    if extension in INCOMPRESSIBLE or localpath is None:
+        return False
+
+    try:
+        with open(localpath, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+    except (IOError, OSError):
+        return False
+
+    if len(sample) < MIN_SIZE:
+        return False
+
+    # The fastest level is enough to tell.
+    return len(zlib.compress(sample, 1)) <= len(sample) * MAX_RATIO
+
+
+class Inflater(object):
+    """
+    Chunk callback inflating a MODE Z data stream, `callback` gets the
+    inflated blocks. `flush` must be called once the transfer is over.
+    """
+
+    def __init__(self, callback):
+        super(Inflater, self).__init__()
+
+        self.callback = callback
+        self.inflater = zlib.decompressobj()
+
+    def __call__(self, chunk):
+        block = self.inflater.decompress(chunk)
+        if block:
+            self.callback(block)
+
+    def flush(self):
+        block = self.inflater.flush()
+        if block:
+            self.callback(block)
+
+
+class DeflatingReader(object):
+    """
+    Read only view of the file object `f` whose data comes out deflated,
+    to be sent in MODE Z. `callback` gets the blocks read from `f`.
+    """
+
+    def __init__(self, f, callback=None):
+        super(DeflatingReader, self).__init__()
+
+        self.f = f
+        self.callback = callback
+        self.deflater = zlib.compressobj(LEVEL)
+        self.finished = False
+
+    def read(self, size):
+        # Empty reads mean the end of the file, zlib keeps small
+        # blocks buffered so more is read until there's output.
+        while not self.finished:
+            block = self.f.read(size)
+            if block:
+                if self.callback is not None:
+                    self.callback(block)
+                data = self.deflater.compress(block)
+            else:
+                data = self.deflater.flush()
+                self.finished = True
+            if data:
+                return data
+
+        return ''
@@ -1,46 +1,96 @@
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from sqlalchemy.exc import OperationalError
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Float, or_, and_
 
+import os
 import time
+import itertools
+import multiprocessing
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from hashing import identity, hash_file
+from localsettings import HASH_WORKERS
 
 engine = create_engine('sqlite:///iqmeta.db', echo=False)
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
 class ActionQueue(object):
+    """
+    Queue of pending `FileAction` objects, holding at most one action per path.
+    Actions are kept in memory, indexed by path and in arrival order, and
+    written to the database in batches of `FLUSH_SIZE` changed paths,
+    or when `flush` is called.
+    
+    The database copy works as a journal: each action goes through the
+    pending, in-flight and done (or failed) states, and the actions left
+    unfinished by a crash are replayed when the queue is created.
+    """
+    
+    FLUSH_SIZE = 100
+    # Failed actions are pending again after `RETRY_DELAY` seconds,
+    # twice as long after each failure, until they failed `RETRIES` times.
+    RETRIES = 5
+    RETRY_DELAY = 30
     
     def __init__(self, actions=[]):
         super(ActionQueue, self).__init__()
         
         self.session = Session()
-        self.clear()
+        self.actions = OrderedDict()
+        # Paths whose action changed since the last flush.
+        self.dirty = set()
+        self.replay()
         for action in actions:
             self.add(action)
         
     def __len__(self):
-        return self.session.query(FileAction).count()
+        return len(self.actions)
     
     def __getitem__(self, key):
-        return self.session.query(FileAction).all()[key]
+        return self.actions.values()[key]
     
     def __iter__(self):
-        return self.session.query(FileAction).__iter__()
+        # Iterates over a copy, actions can be added while iterating.
+        return iter(self.actions.values())
     
     def __contains__(self, action):
-        return session.query(FileAction).filter(path=action.path).count() > 1
+        return action.path in self.actions
+    
+    def get(self, path):
+        """Returns the action over `path`, `None` if there is no such action."""
+        
+        return self.actions.get(path)
     
     def remove(self, action):
-        self.session.delete(action)
-        self.session.commit()
+        self.discard(action.path)
+        
+    def discard(self, path):
+        """
+        Drops the pending action over `path`, if any.
+        
+        :param path: Path of the file on the server
+        """
+        
+        if path in self.actions:
+            print 'Discarding action: %s' % self.actions[path]
+            del self.actions[path]
+            self.changed(path)
         
     def clear(self):
+        self.actions.clear()
+        self.dirty.clear()
+        
         didClear = True
         try:
             self.session.query(FileAction).delete()
             self.session.commit()            
         except OperationalError:
+            self.session.rollback()
             didClear = False
             
         if not didClear:
@@ -50,25 +100,180 @@ class ActionQueue(object):
             self.session.commit()            
         
     
+    def replay(self):
+        """
+        Loads the actions journaled by a previous run. Finished actions
+        are dropped, the ones that were in flight when the application
+        stopped are pending again. Replaying them is safe, transfers
+        resume from their partial files and deletes of missing files
+        are ignored.
+        """
+        
+        self.actions.clear()
+        self.dirty.clear()
+        
+        self.session.query(FileAction).filter(FileAction.state == FileAction.DONE).delete(
+                synchronize_session=False)
+        self.session.commit()
+        
+        for row in self.session.query(FileAction).order_by(FileAction.id):
+            action = FileAction(row.path, row.action, row.location, row.source)
+            if row.state == FileAction.PENDING:
+                self.actions[action.path] = action
+            else:
+                # Rows from older versions have no state at all.
+                print 'Replaying action: %s' % action
+                self.actions[action.path] = action
+                self.dirty.add(action.path)
+        self.flush()
+        
     def add(self, action):
         # Looking for previous actions over the same path
-        print 'Adding action: %s' % action
-        prev_action = self.session.query(FileAction).filter_by(path=action.path).first()
+        prev_action = self.actions.get(action.path)
+        if prev_action is not None and prev_action.action == FileAction.MOVE \
+           and prev_action.state == FileAction.PENDING:
+            if action.action == FileAction.UPLOAD:
+                # Changes are uploaded once the file is moved, see `Sync`.
+                return
+            if action.action == FileAction.DELETE and action.location == FileAction.SERVER:
+                # Moved and deleted before the move was made.
+                self.discard(action.path)
+                self.add(FileAction(prev_action.source, FileAction.DELETE, FileAction.SERVER))
+                return
         if prev_action is not None:
-            # If there is an action over the same path, update it
+            if prev_action.action == action.action and prev_action.location == action.location \
+               and prev_action.source == action.source \
+               and prev_action.state in (FileAction.PENDING, FileAction.FAILED):
+                # Nothing new, happens a lot while a file is being written.
+                # Failed actions wait for their retry.
+                return
+            # If there is an action over the same path, update it.
+            # It keeps its place in the queue. Actions already in flight
+            # or finished are pending again, the file changed since.
+            print 'Updating action: %s' % action
             prev_action.action = action.action
             prev_action.location = action.location
+            prev_action.source = action.source
+            prev_action.state = FileAction.PENDING
+            prev_action.attempts = 0
         else:
-            self.session.add(action)
+            print 'Adding action: %s' % action
+            self.actions[action.path] = action
+        self.changed(action.path)
+        
+    def pending(self):
+        """
+        Returns a list with the actions waiting to be taken, in order.
+        Failed actions whose delay is over are pending again.
+        """
+        
+        now = time.time()
+        for action in self.actions.values():
+            if action.state == FileAction.FAILED and action.attempts < ActionQueue.RETRIES \
+               and action.retry <= now:
+                print 'Retrying action: %s' % action
+                action.state = FileAction.PENDING
+                self.changed(action.path)
+        
+        return [action for action in self.actions.itervalues()
+                if action.state == FileAction.PENDING]
+        
+    def start(self, action):
+        """
+        Marks `action` as in flight. The journal is written on the next
+        flush, which should happen before the transfer begins.
+        
+        :param action: Action about to be taken
+        """
+        
+        action.state = FileAction.INFLIGHT
+        self.changed(action.path)
+        
+    def finish(self, path, success=True):
+        """
+        Marks the action over `path` as done or failed. Actions that
+        were queued again while in flight are left pending.
+        
+        :param path: Path of the file on the server
+        :param success: Tells whether the action succeeded or not
+        """
+        
+        action = self.actions.get(path)
+        if action is None or action.state != FileAction.INFLIGHT:
+            return
+        
+        action.state = FileAction.DONE if success else FileAction.FAILED
+        if not success:
+            action.retry = time.time() + ActionQueue.RETRY_DELAY * 2 ** action.attempts
+            action.attempts += 1
+        self.changed(path)
+        
+    def purge(self):
+        """
+        Drops the finished actions, and the failed ones that ran out of
+        retries. Those are queued again when the file is reported again.
+        """
+        
+        for path, action in self.actions.items():
+            if action.state == FileAction.FAILED and action.attempts >= ActionQueue.RETRIES:
+                print 'Giving up on action: %s' % action
+            elif action.state != FileAction.DONE:
+                continue
+            del self.actions[path]
+            self.changed(path)
+        self.flush()
+        
+    def changed(self, path):
+        """
+        Marks the action over `path` to be written in the next flush.
+        
+        :param path: Path of the file on the server
+        """
+        
+        self.dirty.add(path)
+        if len(self.dirty) >= ActionQueue.FLUSH_SIZE:
+            self.flush()
+            
+    def flush(self):
+        """Writes the actions that changed since the last flush to the database."""
+        
+        if not self.dirty:
+            return
+        
+        dirty = list(self.dirty)
+        for i in range(0, len(dirty), ActionQueue.FLUSH_SIZE):
+            # Chunks keep the queries under SQLite's limit of variables.
+            chunk = dirty[i:i + ActionQueue.FLUSH_SIZE]
+            rows = dict((row.path, row) for row in self.session.query(FileAction).filter(
+                    FileAction.path.in_(chunk)))
+            for path in chunk:
+                action = self.actions.get(path)
+                row = rows.get(path)
+                if action is None:
+                    if row is not None:
+                        self.session.delete(row)
+                elif row is None:
+                    # In memory actions are never attached to the session.
+                    row = FileAction(action.path, action.action, action.location, action.source)
+                    row.state = action.state
+                    self.session.add(row)
+                else:
+                    # Rows are updated in place, so the journal keeps its order.
+                    row.action = action.action
+                    row.location = action.location
+                    row.source = action.source
+                    row.state = action.state
         self.session.commit()
+        self.dirty.clear()
         
     def next(self):
-        nextaction = self.session.query(FileAction).first()
+        for nextaction in self.actions.itervalues():
+            return nextaction
         
-        return nextaction
+        return None
     
     def __repr__(self):
-        return self.session.query(FileAction).all().__repr__()
+        return self.actions.values().__repr__()
     
     
 class FileAction(Base):
@@ -78,19 +283,34 @@ class FileAction(Base):
     path = Column(String)
     action = Column(String)
     location = Column(String)
+    state = Column(String)
+    # Path moved to `path`, only used by `MOVE` actions.
+    source = Column(String)
     
     UPLOAD = 'upload'
     DOWNLOAD = 'download'
     DELETE = 'delete'
+    MOVE = 'move'
     
     SERVER = 'server'
     LOCAL = 'local'
     
-    def __init__(self, path, action, location):
+    PENDING = 'pending'
+    INFLIGHT = 'inflight'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    def __init__(self, path, action, location, source=None):
         
         self.path = path
         self.action = action
         self.location = location
+        self.source = source
+        self.state = FileAction.PENDING
+        # Failures so far and when the action can be retried,
+        # they are not journaled.
+        self.attempts = 0
+        self.retry = 0
 
     def __repr__(self):
         return '<FileAction in %s ("%s" "%s" to "%s")>' % (
@@ -108,6 +328,28 @@ class File(Base):
     last_checked_server = Column(DateTime)
     inserver = Column(Boolean)
     inlocal = Column(Boolean)
+    # Stat results from the last local scan, along with
+    # `localmdate` they tell whether the local file changed.
+    localsize = Column(Integer)
+    inode = Column(Integer)
+    # Size from the last server listing, `None` when unknown.
+    serversize = Column(Integer)
+    # Modified dates of both copies when they were last in sync, each
+    # side is compared against its own. `synced_servermdate` is `None`
+    # after an upload until the server lists the new date.
+    synced_localmdate = Column(DateTime)
+    synced_servermdate = Column(DateTime)
+    # Size and modified date of the server copy the partial download
+    # was started from, it can't be resumed once the server copy changed.
+    partialsize = Column(Integer)
+    partialmdate = Column(DateTime)
+    # Size and mtime of the local file a partial upload was sending, and the
+    # size and modified date the server copy had before, `None` if there
+    # was none. Kept until the upload completes, even across restarts.
+    uploadsize = Column(Integer)
+    uploadmtime = Column(Float)
+    uploadbasesize = Column(Integer)
+    uploadbasemdate = Column(DateTime)
     
     def __init__(
             self, path='', localmdate=None, servermdate=None,
@@ -135,6 +377,98 @@ class File(Base):
     def timeDiff(self):
         return (self.localmdate - self.servermdate).total_seconds()
         
+    def localChanged(self):
+        """
+        Tells whether the local copy changed since both copies were last
+        in sync, `None` if they never were.
+        """
+        
+        if self.synced_localmdate is None:
+            return None
+        
+        return self.localmdate != self.synced_localmdate
+    
+    def serverChanged(self):
+        """
+        Tells whether the server copy changed since both copies were last
+        in sync, `None` if they never were.
+        """
+        
+        if self.synced_localmdate is None:
+            return None
+        if self.synced_servermdate is None:
+            # Just uploaded, the date is taken from the next listing.
+            return False
+        
+        return self.servermdate != self.synced_servermdate
+    
+    def markSynced(self):
+        """Records the current modified dates as the ones both copies are in sync at."""
+        
+        self.synced_localmdate = self.localmdate
+        self.synced_servermdate = self.servermdate
+        
+    @classmethod
+    def sizes(cls, paths):
+        """
+        Returns a dict that maps the paths among `paths` whose server
+        size is known to it, with one query per hundred paths.
+        
+        :param paths: `path` attributes of the `File` instances
+        """
+        
+        session = Session()
+        sizes = dict()
+        for i in range(0, len(paths), 100):
+            query = session.query(cls.path, cls.serversize).filter(cls.path.in_(paths[i:i + 100]))
+            sizes.update((path, size) for path, size in query if size is not None)
+            
+        return sizes
+    
+    @classmethod
+    def partialUploads(cls, paths):
+        """
+        Returns a dict that maps the paths among `paths` with a partial upload
+        to `((size, mtime), (size, mdate))` tuples, the identity of the local
+        file and the server copy from before the upload, `None` if there
+        was none. Uses one query per hundred paths.
+        
+        :param paths: `path` attributes of the `File` instances
+        """
+        
+        session = Session()
+        partials = dict()
+        for i in range(0, len(paths), 100):
+            query = session.query(cls.path, cls.uploadsize, cls.uploadmtime, cls.uploadbasesize,
+                                  cls.uploadbasemdate).filter(cls.path.in_(paths[i:i + 100])).filter(
+                                  cls.uploadsize != None)
+            for path, size, mtime, basesize, basemdate in query:
+                base = (basesize, basemdate) if basemdate is not None else None
+                partials[path] = ((size, mtime), base)
+                
+        return partials
+    
+    @classmethod
+    def recordPartialUpload(cls, path, partial):
+        """
+        Stores the partial upload of `path`, in a session of its own so
+        the transfer workers can call it. Does nothing if there's no such row.
+        
+        :param path: `path` attribute of the `File` instance
+        :param partial: `((size, mtime), (size, mdate))` tuple as returned
+                        by `partialUploads`, `None` to remove it
+        """
+        
+        identity, base = partial if partial is not None else (None, None)
+        identity = identity or (None, None)
+        base = base or (None, None)
+        session = Session()
+        session.query(cls).filter_by(path=path).update({
+                cls.uploadsize: identity[0], cls.uploadmtime: identity[1],
+                cls.uploadbasesize: base[0], cls.uploadbasemdate: base[1]},
+                synchronize_session=False)
+        session.commit()
+    
     @classmethod
     def fromPath(cls, path):
         """
@@ -160,13 +494,490 @@ class File(Base):
             return newfile
         
 
+class Directory(Base):
+    """
+    Server directory as seen by the last remote scan. Directories whose
+    listing still has the same `fingerprint` don't need their files
+    checked again.
+    """
+    
+    __tablename__ = 'directories'
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True)
+    fingerprint = Column(String)
+    last_checked_server = Column(DateTime)
+    
+    def __init__(self, path='', fingerprint=None, last_checked_server=None):
+        
+        self.path = path
+        self.fingerprint = fingerprint
+        self.last_checked_server = last_checked_server
+        
+    def __repr__(self):
+        return '<Directory in %s ("%s")>' % (self.__tablename__, self.path)
+    
+    @classmethod
+    def childrenFilter(cls, query, path, recursive=False):
+        """
+        Filters `query` over `File` or `Directory` down to the entries
+        inside the directory `path`.
+        
+        :param query: Query whose entity has a `path` column
+        :param path: Absolute path of the directory on the server
+        :param recursive: Whether to include entries in subdirectories
+        """
+        
+        entity = query.column_descriptions[0]['entity']
+        prefix = path if path.endswith('/') else path + '/'
+        # Paths starting with `prefix` sort right before the ones starting
+        # with `prefix` after replacing its trailing '/' with the next character, '0'.
+        query = query.filter(entity.path > prefix).filter(entity.path < prefix[:-1] + '0')
+        if not recursive:
+            # Escaping LIKE wildcards that could be part of the path
+            escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            query = query.filter(entity.path.notlike(escaped + '%/%', escape='\\'))
+            
+        return query
+            
+
+class FileHash(Base):
+    """
+    Digest of a local file, valid as long as the file keeps
+    the same inode, size and last modified time.
+    """
+    
+    __tablename__ = 'hashes'
+    id = Column(Integer, primary_key=True)
+    path = Column(String, index=True)
+    algorithm = Column(String)
+    inode = Column(Integer)
+    size = Column(Integer)
+    mtime = Column(Float)
+    digest = Column(String)
+    
+    def __init__(self, path, algorithm, inode, size, mtime, digest):
+        
+        self.path = path
+        self.algorithm = algorithm
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        
+    def __repr__(self):
+        return '<FileHash in %s ("%s" %s "%s")>' % (
+                self.__tablename__, self.path, self.algorithm, self.digest)
+        
+        
+class ServerCapabilities(Base):
+    """
+    What a server supports for a given user: the `FEAT` reply and the
+    result of the write test. Trusted for `TTL` as long as the server
+    keeps advertising the same features, so logins skip the test uploads.
+    """
+    
+    __tablename__ = 'capabilities'
+    id = Column(Integer, primary_key=True)
+    host = Column(String)
+    user = Column(String)
+    # One feature per line, the way `FEAT` lists them.
+    features = Column(String)
+    writable = Column(Boolean)
+    checked = Column(DateTime)
+    # Whether the server replies to pipelined commands, `None` until tested.
+    pipelining = Column(Boolean)
+    
+    TTL = timedelta(days=7)
+    
+    def __init__(self, host, user):
+        
+        self.host = host
+        self.user = user
+        self.features = ''
+        self.writable = False
+        self.checked = None
+        self.pipelining = None
+        
+    def __repr__(self):
+        return '<ServerCapabilities in %s ("%s@%s" checked %s)>' % (
+                self.__tablename__, self.user, self.host, self.checked)
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.session.commit()
+        
+    def featureDict(self):
+        """Returns the features as a dict that maps their names to their parameters."""
+        
+        features = dict()
+        for line in self.features.splitlines():
+            name, sep, params = line.partition(' ')
+            features[name] = params
+            
+        return features
+    
+    def setFeatures(self, features):
+        """
+        Stores `features`, a dict as returned by `featureDict`.
+        """
+        
+        self.features = '\n'.join(sorted(
+                ('%s %s' % item).strip() for item in features.iteritems()))
+        
+    def current(self, features):
+        """
+        Tells whether the stored results are still about the same server,
+        checked less than `TTL` ago and advertising the same `features`.
+        A server upgrade or a different proxy in front of it changes them.
+        
+        :param features: Dict of the features in the current `FEAT` reply
+        """
+        
+        if self.checked is None:
+            return False
+        if datetime.utcnow() - self.checked > ServerCapabilities.TTL:
+            return False
+        
+        return self.featureDict() == features
+        
+    def fresh(self, features):
+        """
+        Tells whether the stored results can be used instead of testing
+        the server again, given the `features` it advertises now.
+        
+        :param features: Dict of the features in the current `FEAT` reply
+        """
+        
+        return self.writable and self.current(features)
+    
+    @classmethod
+    def fromLogin(cls, host, user):
+        """
+        Returns the `ServerCapabilities` instance of `user` at `host`,
+        adding an empty one to the database if there is none.
+        
+        :param host: Location of the FTP server
+        :param user: Name the user logged in with
+        """
+        
+        session = Session()
+        capabilities = session.query(cls).filter_by(host=host, user=user).first()
+        if capabilities is None:
+            capabilities = cls(host, user)
+            session.add(capabilities)
+        capabilities.session = session
+        
+        return capabilities
+        
+
+class ScanWriter(object):
+    """
+    Database writer for the scanners. Rows are loaded a directory at
+    a time and changes are committed together, once per directory or
+    every `FLUSH_SIZE` changed rows, instead of once per file.
+    Signals that depend on the changes are held back until they are committed.
+    """
+    
+    FLUSH_SIZE = 1000
+    
+    def __init__(self):
+        super(ScanWriter, self).__init__()
+        
+        # Loaded rows are used across commits, no need to reload them.
+        self.session = Session(expire_on_commit=False)
+        self.rows = dict()
+        self.changes = 0
+        self.signals = []
+        
+    def load(self, path):
+        """
+        Fetches the `File` rows of the files inside the directory `path`
+        with a single query. Rows loaded for the previous directory are dropped.
+        
+        :param path: Absolute path of the directory on the server
+        """
+        
+        self.rows = dict((file_.path, file_) for file_ in 
+                         Directory.childrenFilter(self.session.query(File), path))
+        
+    def localSnapshot(self):
+        """
+        Returns a dictionary that maps the path of every file known to be
+        in the local folder to a `(localmdate, localsize, inode, inserver, servermdate,
+        synced_localmdate)` tuple, fetched with a single query and without building
+        `File` instances.
+        """
+        
+        query = self.session.query(
+                File.path, File.localmdate, File.localsize, File.inode,
+                File.inserver, File.servermdate, File.synced_localmdate).filter(
+                File.inlocal == True)
+        
+        return dict((row[0], tuple(row[1:])) for row in query)
+        
+    def get(self, path):
+        """
+        Returns the `File` instance for `path` among the loaded rows, if there
+        is no such row this function adds it to the session and returns it.
+        
+        :param path: `path` attribute of the `File` instance
+        """
+        
+        file_ = self.rows.get(path)
+        if file_ is None:
+            file_ = File(path)
+            self.session.add(file_)
+            self.rows[path] = file_
+            
+        return file_
+    
+    def changed(self):
+        """Counts a changed row, commits when there are enough of them."""
+        
+        self.changes += 1
+        if self.changes >= ScanWriter.FLUSH_SIZE:
+            self.commit()
+    
+    def emit(self, signal, *args):
+        """
+        Emits `signal` with `args` once the current changes are committed.
+        
+        :param signal: Signal to be emitted
+        """
+        
+        self.signals.append((signal, args))
+        
+    def commit(self):
+        """Commits the pending changes and emits the signals held back."""
+        
+        self.session.commit()
+        self.changes = 0
+        
+        signals = self.signals
+        self.signals = []
+        for signal, args in signals:
+            signal.emit(*args)
+            
+
+class HashCache(object):
+    """
+    Digests of local files, stored in the `hashes` table along with the
+    file identity: inode, size and last modified time. Files are only read
+    again when their identity changed. Missing digests are computed by
+    a pool of `HASH_WORKERS` processes. Used from the sync thread.
+    """
+
+    # Paths per query when looking up digests.
+    CHUNK = 100
+    # Fewer files than this are hashed in the calling process.
+    POOL_MIN = 4
+
+    def __init__(self):
+        super(HashCache, self).__init__()
+
+        self.session = Session()
+        # Maps `(localpath, algorithm)` to `(identity, digest)` tuples,
+        # the rows already fetched or stored.
+        self.entries = dict()
+        self.pool = None
+
+    def stored(self, localpaths, algorithm):
+        """
+        Returns a dict that maps the paths among `localpaths` with a stored
+        digest to `(identity, digest)` tuples, whether the files still
+        have that identity or not. Digests are fetched with one query
+        per `CHUNK` paths.
+
+        :param localpaths: Absolute local paths of the files
+        :param algorithm: Name of the algorithm as used by the HASH command
+        """
+
+        found = dict()
+        unknown = []
+        for localpath in localpaths:
+            entry = self.entries.get((localpath, algorithm))
+            if entry is not None:
+                found[localpath] = entry
+            else:
+                unknown.append(localpath)
+
+        for i in range(0, len(unknown), HashCache.CHUNK):
+            chunk = unknown[i:i + HashCache.CHUNK]
+            query = self.session.query(FileHash).filter(FileHash.algorithm == algorithm).filter(
+                    FileHash.path.in_(chunk))
+            for row in query:
+                entry = ((row.inode, row.size, row.mtime), row.digest)
+                self.entries[(row.path, algorithm)] = entry
+                found[row.path] = entry
+
+        return found
+
+    def fetch(self, localpaths, algorithm):
+        """
+        Returns a dict that maps the paths among `localpaths` to their
+        digests, computing the ones missing or out of date. Files that
+        can't be read are left out.
+
+        :param localpaths: Absolute local paths of the files
+        :param algorithm: Name of the algorithm as used by the HASH command
+        """
+
+        identities = dict()
+        for localpath in localpaths:
+            current = identity(localpath)
+            if current is not None:
+                identities[localpath] = current
+
+        digests = dict()
+        for localpath, (known, digest) in self.stored(identities.keys(), algorithm).iteritems():
+            if known == identities.get(localpath):
+                digests[localpath] = digest
+
+        missing = [(localpath, algorithm) for localpath in identities if localpath not in digests]
+        if len(missing) == 0:
+            return digests
+
+        if len(missing) >= HashCache.POOL_MIN and HASH_WORKERS > 0:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(HASH_WORKERS)
+            results = self.pool.imap_unordered(hash_file, missing)
+        else:
+            results = itertools.imap(hash_file, missing)
+
+        computed = []
+        for localpath, digest in results:
+            if digest is not None:
+                digests[localpath] = digest
+                computed.append(localpath)
+        self.store(computed, identities, digests, algorithm)
+
+        return digests
+
+    def digest(self, localpath, algorithm):
+        """
+        Returns the digest of `localpath` computed with `algorithm`,
+        `None` if the file can't be read.
+
+        :param localpath: Absolute local path of the file
+        :param algorithm: Name of the algorithm as used by the HASH command
+        """
+
+        return self.fetch([localpath], algorithm).get(localpath)
+
+    def store(self, localpaths, identities, digests, algorithm):
+        """Replaces the stored digests of `localpaths`, in one transaction."""
+
+        for i in range(0, len(localpaths), HashCache.CHUNK):
+            chunk = localpaths[i:i + HashCache.CHUNK]
+            self.session.query(FileHash).filter(FileHash.algorithm == algorithm).filter(
+                    FileHash.path.in_(chunk)).delete(synchronize_session=False)
+        for localpath in localpaths:
+            inode, size, mtime = identities[localpath]
+            self.session.add(FileHash(localpath, algorithm, inode, size, mtime, digests[localpath]))
+            self.entries[(localpath, algorithm)] = (identities[localpath], digests[localpath])
+        self.session.commit()
+            
+
 def empty_db():
     session = Session()
     
     return session.query(File).count() == 0
+
+def unsettled_dirs():
+    """
+    Returns the paths of the directories holding server files that are not
+    known to be in sync, or whose last action failed. Their files are
+    checked again even when their listing didn't change.
+    """
+    
+    session = Session()
+    query = session.query(File.path).filter(File.inserver == True).filter(or_(
+            File.synced_localmdate == None, File.synced_servermdate == None,
+            File.servermdate != File.synced_servermdate,
+            and_(File.inlocal == True, File.localmdate != File.synced_localmdate)))
+    paths = set(path for path, in query)
+    paths.update(path for path, in session.query(FileAction.path).filter(
+            FileAction.state == FileAction.FAILED))
+    
+    return set(os.path.dirname(path) for path in paths)
+
+def move_paths(src, dest):
+    """
+    Renames the `File` and `Directory` rows of the file or directory `src`,
+    and of everything inside it, to be under `dest`. Rows already there
+    are replaced. Returns the number of `File` rows moved.
+    
+    :param src: Absolute path on the server before the move
+    :param dest: Absolute path on the server after the move
+    """
+    
+    session = Session()
+    moved = 0
+    for entity in (File, Directory):
+        # Whatever was at `dest` is gone, it was replaced.
+        session.query(entity).filter(entity.path == dest).delete(synchronize_session=False)
+        Directory.childrenFilter(session.query(entity), dest, recursive=True).delete(
+                synchronize_session=False)
+        
+        rows = session.query(entity).filter(entity.path == src).all()
+        rows += Directory.childrenFilter(session.query(entity), src, recursive=True).all()
+        for row in rows:
+            row.path = dest + row.path[len(src):]
+        if entity is File:
+            moved = len(rows)
+    session.commit()
+    
+    return moved
+            
+def add_missing_columns(table):
+    """
+    Adds the columns of `table` missing from the database file,
+    which happens with databases created by older versions.
+    New columns start as NULL on existing rows.
+    
+    :param table: `Table` object from the models metadata
+    """
+    
+    existing = set(row[1] for row in engine.execute('PRAGMA table_info(%s)' % table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            print 'Adding column %s to %s' % (column.name, table.name)
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(engine.dialect)))
+            
+
+def seed_directories():
+    """
+    Adds a `Directory` row for every server directory holding files known
+    to be in the server, when there are no rows yet. Databases created by
+    older versions only have `File` rows, and remote scans find the
+    removed directories through their `Directory` rows.
+    """
+    
+    session = Session()
+    if session.query(Directory).count() > 0:
+        return
+    
+    dirpaths = set()
+    for path, in session.query(File.path).filter(File.inserver == True):
+        dirpath = path.rsplit('/', 1)[0]
+        while len(dirpath) > 0 and dirpath not in dirpaths:
+            dirpaths.add(dirpath)
+            dirpath = dirpath.rsplit('/', 1)[0]
+            
+    if len(dirpaths) > 0:
+        print 'Adding %d directories from the known files' % len(dirpaths)
+        # No fingerprint, the first scan checks all of their files.
+        session.add_all(Directory(dirpath) for dirpath in dirpaths)
+        session.commit()
             
 
 Base.metadata.create_all(engine)
+for table in Base.metadata.sorted_tables:
+    add_missing_columns(table)
+seed_directories()
 
 if __name__ == '__main__':
     session = Session()
@@ -0,0 +1,225 @@
+import os
+import time
+import threading
+
+
+class Debouncer(object):
+    """
+    Collects file system events and merges the ones over the same path,
+    a file being written produces lots of them. Merged events are handed
+    out by `ready` once their path has been quiet for `QUIET` seconds
+    and its size and last modified time stopped changing.
+    Events can be pushed from any thread.
+    """
+
+    CREATED = 'created'
+    MODIFIED = 'modified'
+    DELETED = 'deleted'
+    MOVED = 'moved'
+
+    # Seconds without events before a path is considered for `ready`.
+    QUIET = 2.0
+
+    def __init__(self):
+        super(Debouncer, self).__init__()
+
+        self.lock = threading.Lock()
+        # Maps paths to `[kind, time of the last event, stat, source]` lists,
+        # `source` is the path a `MOVED` file or directory came from.
+        self.events = dict()
+
+    def __len__(self):
+        return len(self.events)
+
+    @staticmethod
+    def stat(path):
+        """Returns the `(size, mtime)` tuple of `path`, `None` if it's gone."""
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return st.st_size, st.st_mtime
+
+    @classmethod
+    def merge(cls, previous, kind):
+        """
+        Returns the event that stands for `previous` followed by `kind`,
+        `None` when they cancel out.
+
+        :param previous: Kind of the pending event over the path
+        :param kind: Kind of the new event over the path
+        """
+
+        if previous == cls.CREATED:
+            if kind == cls.DELETED:
+                # Temporary file, the rest of the engine never knew about it.
+                return None
+            return cls.CREATED
+        if previous == cls.MOVED and kind != cls.DELETED:
+            # Changes after a move are found when the move is reported.
+            return cls.MOVED
+        if previous == cls.DELETED and kind != cls.DELETED:
+            # Replaced, the way many editors save files.
+            return cls.MODIFIED
+
+        return kind
+
+    def push(self, path, kind):
+        """
+        Records an event over `path`.
+
+        :param path: Absolute local path of the file
+        :param kind: One of `CREATED`, `MODIFIED` or `DELETED`
+        """
+
+        st = None if kind == Debouncer.DELETED else Debouncer.stat(path)
+        with self.lock:
+            pending = self.events.get(path)
+            if pending is not None:
+                if pending[0] == Debouncer.MOVED and kind == Debouncer.DELETED:
+                    # Moved and then deleted, it's the source that goes away.
+                    del self.events[path]
+                    path = pending[3]
+                kind = Debouncer.merge(pending[0], kind)
+                if kind is None:
+                    del self.events[path]
+                    return
+            self.events[path] = [kind, time.time(), st, None]
+
+    def move(self, src, dest):
+        """
+        Records that the file or directory `src` was moved to `dest`.
+        Files that were never reported at `src` are just created at `dest`.
+        Moves of the contents of a directory whose move is pending are
+        part of it, they are dropped.
+
+        :param src: Absolute local path before the move
+        :param dest: Absolute local path after the move
+        """
+
+        st = Debouncer.stat(dest)
+        with self.lock:
+            pending = self.events.pop(src, None)
+            if pending is not None and pending[0] == Debouncer.CREATED:
+                kind, source = Debouncer.CREATED, None
+            elif pending is not None and pending[0] == Debouncer.MOVED:
+                # Moved twice, only the original location matters.
+                kind, source = Debouncer.MOVED, pending[3]
+            else:
+                kind, source = Debouncer.MOVED, src
+
+            if kind == Debouncer.MOVED and self.covered(source, dest):
+                return
+            previous = self.events.get(dest)
+            if kind == Debouncer.CREATED and previous is not None:
+                kind = Debouncer.merge(previous[0], kind)
+            self.events[dest] = [kind, time.time(), st, source]
+
+    def covered(self, src, dest):
+        """
+        Tells whether the move from `src` to `dest` comes with
+        the pending move of a parent directory. Call with `self.lock` held.
+        """
+
+        for path, (kind, when, st, source) in self.events.iteritems():
+            if kind != Debouncer.MOVED or not src.startswith(source + os.sep):
+                continue
+            if dest == path + src[len(source):]:
+                return True
+
+        return False
+
+    def discard(self, path):
+        """Forgets the pending event over `path`, if any."""
+
+        with self.lock:
+            self.events.pop(path, None)
+
+    def ready(self):
+        """
+        Returns a list of `(path, kind, source)` tuples with the events
+        whose path is quiet and stable, and forgets about them. `source`
+        is only set for `MOVED` events.
+        Files still changing without sending events, or whose
+        stat results differ from the last event's, wait some more.
+        """
+
+        now = time.time()
+        with self.lock:
+            quiet = [(path, event) for path, event in self.events.iteritems()
+                     if now - event[1] >= Debouncer.QUIET]
+
+        ready = []
+        for path, (kind, when, st, source) in quiet:
+            current = None if kind == Debouncer.DELETED else Debouncer.stat(path)
+            with self.lock:
+                if self.events.get(path) is None or self.events[path][1] != when:
+                    # New events came in meanwhile.
+                    continue
+                if current != st:
+                    if current is None and kind == Debouncer.CREATED:
+                        # Gone before it was ever reported.
+                        del self.events[path]
+                    elif current is None and kind == Debouncer.MOVED:
+                        del self.events[path]
+                        self.events[source] = [Debouncer.DELETED, now, None, None]
+                    elif current is None:
+                        self.events[path] = [Debouncer.DELETED, now, None, None]
+                    else:
+                        self.events[path] = [kind, now, current, source]
+                    continue
+                del self.events[path]
+            ready.append((path, kind, source))
+
+        return ready
+
+
+class EchoRegistry(object):
+    """
+    Local files the engine itself just wrote or deleted, so that the
+    file system events they cause are not taken for user changes.
+    Each path is expected to have the stat results left by the engine,
+    or to be gone, for `TTL` seconds. Used from any thread.
+    """
+
+    # Seconds an expectation holds.
+    TTL = 60.0
+
+    def __init__(self):
+        super(EchoRegistry, self).__init__()
+
+        self.lock = threading.Lock()
+        # Maps paths to `(stat, expiration time)` tuples.
+        self.expected = dict()
+
+    def expect(self, path, st=None):
+        """
+        Records that the engine left `path` with the `(size, mtime)` stat
+        results `st`, or deleted it if `st` is `None`.
+
+        :param path: Absolute local path of the file
+        :param st: Stat results as returned by `Debouncer.stat`
+        """
+
+        with self.lock:
+            self.expected[path] = (st, time.time() + EchoRegistry.TTL)
+
+    def isEcho(self, path):
+        """
+        Tells whether `path` is still how the engine left it, events
+        over it are then caused by the engine. Expired entries are dropped.
+
+        :param path: Absolute local path of the file
+        """
+
+        now = time.time()
+        with self.lock:
+            for expired in [p for p, (st, until) in self.expected.iteritems() if until < now]:
+                del self.expected[expired]
+            if path not in self.expected:
+                return False
+            st = self.expected[path][0]
+
+        return Debouncer.stat(path) == st
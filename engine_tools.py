@@ -1,4 +1,21 @@
 import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport for Python 2, see dependencies.txt
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Downloads are written to `<localpath><PARTIAL_SUFFIX>` and renamed
+# into place once they are complete.
+PARTIAL_SUFFIX = '.iqbox.part'
+# Segmented downloads use a preallocated file of their own,
+# it can't be resumed so it's removed before each download.
+SEGMENTS_SUFFIX = '.segments' + PARTIAL_SUFFIX
 
 #class engine_tools:
 
@@ -6,9 +23,54 @@ import os
 def isTemporaryFile (file_name_only):
     return file_name_only.startswith('~$') or \
            file_name_only.startswith('.~') or \
-           (file_name_only.startswith('~') and file_name_only.endswith('.tmp'))
+           (file_name_only.startswith('~') and file_name_only.endswith('.tmp')) or \
+           isPartialFile(file_name_only)
+
+
+def isPartialFile (file_name_only):
+    return file_name_only.endswith(PARTIAL_SUFFIX)
 
 
 def file_exists_local (fullFilePath):
     return os.path.exists(fullFilePath)
-            
\ No newline at end of file
+
+
+def scan_directory (path):
+    """
+    Lists the directory `path`. Returns a list of `(name, size, mtime, inode)`
+    tuples for its files and a list with the names of its subdirectories.
+    Links to directories are left out, links to files are followed.
+    `scandir` gets the file types from the listing itself, without
+    a stat call per entry, it is used when available.
+
+    :param path: Absolute local path of the directory
+    """
+
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime, entry.inode()))
+            except OSError:
+                # Removed while listing, or a broken link.
+                pass
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.lstat(os.path.join(path, name))
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(name)
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(os.path.join(path, name))
+                if stat.S_ISREG(st.st_mode):
+                    files.append((name, st.st_size, st.st_mtime, st.st_ino))
+            except OSError:
+                pass
+
+    return files, dirs
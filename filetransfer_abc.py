@@ -1,114 +1,331 @@
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta, abstractmethod, abstractproperty
 
+import os
+import sys
+import time
+import zlib
 import socket
+import calendar
+import traceback
 
 from datetime import datetime as dt
-from datetime import timedelta as td
-from ftplib import FTP_TLS, FTP, error_reply, error_perm
- 
+from ftplib import FTP_TLS, FTP, error_reply, error_perm, error_temp
+
+from hashing import parse_hash_reply, file_digest
+from compression import Inflater, DeflatingReader, LEVEL
+from listing import parse_timestamp
+from pipeline import send_pipelined, send_serial, supports_pipelining
+from localsettings import LOCAL_LATENCY, LOCAL_BANDWIDTH, PIPELINE_DEPTH
+
+
+# Hosts starting with this are directories of the local filesystem,
+# served by `LocalTransfer`.
+LOCAL_SCHEME = 'file://'
+
+
+def open_transfer(host, useSSL):
+    """
+    Returns a new `filetransfer_abc` for `host`, not logged in yet.
+    'file:///some/dir' hosts are served by `LocalTransfer`.
+
+    :param host: Location of the FTP server or 'file://' URL
+    :param useSSL: Tells whether the FTP needs to support TLS or not
+    """
+
+    if host.startswith(LOCAL_SCHEME):
+        return LocalTransfer(host[len(LOCAL_SCHEME):])
+
+    return ftp_si(host, useSSL)
+
+def parse_features(reply):
+    """
+    Parses the reply to the FEAT command. Returns a dict that maps
+    the extensions to their parameters.
+
+    :param reply: Multiline reply from the server
+    """
+
+    features = dict()
+    # First and last lines are the start and end of the reply.
+    for line in reply.splitlines()[1:-1]:
+        name, sep, params = line.strip().partition(' ')
+        features[name.upper()] = params.strip()
+
+    return features
+
+
 class filetransfer_abc:
+    """
+    Operations `ServerWatcher` runs on one connection to the server.
+    Error replies are raised as the `ftplib` errors, `socket.error`
+    and `EOFError` mean the connection was lost.
+    """
+
     __metaclass__ = ABCMeta
- 
+
+    BLOCKSIZE = 8192
+
     @abstractmethod
-    def do_something(self): pass
+    def login(self, username, passwd):
+        """Logs in into the server and returns its reply."""
 
     @abstractmethod
-    def connect(self): pass
- 
- 
-class ftp_si(filetransfer_abc):
+    def close(self):
+        """Closes the connection."""
+
+    @abstractmethod
+    def setdir(self, path):
+        """Changes the working directory to `path`."""
+
+    @abstractproperty
+    def currentdir(self):
+        """Returns the current working directory at the server"""
+
+    @abstractmethod
+    def listfiles_mlsd(self, path, callback_function):
+        """Lists `path` with MLSD, `callback_function` gets each line."""
+
+    @abstractmethod
+    def listfiles_ftpdetails(self, path, callback_function):
+        """Lists `path` with LIST, `callback_function` gets each line."""
+
+    @abstractmethod
+    def deleteFile(self, filename):
+        """Deletes the file `filename`."""
+
+    @abstractmethod
+    def rename(self, src, dest):
+        """Moves the file or directory `src` to `dest`."""
+
+    @abstractmethod
+    def makeDir(self, path):
+        """Creates the directory `path`, its parent must exist."""
+
+    @abstractmethod
+    def fileSize(self, filename):
+        """Returns the size in bytes of `filename`."""
+
+    @abstractmethod
+    def fileExists(self, filepath):
+        """Tells whether `filepath` is a file on the server."""
+
+    @abstractmethod
+    def lastModified(self, filename):
+        """Returns the last modified date of `filename`, in UTC."""
+
+    @abstractmethod
+    def setLastModified(self, serverpath, newtime):
+        """Sets `newtime` as the last modified date of `serverpath`."""
+
+    @abstractmethod
+    def downloadFile(self, filename, callback_function, rest=0, length=None, compressed=False):
+        """
+        Downloads `filename` from the offset `rest`, `callback_function`
+        gets the blocks of data. Only `length` bytes are read when
+        it's not `None`. Data is deflated on the wire if `compressed`,
+        with MODE Z, which can't be combined with `rest` or `length`.
+        """
+
+    @abstractmethod
+    def uploadFile(self, filename, f, callback_function=None, rest=0, compressed=False):
+        """
+        Sends the contents of the file object `f` to `filename`, written
+        from the offset `rest`. `callback_function` gets the blocks sent.
+        Data is deflated on the wire if `compressed`, with MODE Z,
+        which can't be combined with `rest`.
+        """
+
+    @abstractmethod
+    def appendFile(self, filename, f, callback_function=None):
+        """Appends the contents of the file object `f` to `filename`."""
+
+    @abstractmethod
+    def features(self):
+        """Returns a dict that maps the extensions of the server to their parameters."""
+
+    @abstractmethod
+    def fileHash(self, filename, command, algorithm):
+        """
+        Returns the digest of `filename` computed by the server with
+        `command`, one of HASH, XSHA1, XMD5 or XCRC, `None` if the
+        reply has none.
+        """
+
+    def connect(self, username, passwd):
+        """
+        Logs in, returns an error message for the user,
+        empty if the login succeeded.
+
+        :param username: Username to log in into the FTP server
+        :param passwd: Password to log in into the FTP server
+        """
+
+        try:
+            loginResponse = self.login(username, passwd)
+        except socket.gaierror:
+            return 'Server address could not be found.'
+        except (error_perm, error_reply):
+            info = traceback.format_exception(*sys.exc_info())
+            for i in info: sys.stderr.write(i)
+            return 'Login failed.'
+
+        if '230' not in loginResponse:
+            return 'Login failed.'
+
+        return ''
+
+    def mkpath(self, path):
+        """
+        Creates the path `path` on the server by recursively
+        created folders, if needed.
+
+        :param path: Absolute path on the server to be created
+        """
+
+        make_dir = ''
+        for step in path.split('/'):
+            if len(step) == 0:
+                continue
+            make_dir += '/%s' % step
+            try:
+                self.makeDir(make_dir)
+            except error_perm:
+                # Probably already exists
+                continue
+
+    def fileSizes(self, filenames, pipelined=False):
+        """
+        Batched `fileSize`. Returns a dict that maps the filenames
+        to their sizes, the ones SIZE failed for are left out.
+
+        :param filenames: Relative or absolute paths to the files
+        :param pipelined: Whether the server handles pipelined commands
+        """
+
+        sizes = dict()
+        for filename in filenames:
+            try:
+                sizes[filename] = self.fileSize(filename)
+            except (error_reply, error_perm, error_temp, ValueError):
+                pass
+
+        return sizes
+
+    def lastModifiedAll(self, filenames, pipelined=False):
+        """
+        Batched `lastModified`. Returns a dict that maps the filenames
+        to their last modified dates, the ones MDTM failed for are left out.
+
+        :param filenames: Relative or absolute paths to the files
+        :param pipelined: Whether the server handles pipelined commands
+        """
+
+        mdates = dict()
+        for filename in filenames:
+            try:
+                mdates[filename] = self.lastModified(filename)
+            except (error_reply, error_perm, error_temp):
+                pass
+
+        return mdates
+
+    def supportsPipelining(self):
+        """
+        Tells whether commands can be sent before the reply to the
+        previous one, the connection is not used after this test.
+        """
+
+        return False
 
-    username = ''
-    passwd = ''
-    ftp = None
-    
-    
-    def do_mystuff(self):
-        print "Do my stuff!"
-    def do_something(self):
-        print "Do something!"
+
+class ftp_si(filetransfer_abc):
+    """`filetransfer_abc` over an `FTP` or `FTP_TLS` connection."""
 
     def __init__(self, host, useSSL):
-        
+        """
+        :param host: Location of the FTP server
+        :param useSSL: Tells whether the FTP needs to support TLS or not
+        """
+
         self.ftp = None
         self.useSSL = useSSL
         self.host = host
-        useSSL = False
+        # Transfer mode of the connection, S or Z.
+        self.mode = 'S'
+        # Whether the server accepted MODE Z, `None` until it's tried.
+        self.modeZ = None
+
+    def login(self, username, passwd):
+        if self.ftp is None:
+            self.ftp = FTP_TLS(self.host) if self.useSSL is True else FTP(self.host)
+            self.mode = 'S'
 
-    def connect(self, the_user, the_passwd):
+        return self.ftp.login(username, passwd)
 
-        self.username = the_user
-        self.passwd = the_passwd
-        
-        ok=True
-        msg = ''
+    def useMode(self, compressed=False):
+        """
+        Switches to MODE Z for compressed transfers and back to MODE S for
+        the rest, the mode only changes when needed. Returns whether the
+        next transfer is compressed, it's not if the server refused MODE Z.
 
-        if self.useSSL is True:
-            self.ftp = FTP_TLS(self.host)
-        else:    
-            self.ftp=FTP(self.host)
-        
+        :param compressed: Whether the next transfer should be compressed
+        """
 
-        try:        
-            loginResponse = self.ftp.login(self.username, self.passwd)
-            msg = 'Login ok'
-        except socket.gaierror:
+        mode = 'Z' if compressed and self.modeZ is not False else 'S'
+        if mode != self.mode:
+            try:
+                self.ftp.voidcmd('MODE %s' % mode)
+            except error_perm:
+                if mode == 'S':
+                    raise
+                print 'Server refused MODE Z, transfers won\'t be compressed'
+                self.modeZ = False
+                return False
+            self.mode = mode
+            if mode == 'Z':
+                self.modeZ = True
+
+        return mode == 'Z'
+
+    def close(self):
+        # No QUIT, the connection can be in the middle of a reply.
+        if self.ftp is not None:
+            self.ftp.close()
             self.ftp = None
-            ok = False
-            msg = 'Server address could not be found.' 
-        except (error_perm, error_reply):
-            info = traceback.format_exception(*sys.exc_info())
-            for i in info: sys.stderr.write(i)
-            ok = False
-            msg = error_msg         
-        else:
-            if '230' in loginResponse:
-                ok = True
-            else:
-                ok = False
-                msg = error_msg
-        
-        return msg
-                
+
     def setdir(self, path):
         self.ftp.cwd(path)
 
     @property
     def currentdir(self):
-        """Returns the current working directory at the server"""
-        
-        return self.ftp.pwd()         
-    
+        return self.ftp.pwd()
+
     def listfiles_basic(self, path):
+        self.useMode()
         return self.ftp.nlst(path)
 
+    def listfiles_mlsd(self, path, callback_function):
+        self.useMode()
+        self.ftp.retrlines('MLSD %s' % path, callback_function)
+
     def listfiles_ftpdetails(self, path, callback_function):
-        
-        try:
-            self.ftp.retrlines('LIST %s' % path, callback_function)
-            
-            return
-        except:
-            print 'Exception in ServerWatcher.getDirs'
-            info = traceback.format_exception(*sys.exc_info())
-            for i in info: sys.stderr.write(i)
-            return []    
+        self.useMode()
+        self.ftp.retrlines('LIST %s' % path, callback_function)
 
     def deleteFile(self, filename):
-        """
-        Deletes the file `filename` to the server
-        
-        :param filename: Absolute or relative path to the file
-        """
-        
-        try:
-            # print 'Deleting %s' % filename
-            self.ftp.delete(filename)
-            return True
-        except (error_reply, error_perm):
-            # print 'Error deleting %s' % filename
-            return False
+        self.ftp.delete(filename)
 
+    def rename(self, src, dest):
+        self.ftp.rename(src, dest)
+
+    def makeDir(self, path):
+        self.ftp.mkd(path)
+
+    def fileSize(self, filename):
+        # Some servers refuse SIZE in ASCII mode.
+        self.ftp.voidcmd('TYPE I')
+
+        return int(self.ftp.sendcmd('SIZE %s' % filename).split(' ')[-1])
 
     def fileExists(self, filepath):
         try:
@@ -118,77 +335,115 @@ class ftp_si(filetransfer_abc):
         else:
             exists = True
 
+        return exists
+
+    def replies(self, command, filenames, pipelined=False):
+        """
+        Sends `command` for each of `filenames`, pipelined if `pipelined`.
+        Returns a dict that maps the filenames to the replies,
+        the ones the command failed for are left out.
+
+        :param command: Command taking a path as its only argument, like MDTM
+        :param filenames: Relative or absolute paths to the files
+        :param pipelined: Whether the server handles pipelined commands
+        """
+
+        send = send_pipelined if pipelined else send_serial
+        replies = send(self.ftp, ['%s %s' % (command, filename) for filename in filenames])
+
+        return dict((filename, reply) for filename, reply in zip(filenames, replies)
+                    if not isinstance(reply, Exception))
+
+    def fileSizes(self, filenames, pipelined=False):
+        self.ftp.voidcmd('TYPE I')
+        sizes = dict()
+        for filename, reply in self.replies('SIZE', filenames, pipelined).iteritems():
+            try:
+                sizes[filename] = int(reply.split(' ')[-1])
+            except ValueError:
+                pass
+
+        return sizes
+
+    def lastModifiedAll(self, filenames, pipelined=False):
+        mdates = dict()
+        for filename, reply in self.replies('MDTM', filenames, pipelined).iteritems():
+            mdate = parse_timestamp(reply.split(' ')[-1]) if reply.startswith('213 ') else None
+            if mdate is not None:
+                mdates[filename] = mdate
+
+        return mdates
+
+    def supportsPipelining(self):
+        return supports_pipelining(self.ftp)
+
+    def downloadFile(self, filename, callback_function, rest=0, length=None, compressed=False):
+        if self.useMode(compressed):
+            inflater = Inflater(callback_function)
+            self.ftp.retrbinary('RETR %s' % filename, inflater, filetransfer_abc.BLOCKSIZE)
+            inflater.flush()
+            return
+
+        if length is None:
+            self.ftp.retrbinary('RETR %s' % filename, callback_function,
+                                filetransfer_abc.BLOCKSIZE, rest or None)
+            return
+
+        self.ftp.voidcmd('TYPE I')
+        conn = self.ftp.transfercmd('RETR %s' % filename, rest=rest)
+        remaining = length
+        try:
+            while remaining > 0:
+                chunk = conn.recv(min(filetransfer_abc.BLOCKSIZE, remaining))
+                if not chunk:
+                    break
+                callback_function(chunk)
+                remaining -= len(chunk)
+        finally:
+            conn.close()
 
-    
-    def fileSize (self, filename):
-
-        try:        
-            download_size = int(self.ftp.sendcmd('SIZE %s' % filename).split(' ')[-1])
-
-        except (IOError, OSError):
-            download_size = -1
-            # self.ioError.emit(localpath)
-        except (error_reply, error_perm) as ftperr:
-            # print 'Error downloading %s, %s' % (filename, ftperr)
-            download_size = -1
-        
-        return download_size
-    
-    
-    def downloadFile(filename, callback_function):
-        downloaded = True
-        
         try:
-            self.ftp.retrbinary('RETR %s' % filename, handleChunk)
-        except (IOError, OSError):
-            downloaded = False
-            # self.ioError.emit(localpath)
-        except (error_reply, error_perm) as ftperr:
-            # print 'Error downloading %s, %s' % (filename, ftperr)
-            downloaded = False    
-        
-        return downloaded
-
-
-    def uploadFile (self, filename, callback_function):
-        
+            # The server complains when the transfer is closed before
+            # the end of the file, that is expected here.
+            self.ftp.voidresp()
+        except (error_reply, error_perm, error_temp):
+            pass
+
+    def uploadFile(self, filename, f, callback_function=None, rest=0, compressed=False):
+        if self.useMode(compressed):
+            self.ftp.storbinary('STOR %s' % filename, DeflatingReader(f, callback_function),
+                                filetransfer_abc.BLOCKSIZE)
+            return
+
+        self.ftp.storbinary('STOR %s' % filename, f, filetransfer_abc.BLOCKSIZE,
+                            callback_function, rest or None)
+
+    def appendFile(self, filename, f, callback_function=None):
+        self.useMode()
+        self.ftp.storbinary('APPE %s' % filename, f, filetransfer_abc.BLOCKSIZE,
+                            callback_function)
+
+    def features(self):
         try:
-            # Uploads file and updates its modified date in the server
-            # to match the date in the local filesystem.
-            self.upload_progress = 0
-            self.upload_size = os.path.getsize(localpath)
-            # self.fileEvent.emit(localpath)
-            self.ftp.storbinary('STOR %s' % filename,
-                                open(localpath, 'rb'), 
-                                1024,
-                                handle)
-            # print 'Upload finished'
-            with File.fromPath(filename) as uploaded:
-                modified = uploaded.localmdate
-                uploaded.servermdate = modified
-                
-                self.setLastModified(filename, modified)
-            
-            uploaded = True
-
-        except (IOError, OSError):
-            uploaded = False
-            self.ioError.emit(localpath)
-        except (error_reply, error_perm, OSError) as err:
-            print 'Error uploading %s, %s' % (filename, err)
-            uploaded = False
-                    
-        
+            return parse_features(self.ftp.sendcmd('FEAT'))
+        except (error_reply, error_perm):
+            return dict()
+
+    def fileHash(self, filename, command, algorithm):
+        self.ftp.voidcmd('TYPE I')
+
+        return parse_hash_reply(self.ftp.sendcmd('%s %s' % (command, filename)), algorithm)
+
     def lastModified(self, filename):
         """
         Uses the MDTM FTP command to find the last modified timestamp
         of the file `filename`.
         Returns a `datetime.datetime` object in UTC representing the file's
         last modified date and time.
-        
+
         :param filename: Relative or absolute path to the file
         """
-        
+
         timestamp = self.ftp.sendcmd('MDTM %s' % filename)
         if '213 ' not in timestamp:
             # Second chance was found to be needed in some cases.
@@ -196,7 +451,7 @@ class ftp_si(filetransfer_abc):
 
         timestamp = timestamp.split(' ')[-1]
         dateformat = '%Y%m%d%H%M%S.%f' if '.' in timestamp else '%Y%m%d%H%M%S'
-        
+
         try:
             mtime = dt.strptime(timestamp, dateformat)
         except ValueError:
@@ -207,7 +462,7 @@ class ftp_si(filetransfer_abc):
     def setLastModified(self, serverpath, newtime):
         """
         Uses the MFMT or MDTM FTP commands to set `newtime` as the modified timestamp of the
-        file `serverpath` on the server. 
+        file `serverpath` on the server.
 
         :param serverpath: Relative or absolute path to the file
         :param newtime: datedatime object holding the required time
@@ -225,39 +480,313 @@ class ftp_si(filetransfer_abc):
                     raise e
                 else:
                     continue
-        
-    def mkpath(self, path):
+
+
+class LocalTransfer(filetransfer_abc):
+    """
+    `filetransfer_abc` over a local directory, which plays the part of
+    the server. Every command waits `latency` seconds and data moves at
+    `bandwidth` bytes per second, to measure scans and transfers
+    without an FTP server. Compressed transfers are deflated and inflated
+    for real, the bandwidth applies to the deflated data. Errors are
+    raised as `error_perm`, the way a server would refuse the command.
+    """
+
+    def __init__(self, root, latency=LOCAL_LATENCY, bandwidth=LOCAL_BANDWIDTH):
         """
-        Creates the path `path` on the server by recursively 
-        created folders, if needed.
-        
-        :param path: Absolute path on the server to be created
+        :param root: Absolute local path of the directory served as '/'
+        :param latency: Seconds each command takes
+        :param bandwidth: Bytes per second of the transfers, 0 for no limit
         """
-        
+
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.cwd = '/'
+        # Transfer mode, switching it takes a round trip.
+        self.mode = 'S'
+
+    def useMode(self, compressed=False):
+        """Switches between MODE S and MODE Z like `ftp_si.useMode`."""
+
+        mode = 'Z' if compressed else 'S'
+        if mode != self.mode:
+            self.delay()
+            self.mode = mode
+
+        return compressed
+
+    def delay(self, commands=1, size=0):
+        """Waits as long as `commands` round trips and `size` bytes of data take."""
+
+        seconds = commands * self.latency
+        if self.bandwidth > 0:
+            seconds += size / float(self.bandwidth)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def localpath(self, path):
+        """Maps the server path `path` into `self.root`."""
+
+        # Absolute, so '..' can't go above the root, like on a server.
+        path = os.path.normpath(os.path.join(self.cwd, path)).replace(os.sep, '/')
+
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def refused(self, err):
+        """Returns the `error_perm` for the failed filesystem call `err`."""
+
+        return error_perm('550 %s' % (err.strerror or err))
+
+    def stat(self, path, isdir=None):
+        """Returns `os.stat` of `path`, which must be a directory if `isdir` or a file if not `isdir`."""
+
         try:
-            self.ftp.cwd(path)
+            st = os.stat(self.localpath(path))
+        except OSError as err:
+            raise self.refused(err)
+        if isdir is not None and os.path.isdir(self.localpath(path)) != isdir:
+            raise error_perm('550 %s: Not a %s.' % (path, 'directory' if isdir else 'regular file'))
+
+        return st
+
+    def login(self, username, passwd):
+        self.delay(2)
+        if not os.path.isdir(self.root):
+            raise error_perm('530 %s is not a directory.' % self.root)
+        self.cwd = '/'
+
+        return '230 Login successful.'
+
+    def close(self):
+        pass
+
+    def setdir(self, path):
+        self.delay()
+        self.stat(path, isdir=True)
+        self.cwd = os.path.normpath(os.path.join(self.cwd, path)).replace(os.sep, '/')
+
+    @property
+    def currentdir(self):
+        self.delay()
+
+        return self.cwd
+
+    def listing(self, path):
+        """Returns `(name, os.stat)` tuples for the entries of the directory `path`."""
+
+        self.stat(path, isdir=True)
+        localdir = self.localpath(path)
+        entries = []
+        for name in sorted(os.listdir(localdir)):
+            try:
+                entries.append((name, os.stat(os.path.join(localdir, name))))
+            except OSError:
+                # Removed while listing.
+                continue
+
+        return entries
+
+    def listfiles_mlsd(self, path, callback_function):
+        self.useMode()
+        self.delay(2)
+        lines = []
+        for name, st in self.listing(path):
+            modify = time.strftime('%Y%m%d%H%M%S', time.gmtime(st.st_mtime))
+            if os.path.isdir(os.path.join(self.localpath(path), name)):
+                lines.append('type=dir;modify=%s; %s' % (modify, name))
+            else:
+                lines.append('type=file;size=%d;modify=%s; %s' % (st.st_size, modify, name))
+        self.delay(0, sum(len(line) + 2 for line in lines))
+        for line in lines:
+            callback_function(line)
+
+    def listfiles_ftpdetails(self, path, callback_function):
+        self.useMode()
+        self.delay(2)
+        lines = []
+        for name, st in self.listing(path):
+            kind = 'd' if os.path.isdir(os.path.join(self.localpath(path), name)) else '-'
+            lines.append('%srw-r--r--   1 owner    group    %10d %s %s' % (
+                    kind, st.st_size, time.strftime('%b %d %H:%M', time.gmtime(st.st_mtime)), name))
+        self.delay(0, sum(len(line) + 2 for line in lines))
+        for line in lines:
+            callback_function(line)
+
+    def deleteFile(self, filename):
+        self.delay()
+        self.stat(filename, isdir=False)
+        try:
+            os.remove(self.localpath(filename))
+        except OSError as err:
+            raise self.refused(err)
+
+    def rename(self, src, dest):
+        self.delay(2)
+        try:
+            os.rename(self.localpath(src), self.localpath(dest))
+        except OSError as err:
+            raise self.refused(err)
+
+    def makeDir(self, path):
+        self.delay()
+        try:
+            os.mkdir(self.localpath(path))
+        except OSError as err:
+            raise self.refused(err)
+
+    def fileSize(self, filename):
+        self.delay()
+
+        return self.stat(filename, isdir=False).st_size
+
+    def fileExists(self, filepath):
+        try:
+            self.fileSize(filepath)
         except error_perm:
-            # `cwd` call failed. Need to create some folders
-            make_dir = '/' 
-            steps = path.split('/')
-            for step in steps:
-                if len(step) == 0:
-                    continue
-                make_dir += '%s/' % step
-                try:
-                    self.ftp.mkd(make_dir)
-                except error_perm:
-                    # Probably already exists
-                    continue
+            return False
+
+        return True
+
+    def lastModified(self, filename):
+        self.delay()
+        st = self.stat(filename, isdir=False)
+
+        # Whole seconds, like MDTM replies.
+        return dt.utcfromtimestamp(int(st.st_mtime))
+
+    def setLastModified(self, serverpath, newtime):
+        self.delay()
+        st = self.stat(serverpath, isdir=False)
+        try:
+            os.utime(self.localpath(serverpath),
+                     (st.st_atime, calendar.timegm(newtime.utctimetuple())))
+        except OSError as err:
+            raise self.refused(err)
+
+    def downloadFile(self, filename, callback_function, rest=0, length=None, compressed=False):
+        compressed = self.useMode(compressed)
+        self.delay(3 if rest else 2)
+        self.stat(filename, isdir=False)
+        try:
+            f = open(self.localpath(filename), 'rb')
+        except IOError as err:
+            raise self.refused(err)
+
+        if compressed:
+            deflater = zlib.compressobj(LEVEL)
+            callback_function = Inflater(callback_function)
+
+        with f:
+            f.seek(rest)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = filetransfer_abc.BLOCKSIZE
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                if compressed:
+                    chunk = deflater.compress(chunk)
+                self.delay(0, len(chunk))
+                callback_function(chunk)
+
+        if compressed:
+            chunk = deflater.flush()
+            self.delay(0, len(chunk))
+            callback_function(chunk)
+            callback_function.flush()
+
+    def store(self, filename, f, callback_function, mode, rest=0, compressed=False):
+        """
+        Writes the contents of the file object `f` into `filename`, opened
+        with `mode`. The contents are deflated if `compressed`.
+        """
+
+        try:
+            target = open(self.localpath(filename), mode)
+        except IOError as err:
+            raise self.refused(err)
+
+        with target:
+            if rest:
+                # Written over from `rest`, not truncated, like servers do.
+                target.seek(rest)
+            write = Inflater(target.write) if compressed else target.write
+            while True:
+                chunk = f.read(filetransfer_abc.BLOCKSIZE)
+                if not chunk:
+                    break
+                self.delay(0, len(chunk))
+                write(chunk)
+                if callback_function is not None:
+                    callback_function(chunk)
+            if compressed:
+                write.flush()
+
+    def uploadFile(self, filename, f, callback_function=None, rest=0, compressed=False):
+        compressed = self.useMode(compressed)
+        self.delay(3 if rest else 2)
+        exists = os.path.isfile(self.localpath(filename))
+        mode = 'r+b' if rest and exists else 'wb'
+        if compressed:
+            # The progress is counted on the data read from `f`.
+            self.store(filename, DeflatingReader(f, callback_function), None, mode, 0, True)
         else:
-            # `cwd` call succeed. No need to create
-            # any folders
-            self.ftp.cwd('/')
-            return
+            self.store(filename, f, callback_function, mode, rest)
+
+    def appendFile(self, filename, f, callback_function=None):
+        self.useMode()
+        self.delay(2)
+        self.store(filename, f, callback_function, 'ab')
+
+    def features(self):
+        self.delay()
+
+        return {'MLST': 'type*;size*;modify*;', 'SIZE': '', 'MDTM': '', 'REST': 'STREAM',
+                'HASH': 'SHA-256;SHA-1*;MD5;CRC32', 'MODE': 'Z'}
+
+    def fileHash(self, filename, command, algorithm):
+        self.delay()
+        self.stat(filename, isdir=False)
+        try:
+            return file_digest(self.localpath(filename), algorithm)
+        except IOError as err:
+            raise self.refused(err)
+
+    def supportsPipelining(self):
+        return True
+
+    def pipelined(self, method, filenames):
+        """
+        Runs the batched `method` of `filetransfer_abc` with one round trip
+        per `PIPELINE_DEPTH` files, as pipelined commands take.
+        """
+
+        self.delay(len(range(0, len(filenames), PIPELINE_DEPTH)))
+        latency, self.latency = self.latency, 0
+        try:
+            return method(self, filenames)
+        finally:
+            self.latency = latency
+
+    def fileSizes(self, filenames, pipelined=False):
+        if pipelined:
+            return self.pipelined(filetransfer_abc.fileSizes, filenames)
+
+        return super(LocalTransfer, self).fileSizes(filenames)
+
+    def lastModifiedAll(self, filenames, pipelined=False):
+        if pipelined:
+            return self.pipelined(filetransfer_abc.lastModifiedAll, filenames)
+
+        return super(LocalTransfer, self).lastModifiedAll(filenames)
+
 
-    
 if __name__ == '__main__':
-    
+
     print "hello"
     c = ftp_si('ftp.iqstorage.com', True)
     c.connect('testuser', 'test')
@@ -265,11 +794,5 @@ if __name__ == '__main__':
     a = list
     a = c.listfiles_basic('/')
     print a
-    
-    #for s in a:
-    #    print s
-        
+
     print "Done"
-    #c.do_something()
-    #c.do_mystuff()
-    
\ No newline at end of file
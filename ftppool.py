@@ -0,0 +1,179 @@
+import sys
+import socket
+import threading
+import traceback
+import Queue
+
+from collections import deque
+from ftplib import error_temp
+
+from filetransfer_abc import open_transfer
+
+
+class FTPPool(object):
+    """
+    Set of logged in connections, `filetransfer_abc` objects made by
+    `open_transfer`, each one owned by a worker thread.
+    Work is handed to the workers in batches, see `FTPPool.batch`.
+    Connections are opened lazily by their workers, and re-opened
+    when they are dropped by the server.
+    """
+
+    # Times a task is retried after its connection was lost.
+    RETRIES = 3
+
+    def __init__(self, host, ssl, size):
+        """
+        :param host: Location of the FTP server
+        :param ssl: Tells whether the FTP needs to support TLS or not
+        :param size: Number of connections in the pool
+        """
+
+        super(FTPPool, self).__init__()
+
+        self.host = host
+        self.useSSL = ssl
+        self.size = size
+        self.username = ''
+        self.passwd = ''
+        self.tasks = Queue.Queue()
+        self.workers = []
+
+    def login(self, username, passwd):
+        """
+        Stores the credentials used by the connections and starts
+        the worker threads.
+
+        :param username: Username to log in into the FTP server
+        :param passwd: Password to log in into the FTP server
+        """
+
+        self.username = username
+        self.passwd = passwd
+
+        while len(self.workers) < self.size:
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def connect(self):
+        """Returns a new logged in connection to the server."""
+
+        ftp = open_transfer(self.host, self.useSSL)
+        ftp.login(self.username, self.passwd)
+
+        return ftp
+
+    def close(self):
+        """Stops the worker threads once they are done with the queued tasks."""
+
+        for worker in self.workers:
+            self.tasks.put(None)
+        self.workers = []
+
+    def batch(self, func):
+        """
+        Returns a `Batch` object that runs `func` in the pool workers.
+
+        :param func: Callable that accepts an `ftp` keyword argument
+        """
+
+        return Batch(self, func)
+
+    def work(self):
+        """Worker thread loop, runs tasks from `self.tasks` until `close` is called."""
+
+        ftp = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            func, args, results = task
+            result = None
+            for attempt in range(FTPPool.RETRIES + 1):
+                try:
+                    if ftp is None:
+                        ftp = self.connect()
+                    result = func(*args, ftp=ftp)
+                    break
+                except (socket.error, EOFError, error_temp):
+                    # Connection was lost or the server is busy,
+                    # reconnect and try again.
+                    print 'Pool connection lost running %s%s' % (func.__name__, args)
+                    try:
+                        ftp.close()
+                    except:
+                        pass
+                    ftp = None
+                except:
+                    info = traceback.format_exception(*sys.exc_info())
+                    for i in info: sys.stderr.write(i)
+                    break
+
+            results.put((args, result))
+
+        if ftp is not None:
+            try:
+                ftp.close()
+            except:
+                pass
+
+
+class Batch(object):
+    """
+    Group of calls to the same function whose results are collected
+    by iterating over the batch. More calls can be added while iterating,
+    iteration ends when every call added so far has returned.
+    """
+
+    def __init__(self, pool, func):
+        super(Batch, self).__init__()
+
+        self.pool = pool
+        self.func = func
+        self.pending = 0
+        self.results = Queue.Queue()
+
+    def put(self, *args):
+        """Schedules a call to the batch function with the arguments `args`."""
+
+        self.pending += 1
+        self.pool.tasks.put((self.func, args, self.results))
+
+    def __iter__(self):
+        """Yields `(args, result)` tuples, in completion order."""
+
+        while self.pending > 0:
+            args, result = self.results.get()
+            self.pending -= 1
+            yield args, result
+
+
+class SerialBatch(object):
+    """
+    Runs a batch on a single connection, in the calling thread.
+    Same interface as `Batch`, used when there is no pool available.
+    """
+
+    def __init__(self, func, ftp):
+        super(SerialBatch, self).__init__()
+
+        self.func = func
+        self.ftp = ftp
+        self.calls = deque()
+
+    def put(self, *args):
+        self.calls.append(args)
+
+    def __iter__(self):
+        while len(self.calls) > 0:
+            args = self.calls.popleft()
+            result = None
+            try:
+                result = self.func(*args, ftp=self.ftp)
+            except:
+                info = traceback.format_exception(*sys.exc_info())
+                for i in info: sys.stderr.write(i)
+            yield args, result
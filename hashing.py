@@ -0,0 +1,99 @@
+import os
+import re
+import zlib
+import hashlib
+
+
+# Algorithm names as used by the FTP HASH command, mapped to
+# the `hashlib` constructors. CRC32 is computed with `zlib`.
+ALGORITHMS = {
+    'MD5': hashlib.md5,
+    'SHA-1': hashlib.sha1,
+    'SHA-256': hashlib.sha256,
+    'SHA-512': hashlib.sha512,
+    'CRC32': None}
+
+# Length of the hexadecimal digests, CRC32 digests are
+# sent by some servers without the leading zeros.
+DIGEST_LENGTHS = {
+    'MD5': 32,
+    'SHA-1': 40,
+    'SHA-256': 64,
+    'SHA-512': 128,
+    'CRC32': 8}
+
+BLOCKSIZE = 64 * 1024
+
+
+def file_digest(localpath, algorithm):
+    """
+    Reads the file `localpath` and returns its lowercase hexadecimal
+    digest computed with `algorithm`, one of the `ALGORITHMS` keys.
+
+    :param localpath: Absolute local path of the file
+    :param algorithm: Name of the algorithm as used by the HASH command
+    """
+
+    constructor = ALGORITHMS[algorithm]
+    digest = constructor() if constructor is not None else 0
+    with open(localpath, 'rb') as f:
+        while True:
+            block = f.read(BLOCKSIZE)
+            if not block:
+                break
+            if constructor is None:
+                digest = zlib.crc32(block, digest)
+            else:
+                digest.update(block)
+
+    if constructor is None:
+        return '%08x' % (digest & 0xffffffff)
+
+    return digest.hexdigest()
+
+def identity(localpath):
+    """
+    Returns the `(inode, size, mtime)` tuple that identifies the contents
+    of `localpath`, `None` if the file is gone.
+
+    :param localpath: Absolute local path of the file
+    """
+
+    try:
+        st = os.stat(localpath)
+    except OSError:
+        return None
+
+    return st.st_ino, st.st_size, st.st_mtime
+
+def hash_file(task):
+    """
+    Pool task computing the digest of a `(localpath, algorithm)` tuple.
+    Returns a `(localpath, digest)` tuple, `digest` is `None` when the
+    file can't be read.
+    """
+
+    localpath, algorithm = task
+    try:
+        return localpath, file_digest(localpath, algorithm)
+    except (IOError, OSError):
+        return localpath, None
+
+def parse_hash_reply(reply, algorithm):
+    """
+    Finds the digest in the reply to the HASH, XMD5, XSHA1 or XCRC commands,
+    servers don't agree on where to put it. Returns the lowercase digest
+    or `None` if there is none.
+
+    :param reply: Reply from the server
+    :param algorithm: Name of the algorithm the digest was computed with
+    """
+
+    length = DIGEST_LENGTHS[algorithm]
+    # The first word is the reply code.
+    for word in reply.split()[1:]:
+        if re.match(r'^[0-9a-fA-F]+$', word) and len(word) <= length \
+           and (algorithm == 'CRC32' or len(word) == length):
+            return word.lower().zfill(length)
+
+    return None
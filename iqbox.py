@@ -1,6 +1,7 @@
 import sys
 import os
 from datetime import datetime as dt
+from multiprocessing import freeze_support
 
 from PySide.QtGui import QApplication, QFont
 
@@ -12,6 +13,9 @@ from views import View
 
 
 if __name__ == '__main__':
+    # Digests are computed in child processes, frozen
+    # Windows builds need this to start them.
+    freeze_support()
 
     if WEARECODING:
         try:
@@ -0,0 +1,129 @@
+import re
+import hashlib
+
+from collections import namedtuple
+from datetime import datetime as dt
+
+
+# One entry of a remote directory listing. `size` and `mdate` are `None`
+# when the listing format doesn't provide them reliably.
+ListItem = namedtuple('ListItem', ['name', 'isdir', 'size', 'mdate'])
+
+# Unix style LIST line, lines look like:
+# 'drwxrwxrwx   1 user     group           0 Jun 15  2012 dirname'
+UNIX_LINE = re.compile(
+        r'^([\-dlbcps])\S{9}\S*\s+\d+\s+(?:\S+\s+){1,2}(\d+)\s+'
+        r'\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4})\s(.+)$')
+
+# DOS style LIST line (IIS), lines look like:
+# '06-15-12  10:30AM       <DIR>          dirname'
+DOS_LINE = re.compile(
+        r'^\d{2}-\d{2}-\d{2,4}\s+\d{1,2}:\d{2}(?:AM|PM)?\s+(<DIR>|\d+)\s+(.+)$',
+        re.IGNORECASE)
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses a `YYYYMMDDHHMMSS[.sss]` timestamp as used by MDTM and MLSD.
+    Returns a `datetime.datetime` object in UTC or `None` if
+    the timestamp can't be parsed.
+
+    :param timestamp: Timestamp string sent by the server
+    """
+
+    dateformat = '%Y%m%d%H%M%S.%f' if '.' in timestamp else '%Y%m%d%H%M%S'
+    try:
+        return dt.strptime(timestamp, dateformat)
+    except ValueError:
+        return None
+
+def parse_mlsd_line(line):
+    """
+    Parses a line sent by the MLSD command, lines look like:
+    'type=file;size=1024;modify=20120615103000; filename'
+    Returns a `ListItem` or `None` for the '.' and '..' entries
+    and lines that can't be parsed.
+
+    :param line: Line from the MLSD command
+    """
+
+    facts, sep, name = line.partition(' ')
+    if not sep or not name:
+        return None
+
+    parsed = dict()
+    for fact in facts.split(';'):
+        key, sep, value = fact.partition('=')
+        if sep:
+            parsed[key.lower()] = value
+
+    kind = parsed.get('type', 'file').lower()
+    if kind in ('cdir', 'pdir') or name in ('.', '..'):
+        return None
+
+    size = parsed.get('size', parsed.get('sizd'))
+    try:
+        size = int(size) if size is not None else None
+    except ValueError:
+        size = None
+
+    mdate = parsed.get('modify')
+    if mdate is not None:
+        mdate = parse_timestamp(mdate)
+
+    # Anything that is not a directory (links, devices) is handled as
+    # a file, the same way the NLST based listing used to.
+    return ListItem(name, kind == 'dir', size, mdate)
+
+def parse_list_line(line):
+    """
+    Parses a line sent by the LIST command, both Unix and DOS
+    formats are understood.
+    LIST dates are too coarse to be compared with MDTM dates,
+    so the returned `ListItem` has no `mdate`.
+    Returns `None` for the '.' and '..' entries and lines that
+    can't be parsed (like the 'total' line).
+
+    :param line: Line from the LIST command
+    """
+
+    match = UNIX_LINE.match(line)
+    if match is not None:
+        kind, size, name = match.groups()
+        if kind == 'l':
+            # Links look like 'name -> target'
+            name = name.split(' -> ')[0]
+        isdir = kind == 'd'
+        size = int(size)
+    else:
+        match = DOS_LINE.match(line)
+        if match is None:
+            return None
+        size, name = match.groups()
+        isdir = size.upper() == '<DIR>'
+        size = None if isdir else int(size)
+
+    if name in ('.', '..'):
+        return None
+
+    return ListItem(name, isdir, size, None)
+
+def fingerprint(items):
+    """
+    Returns a digest of the names, types, sizes and last modified dates
+    of the `ListItem` objects in `items`. Two listings of the same
+    directory get the same fingerprint only if nothing in it changed.
+    Returns `None` if a file in the listing has no last modified date,
+    changes can't be told from the listing alone then.
+
+    :param items: Listing of a directory
+    """
+
+    digest = hashlib.sha1()
+    for item in sorted(items):
+        if item.mdate is None and not item.isdir:
+            return None
+        digest.update(repr(tuple(item)))
+        digest.update('\n')
+
+    return digest.hexdigest()
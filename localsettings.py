@@ -5,6 +5,42 @@ DEBUG = False
 # Flag for anything related to development, ex: deleting log at start, QT debug workarounds:
 WEARECODING = True
 
+# Number of extra FTP connections used to scan and transfer in parallel.
+FTP_POOL_SIZE = 4
+
+# Files of at least this many bytes are downloaded in FTP_POOL_SIZE
+# byte ranges at the same time, one per pool connection.
+SEGMENTED_DOWNLOAD_SIZE = 64 * 1024 * 1024
+
+# Threads listing the local folder, one top level subdirectory each.
+# Helps a lot when the folder lives on a network mount.
+LOCAL_SCAN_WORKERS = 4
+
+# Compare file digests before transferring a file whose modified time
+# changed on either side, when the server supports HASH, XSHA1, XMD5 or XCRC.
+HASH_VERIFICATION = True
+
+# Processes computing digests of local files in the background.
+HASH_WORKERS = 2
+
+# MDTM and SIZE commands written at once on the control connection,
+# before reading their replies, when the server handles it.
+PIPELINE_DEPTH = 50
+
+# Send files that compress well deflated, with MODE Z, when the server
+# supports it. Compressed transfers can't be resumed or segmented.
+TRANSFER_COMPRESSION = True
+
+# Connections multiplexed on one event loop for listings and transfers,
+# instead of the FTP_POOL_SIZE threads. Plain FTP only, 0 disables it.
+ASYNC_CONNECTIONS = 0
+
+# Hosts like 'file:///some/dir' sync against a local directory instead of
+# an FTP server, for benchmarks. Seconds each command takes and bytes
+# per second of the transfers, 0 for no limit.
+LOCAL_LATENCY = 0.05
+LOCAL_BANDWIDTH = 0
+
 # To be used with the `QSettings` objects
 SettingsKeys = {
     'host': 'Host',
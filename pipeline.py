@@ -0,0 +1,74 @@
+import socket
+
+from ftplib import error_reply, error_perm, error_temp, error_proto
+
+from localsettings import PIPELINE_DEPTH
+
+
+# Seconds to wait for the second reply when testing whether
+# the server handles pipelined commands.
+TEST_TIMEOUT = 5
+
+
+def send_pipelined(ftp, commands):
+    """
+    Writes `commands` to the control connection of `ftp` back to back,
+    `PIPELINE_DEPTH` at a time, and then reads their replies in order.
+    Returns the list of replies, the reply of a command that failed
+    is the exception `ftplib` raised for it.
+
+    :param ftp: Logged in `FTP` connection
+    :param commands: List of commands, without the line endings
+    """
+
+    replies = []
+    for i in range(0, len(commands), PIPELINE_DEPTH):
+        chunk = commands[i:i + PIPELINE_DEPTH]
+        ftp.sock.sendall(''.join('%s\r\n' % command for command in chunk))
+        for command in chunk:
+            try:
+                replies.append(ftp.getresp())
+            except (error_reply, error_perm, error_temp) as err:
+                replies.append(err)
+
+    return replies
+
+def send_serial(ftp, commands):
+    """
+    Same as `send_pipelined`, for servers that handle
+    one command at a time.
+
+    :param ftp: Logged in `FTP` connection
+    :param commands: List of commands, without the line endings
+    """
+
+    replies = []
+    for command in commands:
+        try:
+            replies.append(ftp.sendcmd(command))
+        except (error_reply, error_perm, error_temp) as err:
+            replies.append(err)
+
+    return replies
+
+def supports_pipelining(ftp):
+    """
+    Tells whether the server replies to commands sent before the reply
+    to the previous one, some of them drop those commands. Two NOOP
+    are sent at once, the connection can't be used afterwards if the
+    second reply doesn't come.
+
+    :param ftp: Logged in `FTP` connection, used only for this test
+    """
+
+    timeout = ftp.sock.gettimeout()
+    ftp.sock.settimeout(TEST_TIMEOUT)
+    try:
+        ftp.sock.sendall('NOOP\r\nNOOP\r\n')
+        ftp.getresp()
+        ftp.getresp()
+        return True
+    except (socket.timeout, EOFError, error_reply, error_perm, error_temp, error_proto):
+        return False
+    finally:
+        ftp.sock.settimeout(timeout)
@@ -8,8 +8,9 @@ from filetransfer_abc import ftp_si
 
 from PySide.QtCore import QObject, Slot, Signal, QTimer, QDir, QThread
 
-from dbcore import File, FileAction, ActionQueue, Session, empty_db
+from dbcore import File, FileAction, Directory, ActionQueue, HashCache, Session, empty_db
 from watchers import ServerWatcher, LocalWatcher
+from localsettings import HASH_VERIFICATION
 
 
 class Sync(QObject):
@@ -18,6 +19,7 @@ class Sync(QObject):
     deleteLocalFile = Signal((str,))
     downloadFile = Signal((str,))
     uploadFile = Signal((str,))
+    moveServerFile = Signal((str, str,))
     checkServer = Signal()
     checkLocal = Signal()
     statusChanged = Signal((str,))
@@ -27,6 +29,8 @@ class Sync(QObject):
 
         self.server = ServerWatcher(host, ssl, self)
         
+        # Digests of local files, for `sameContents`.
+        self.hashes = HashCache()
         self.preloaedActions = []
         self.doPreemptive = empty_db()
         self.connected = False
@@ -38,6 +42,9 @@ class Sync(QObject):
             os.makedirs(localdir)
         self.local = LocalWatcher(localdir)
         self.server.setLocalDir(localdir)
+        # Files written by downloads must not look like local changes.
+        self.local.echoes = self.server.echoes
+        self.local.hashes = self.hashes
 
         self.local.moveToThread(self.thread())
         self.local.setParent(self)
@@ -52,11 +59,14 @@ class Sync(QObject):
             self.local.fileAdded.connect(self.onAdded)
             self.local.fileChanged.connect(self.onChanged)
             self.local.fileDeleted.connect(self.onDeleted)
+            self.local.fileMoved.connect(self.onMoved)
 
             self.deleteLocalFile.connect(self.local.deleteFile)
             self.deleteServerFile.connect(self.server.onDelete)
             self.downloadFile.connect(self.server.onDownload)
             self.uploadFile.connect(self.server.onUpload)
+            self.moveServerFile.connect(self.server.onMove)
+            self.server.transferFinished.connect(self.onTransferFinished)
 
     @Slot()
     def initQueue(self):
@@ -71,6 +81,9 @@ class Sync(QObject):
     @Slot()
     def takeAction(self):
         self.actionTimer.stop()
+        
+        # Actions queued since the last pass are saved now, in one go.
+        self.actionQueue.flush()
 
         if self.doPreemptive:
             # Preemptive check is a bit of a workaround to deal with
@@ -78,8 +91,10 @@ class Sync(QObject):
             self.doPreemptive = False
             self.server.preemptiveCheck = True
             self.local.fileAdded.connect(self.server.added)
-            self.local.checkout()
+            # The server goes first so that local files found
+            # are compared with the sizes and dates just listed.
             self.server.checkout()
+            self.local.checkout()
             self.local.fileAdded.disconnect(self.server.added)
             self.server.preemptiveCheck = False
             for action in self.server.preemptiveActions:
@@ -91,7 +106,14 @@ class Sync(QObject):
 
         serverActionCount = 0
         localActionCount = 0
-        for action in self.actionQueue:
+        actions = self.actionQueue.pending()
+        for action in actions:
+            self.actionQueue.start(action)
+        # The journal must tell which actions were in flight
+        # if the application stops before they are over.
+        self.actionQueue.flush()
+        
+        for action in actions:
             if action is not None:
                 print 'Next action: %s' % action 
                 path = action.path
@@ -105,6 +127,7 @@ class Sync(QObject):
                         # Maybe it was temporary or a quick rename.
                         # So we ignore it
                         print "Ignored action on " + path + ": File doesn't exist on local."
+                        self.actionQueue.finish(path)
                         continue
                     
                 
@@ -114,6 +137,9 @@ class Sync(QObject):
                 elif do == FileAction.DOWNLOAD:
                     self.downloadFile.emit(path)
                     serverActionCount += 1
+                elif do == FileAction.MOVE:
+                    self.moveServerFile.emit(action.source, path)
+                    serverActionCount += 1
                 elif do == FileAction.DELETE:
                     with File.fromPath(path) as deleted_file:
                         # `action.location` attribute only makes sense when deciding
@@ -123,22 +149,27 @@ class Sync(QObject):
                             self.deleteLocalFile.emit(localpath)
                             deleted_file.inlocal = False
                             localActionCount += 1
+                            self.actionQueue.finish(path)
 
                         elif location == FileAction.SERVER:
                             self.deleteServerFile.emit(path)
                             deleted_file.inserver = False
                             serverActionCount += 1
         
-        self.actionQueue.clear()
-        
-        # Scan server for file changes
+        # Scan server for file changes, queued transfers are run first
         self.statusChanged.emit('Scanning remote files for changes')
         self.server.checkout()
+        self.actionQueue.purge()
         
         if self.firstScan:
             # First do a full scan to check for offline changes.
             # From there we will rely on real time notifications watchdog.
             self.firstScan = False
+            if HASH_VERIFICATION:
+                # Local digests are computed with the algorithm the server uses,
+                # without one there is nothing to compare them with.
+                hashCommand = self.server.hashAlgorithm()
+                self.local.hashAlgorithm = hashCommand[1] if hashCommand else None
             self.statusChanged.emit('Scanning local files for changes')
             self.local.checkout()
             self.local.startObserver()
@@ -161,6 +192,72 @@ class Sync(QObject):
         
         self.actionTimer.start()
             
+    @Slot(str, bool)
+    def onTransferFinished(self, serverpath, success):
+        action = self.actionQueue.get(serverpath)
+        if action is None or action.state != FileAction.INFLIGHT:
+            return
+        self.actionQueue.finish(serverpath, success)
+        
+        if action.action == FileAction.MOVE:
+            if not success:
+                # Replaced by uploads and deletes, it's not retried.
+                self.actionQueue.discard(serverpath)
+                self.moveFailed(action.source, serverpath)
+            elif not os.path.isdir(self.local.localFromServer(serverpath)):
+                # Changes made while the move was pending weren't queued.
+                self.onChanged(FileAction.LOCAL, serverpath, False)
+                
+    def movedFiles(self, serverpath):
+        """
+        Returns the `File` rows of the local file or directory `serverpath`,
+        taken from the database.
+        
+        :param serverpath: Path of the file or directory on the server
+        """
+        
+        session = Session()
+        if os.path.isdir(self.local.localFromServer(serverpath)):
+            return Directory.childrenFilter(session.query(File), serverpath, recursive=True).all()
+        
+        return session.query(File).filter(File.path == serverpath).all()
+    
+    def moveFailed(self, src, dest):
+        """
+        Falls back to uploading the moved files again, and deleting
+        their copies at the old location on the server.
+        The rows were already moved along with the local files, the
+        server copies get theirs back so the scans don't take
+        them for new files, or the moved ones for deleted files.
+        
+        :param src: Path on the server before the move
+        :param dest: Path on the server after the move
+        """
+        
+        print 'Could not move %s, uploading %s instead' % (src, dest)
+        moved_files = self.movedFiles(dest)
+        session = Session.object_session(moved_files[0]) if moved_files else None
+        for moved_file in moved_files:
+            if moved_file.inserver:
+                oldpath = src + moved_file.path[len(dest):]
+                old_file = session.query(File).filter(File.path == oldpath).first()
+                if old_file is None:
+                    old_file = File(oldpath)
+                    session.add(old_file)
+                old_file.inserver = True
+                old_file.inlocal = False
+                old_file.servermdate = moved_file.servermdate
+                old_file.serversize = moved_file.serversize
+                old_file.last_checked_server = moved_file.last_checked_server
+                old_file.synced_localmdate = moved_file.synced_localmdate
+                old_file.synced_servermdate = moved_file.synced_servermdate
+                # Not on the server until it's uploaded.
+                moved_file.inserver = False
+                self.actionQueue.add(FileAction(oldpath, FileAction.DELETE, FileAction.SERVER))
+            self.actionQueue.add(FileAction(moved_file.path, FileAction.UPLOAD, FileAction.SERVER))
+        if session is not None:
+            session.commit()
+        
     @Slot()
     def cleanSync(self):
         """
@@ -202,31 +299,81 @@ class Sync(QObject):
                     
         
         try:
-            if changed_file.inserver:
-                diff = changed_file.timeDiff()
+            # Whether both copies have the same contents, `None` when
+            # it can't be told or it hasn't been checked.
+            same = None
+            # Copies of different sizes can't be the same, no need to
+            # look at the modified times or the contents.
+            resized = changed_file.inserver and changed_file.inlocal \
+                      and None not in (changed_file.localsize, changed_file.serversize) \
+                      and changed_file.localsize != changed_file.serversize
+            if resized:
+                same = False
+            # Each copy is compared against the date it was last in sync at,
+            # `None` when it never was.
+            localChanged = serverChanged = None
+            if changed_file.inserver and changed_file.inlocal:
+                localChanged = changed_file.localChanged()
+                serverChanged = changed_file.serverChanged()
+                
+            if localChanged is not None and localChanged != serverChanged:
+                # Only one copy changed since the last sync, it's the one kept.
+                if localChanged:
+                    action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
+                else:
+                    action = FileAction(serverpath, FileAction.DOWNLOAD, FileAction.LOCAL)
+            elif localChanged is False and resized:
+                # Same dates but a new size, the side that reported it wins.
+                if location == FileAction.LOCAL:
+                    action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
+                else:
+                    action = FileAction(serverpath, FileAction.DOWNLOAD, FileAction.LOCAL)
+            elif localChanged is False:
+                # Both copies are still the way they were last synced.
+                return
+            else:
+                # Never synced, or changed on both sides: the newest copy wins.
+                if changed_file.inserver:
+                    diff = changed_file.timeDiff()
 
-                MY_TOLERANCE = 10
+                    MY_TOLERANCE = 10
             
-                if skipDeltaCheck == False and abs(diff) < MY_TOLERANCE:
-                    return
+                    if skipDeltaCheck == False and abs(diff) < MY_TOLERANCE and not resized:
+                        # Edits made within the tolerance are caught
+                        # by comparing the contents, when possible.
+                        same = self.sameContents(serverpath) if changed_file.inlocal else None
+                        if same is not False:
+                            return
             
-            if location == FileAction.SERVER:
-                if changed_file.inlocal:
-                    if changed_file.localmdate < changed_file.servermdate:
+                # Within the tolerance the side that reported the change wins.
+                resized = resized and abs(changed_file.timeDiff()) < MY_TOLERANCE
+                if location == FileAction.SERVER:
+                    if changed_file.inlocal:
+                        if changed_file.localmdate < changed_file.servermdate or resized:
+                            action = FileAction(serverpath, FileAction.DOWNLOAD, FileAction.LOCAL)
+                    else:
                         action = FileAction(serverpath, FileAction.DOWNLOAD, FileAction.LOCAL)
-                else:
-                    action = FileAction(serverpath, FileAction.DOWNLOAD, FileAction.LOCAL)
            
-            elif location == FileAction.LOCAL:
-                if changed_file.inserver:
-                    try:
-                        if changed_file.servermdate < changed_file.localmdate:
-                            action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
-                    except:
-                        print 'Error:', changed_file, changed_file.servermdate, changed_file.localmdate
+                elif location == FileAction.LOCAL:
+                    if changed_file.inserver:
+                        try:
+                            if changed_file.servermdate < changed_file.localmdate or resized:
+                                action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
+                        except:
+                            print 'Error:', changed_file, changed_file.servermdate, changed_file.localmdate
                         
-                else:
-                    action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
+                    else:
+                        action = FileAction(serverpath, FileAction.UPLOAD, FileAction.SERVER)
+                    
+            if action is not None and changed_file.inserver and changed_file.inlocal:
+                # Touched but not changed, the current dates
+                # are recorded without transferring.
+                if same is None:
+                    same = self.sameContents(serverpath)
+                if same:
+                    print 'File %s has the same contents on both sides' % serverpath
+                    self.markSynced(serverpath)
+                    action = None
                 
             if action is not None:
                 self.actionQueue.add(action)
@@ -235,6 +382,40 @@ class Sync(QObject):
             for i in info: sys.stderr.write(i)
             
     
+    def sameContents(self, serverpath):
+        """
+        Compares the digests of the local and server copies of `serverpath`.
+        Returns `None` if they can't be compared, the server
+        doesn't support any hash extension for instance.
+        
+        :param serverpath: Path of the file on the server
+        """
+        
+        if not HASH_VERIFICATION:
+            return None
+        
+        remote = self.server.remoteHash(serverpath)
+        if remote is None:
+            return None
+        algorithm, digest = remote
+        
+        local = self.hashes.digest(self.local.localFromServer(serverpath), algorithm)
+        if local is None:
+            return None
+        
+        return local == digest
+    
+    def markSynced(self, serverpath):
+        """
+        Records both copies of a file with the same contents as in sync
+        at their current modified dates, nothing is transferred.
+        
+        :param serverpath: Path of the file on the server
+        """
+        
+        with File.fromPath(serverpath) as same_file:
+            same_file.markSynced()
+                
     @Slot(str, str)
     def onAdded(self, location, serverpath):
 
@@ -274,5 +455,29 @@ class Sync(QObject):
         
         if action is not None:
             self.actionQueue.add(action)
+        else:
+            # The file never made it to the other side, whatever was
+            # pending for it (an upload or a download) cancels out.
+            self.actionQueue.discard(serverpath)
+            
+    @Slot(str, str, str)
+    def onMoved(self, location, src, dest):
+        if location != FileAction.LOCAL:
+            return
+        
+        # Whatever was pending at the old location no longer applies.
+        for action in self.actionQueue:
+            if action.path == src or action.path.startswith(src + '/'):
+                self.actionQueue.discard(action.path)
+        
+        # Rows were already moved by the local watcher.
+        moved_files = self.movedFiles(dest)
+        if any(moved_file.inserver for moved_file in moved_files):
+            self.actionQueue.add(FileAction(dest, FileAction.MOVE, FileAction.SERVER, src))
+            
+        for moved_file in moved_files:
+            if not moved_file.inserver:
+                # Never uploaded, there is nothing to move on the server.
+                self.onAdded(FileAction.LOCAL, moved_file.path)
             
     
@@ -0,0 +1,77 @@
+import os
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from compression import worth_compressing, Inflater, DeflatingReader, MIN_SIZE
+
+
+class WorthCompressingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.localdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.localdir)
+
+    def write(self, name, data):
+        localpath = os.path.join(self.localdir, name)
+        with open(localpath, 'wb') as f:
+            f.write(data)
+        return localpath
+
+    def test_small_files(self):
+        self.assertFalse(worth_compressing('notes.txt', MIN_SIZE - 1))
+
+    def test_known_extensions(self):
+        self.assertTrue(worth_compressing('server.LOG', 10 * MIN_SIZE))
+        self.assertFalse(worth_compressing('photo.jpg', 10 * MIN_SIZE))
+
+    def test_unknown_size(self):
+        self.assertTrue(worth_compressing('data.csv', None))
+
+    def test_unknown_extension_without_local_copy(self):
+        self.assertFalse(worth_compressing('data.xyz', 10 * MIN_SIZE))
+
+    def test_unknown_extension_sampled(self):
+        text = self.write('text.xyz', 'line of text\n' * 1000)
+        noise = self.write('noise.xyz', os.urandom(10 * MIN_SIZE))
+        self.assertTrue(worth_compressing('text.xyz', os.path.getsize(text), text))
+        self.assertFalse(worth_compressing('noise.xyz', os.path.getsize(noise), noise))
+
+    def test_sample_too_small(self):
+        localpath = self.write('short.xyz', 'a' * 100)
+        self.assertFalse(worth_compressing('short.xyz', None, localpath))
+
+    def test_missing_local_copy(self):
+        localpath = os.path.join(self.localdir, 'gone.xyz')
+        self.assertFalse(worth_compressing('gone.xyz', 10 * MIN_SIZE, localpath))
+
+
+class StreamTest(unittest.TestCase):
+
+    data = 'line of text\n' * 5000
+
+    def test_deflating_reader(self):
+        blocks = []
+        reader = DeflatingReader(StringIO(self.data), blocks.append)
+        deflated = ''.join(iter(lambda: reader.read(1024), ''))
+        self.assertEqual(zlib.decompress(deflated), self.data)
+        self.assertEqual(''.join(blocks), self.data)
+        self.assertLess(len(deflated), len(self.data))
+
+    def test_inflater(self):
+        blocks = []
+        inflater = Inflater(blocks.append)
+        deflated = zlib.compress(self.data)
+        for i in range(0, len(deflated), 100):
+            inflater(deflated[i:i + 100])
+        inflater.flush()
+        self.assertEqual(''.join(blocks), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
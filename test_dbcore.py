@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+import dbcore
+
+from dbcore import ActionQueue, FileAction, File, Directory, ServerCapabilities, Base, Session, \
+                   seed_directories
+
+
+def upload(path):
+    return FileAction(path, FileAction.UPLOAD, FileAction.SERVER)
+
+def download(path):
+    return FileAction(path, FileAction.DOWNLOAD, FileAction.LOCAL)
+
+
+class ActionQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # Each test gets its own database file.
+        self.dbdir = tempfile.mkdtemp()
+        engine = create_engine('sqlite:///%s' % os.path.join(self.dbdir, 'iqmeta.db'))
+        Base.metadata.create_all(engine)
+        Session.configure(bind=engine)
+        self.delay = ActionQueue.RETRY_DELAY
+        self.queue = ActionQueue()
+
+    def tearDown(self):
+        ActionQueue.RETRY_DELAY = self.delay
+        self.queue.session.close()
+        Session.configure(bind=dbcore.engine)
+        shutil.rmtree(self.dbdir)
+
+    def paths(self, actions):
+        return [action.path for action in actions]
+
+    def take(self):
+        """Starts the pending actions and returns them, like `Sync.takeAction`."""
+
+        actions = self.queue.pending()
+        for action in actions:
+            self.queue.start(action)
+        self.queue.flush()
+        return actions
+
+    def test_same_action(self):
+        self.queue.add(upload('/a.txt'))
+        self.queue.add(upload('/a.txt'))
+        self.assertEqual(len(self.queue), 1)
+
+    def test_updated_in_place(self):
+        self.queue.add(upload('/a.txt'))
+        self.queue.add(upload('/b.txt'))
+        self.queue.add(download('/a.txt'))
+        self.assertEqual(self.paths(self.queue.pending()), ['/a.txt', '/b.txt'])
+        self.assertEqual(self.queue.get('/a.txt').action, FileAction.DOWNLOAD)
+
+    def test_queued_again_in_flight(self):
+        self.queue.add(upload('/a.txt'))
+        self.take()
+        self.queue.add(upload('/a.txt'))
+        self.queue.finish('/a.txt')
+        self.assertEqual(self.paths(self.queue.pending()), ['/a.txt'])
+
+    def test_upload_after_move(self):
+        self.queue.add(FileAction('/b.txt', FileAction.MOVE, FileAction.SERVER, '/a.txt'))
+        self.queue.add(upload('/b.txt'))
+        self.assertEqual(self.queue.get('/b.txt').action, FileAction.MOVE)
+
+    def test_delete_after_move(self):
+        self.queue.add(FileAction('/b.txt', FileAction.MOVE, FileAction.SERVER, '/a.txt'))
+        self.queue.add(FileAction('/b.txt', FileAction.DELETE, FileAction.SERVER))
+        self.assertIsNone(self.queue.get('/b.txt'))
+        self.assertEqual(self.queue.get('/a.txt').action, FileAction.DELETE)
+
+    def test_discard(self):
+        self.queue.add(upload('/a.txt'))
+        self.queue.discard('/a.txt')
+        self.queue.flush()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(len(ActionQueue()), 0)
+
+    def test_purge(self):
+        self.queue.add(upload('/a.txt'))
+        self.queue.add(upload('/b.txt'))
+        self.take()
+        self.queue.finish('/a.txt')
+        self.queue.purge()
+        self.assertEqual(self.paths(self.queue), ['/b.txt'])
+
+    def test_replay(self):
+        for path in ['/a.txt', '/b.txt', '/c.txt']:
+            self.queue.add(upload(path))
+        self.take()
+        self.queue.finish('/b.txt')
+        self.queue.add(download('/d.txt'))
+        self.queue.flush()
+        # Started after a crash, /a.txt and /c.txt were in flight.
+        replayed = ActionQueue()
+        self.assertEqual(self.paths(replayed.pending()), ['/a.txt', '/c.txt', '/d.txt'])
+        self.assertEqual(replayed.get('/d.txt').action, FileAction.DOWNLOAD)
+
+    def test_replay_failed(self):
+        self.queue.add(upload('/a.txt'))
+        self.take()
+        self.queue.finish('/a.txt', False)
+        self.queue.flush()
+        self.assertEqual(self.paths(ActionQueue().pending()), ['/a.txt'])
+
+    def test_retry(self):
+        self.queue.add(upload('/a.txt'))
+        self.take()
+        self.queue.finish('/a.txt', False)
+        self.assertEqual(self.queue.pending(), [])
+        # The same change reported again waits for the retry.
+        self.queue.add(upload('/a.txt'))
+        self.assertEqual(self.queue.pending(), [])
+        self.queue.get('/a.txt').retry = 0
+        self.assertEqual(self.paths(self.queue.pending()), ['/a.txt'])
+        self.assertEqual(self.queue.get('/a.txt').attempts, 1)
+
+    def test_retries_run_out(self):
+        ActionQueue.RETRY_DELAY = 0
+        self.queue.add(upload('/a.txt'))
+        for i in range(ActionQueue.RETRIES):
+            self.assertEqual(self.paths(self.take()), ['/a.txt'])
+            self.queue.finish('/a.txt', False)
+            self.queue.purge()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(len(ActionQueue()), 0)
+
+
+class SeedDirectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        engine = create_engine('sqlite:///%s' % os.path.join(self.dbdir, 'iqmeta.db'))
+        Base.metadata.create_all(engine)
+        Session.configure(bind=engine)
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.close()
+        Session.configure(bind=dbcore.engine)
+        shutil.rmtree(self.dbdir)
+
+    def add(self, path, inserver=True):
+        file_ = File(path)
+        file_.inserver = inserver
+        self.session.add(file_)
+        self.session.commit()
+
+    def directories(self):
+        return sorted(path for path, in Session().query(Directory.path))
+
+    def test_parents(self):
+        self.add('/top.txt')
+        self.add('/a/b/c.txt')
+        self.add('/a/d.txt')
+        self.add('/local/only.txt', False)
+        seed_directories()
+        self.assertEqual(self.directories(), ['/a', '/a/b'])
+
+    def test_existing_rows(self):
+        self.add('/a/b/c.txt')
+        self.session.add(Directory('/a'))
+        self.session.commit()
+        seed_directories()
+        self.assertEqual(self.directories(), ['/a'])
+
+
+class PartialUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        engine = create_engine('sqlite:///%s' % os.path.join(self.dbdir, 'iqmeta.db'))
+        Base.metadata.create_all(engine)
+        Session.configure(bind=engine)
+        session = Session()
+        session.add_all([File('/a.txt'), File('/b.txt')])
+        session.commit()
+
+    def tearDown(self):
+        Session.configure(bind=dbcore.engine)
+        shutil.rmtree(self.dbdir)
+
+    def test_stored(self):
+        partial = ((1000, 1500000000.25), (200, datetime(2020, 1, 2, 3, 4, 5)))
+        File.recordPartialUpload('/a.txt', partial)
+        self.assertEqual(File.partialUploads(['/a.txt', '/b.txt']), {'/a.txt': partial})
+
+    def test_no_server_copy(self):
+        File.recordPartialUpload('/a.txt', ((1000, 1500000000.25), None))
+        self.assertEqual(File.partialUploads(['/a.txt'])['/a.txt'], ((1000, 1500000000.25), None))
+
+    def test_removed(self):
+        File.recordPartialUpload('/a.txt', ((1000, 1500000000.25), None))
+        File.recordPartialUpload('/a.txt', None)
+        self.assertEqual(File.partialUploads(['/a.txt']), {})
+
+
+class ServerCapabilitiesTest(unittest.TestCase):
+
+    features = {'MLSD': '', 'MFMT': '', 'HASH': 'SHA-1;MD5*'}
+
+    def setUp(self):
+        self.capabilities = ServerCapabilities('ftp.example.com', 'user')
+        self.capabilities.setFeatures(self.features)
+        self.capabilities.writable = True
+        self.capabilities.checked = datetime.utcnow()
+
+    def test_same_features(self):
+        self.assertTrue(self.capabilities.current(dict(self.features)))
+        self.assertTrue(self.capabilities.fresh(dict(self.features)))
+
+    def test_different_features(self):
+        features = dict(self.features, MODE='Z')
+        self.assertFalse(self.capabilities.current(features))
+        self.assertFalse(self.capabilities.fresh(features))
+
+    def test_expired(self):
+        self.capabilities.checked -= ServerCapabilities.TTL + timedelta(minutes=1)
+        self.assertFalse(self.capabilities.current(self.features))
+
+    def test_not_writable(self):
+        self.capabilities.writable = False
+        self.assertTrue(self.capabilities.current(self.features))
+        self.assertFalse(self.capabilities.fresh(self.features))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import unittest
+
+from debouncer import Debouncer
+
+
+# Paths that don't exist, the stat results are all `None`.
+ROOT = os.path.join(os.sep, 'nonexistent', 'iqbox')
+
+def path(*names):
+    return os.path.join(ROOT, *names)
+
+
+class MergeTest(unittest.TestCase):
+
+    def test_created(self):
+        self.assertEqual(Debouncer.merge(Debouncer.CREATED, Debouncer.MODIFIED), Debouncer.CREATED)
+        self.assertIsNone(Debouncer.merge(Debouncer.CREATED, Debouncer.DELETED))
+
+    def test_moved(self):
+        self.assertEqual(Debouncer.merge(Debouncer.MOVED, Debouncer.MODIFIED), Debouncer.MOVED)
+        self.assertEqual(Debouncer.merge(Debouncer.MOVED, Debouncer.DELETED), Debouncer.DELETED)
+
+    def test_deleted(self):
+        self.assertEqual(Debouncer.merge(Debouncer.DELETED, Debouncer.CREATED), Debouncer.MODIFIED)
+        self.assertEqual(Debouncer.merge(Debouncer.DELETED, Debouncer.DELETED), Debouncer.DELETED)
+
+    def test_modified(self):
+        self.assertEqual(Debouncer.merge(Debouncer.MODIFIED, Debouncer.MODIFIED), Debouncer.MODIFIED)
+        self.assertEqual(Debouncer.merge(Debouncer.MODIFIED, Debouncer.DELETED), Debouncer.DELETED)
+
+
+class PushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.debouncer = Debouncer()
+
+    def kind(self, path):
+        return self.debouncer.events[path][0]
+
+    def test_burst(self):
+        for i in range(10):
+            self.debouncer.push(path('a.txt'), Debouncer.MODIFIED)
+        self.assertEqual(len(self.debouncer), 1)
+        self.assertEqual(self.kind(path('a.txt')), Debouncer.MODIFIED)
+
+    def test_temporary(self):
+        self.debouncer.push(path('a.tmp'), Debouncer.CREATED)
+        self.debouncer.push(path('a.tmp'), Debouncer.MODIFIED)
+        self.debouncer.push(path('a.tmp'), Debouncer.DELETED)
+        self.assertEqual(len(self.debouncer), 0)
+
+    def test_replaced(self):
+        self.debouncer.push(path('a.txt'), Debouncer.DELETED)
+        self.debouncer.push(path('a.txt'), Debouncer.CREATED)
+        self.assertEqual(self.kind(path('a.txt')), Debouncer.MODIFIED)
+
+
+class MoveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.debouncer = Debouncer()
+
+    def event(self, path):
+        kind, when, st, source = self.debouncer.events[path]
+        return kind, source
+
+    def test_move(self):
+        self.debouncer.move(path('a.txt'), path('b.txt'))
+        self.assertEqual(self.event(path('b.txt')), (Debouncer.MOVED, path('a.txt')))
+
+    def test_created_then_moved(self):
+        self.debouncer.push(path('a.txt'), Debouncer.CREATED)
+        self.debouncer.move(path('a.txt'), path('b.txt'))
+        self.assertNotIn(path('a.txt'), self.debouncer.events)
+        self.assertEqual(self.event(path('b.txt')), (Debouncer.CREATED, None))
+
+    def test_moved_twice(self):
+        self.debouncer.move(path('a.txt'), path('b.txt'))
+        self.debouncer.move(path('b.txt'), path('c.txt'))
+        self.assertEqual(len(self.debouncer), 1)
+        self.assertEqual(self.event(path('c.txt')), (Debouncer.MOVED, path('a.txt')))
+
+    def test_moved_then_deleted(self):
+        self.debouncer.move(path('a.txt'), path('b.txt'))
+        self.debouncer.push(path('b.txt'), Debouncer.DELETED)
+        self.assertEqual(len(self.debouncer), 1)
+        self.assertEqual(self.event(path('a.txt')), (Debouncer.DELETED, None))
+
+    def test_moved_then_modified(self):
+        self.debouncer.move(path('a.txt'), path('b.txt'))
+        self.debouncer.push(path('b.txt'), Debouncer.MODIFIED)
+        self.assertEqual(self.event(path('b.txt'))[0], Debouncer.MOVED)
+
+    def test_directory_contents(self):
+        self.debouncer.move(path('dir'), path('renamed'))
+        self.debouncer.move(path('dir', 'a.txt'), path('renamed', 'a.txt'))
+        self.assertEqual(len(self.debouncer), 1)
+        self.assertEqual(self.event(path('renamed')), (Debouncer.MOVED, path('dir')))
+
+    def test_out_of_directory(self):
+        self.debouncer.move(path('dir'), path('renamed'))
+        self.debouncer.move(path('dir', 'a.txt'), path('elsewhere.txt'))
+        self.assertEqual(self.event(path('elsewhere.txt')), (Debouncer.MOVED, path('dir', 'a.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from hashing import parse_hash_reply, file_digest
+
+
+MD5_ABC = '900150983cd24fb0d6963f7d28e17f72'
+SHA256_ABC = 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+
+
+class ParseHashReplyTest(unittest.TestCase):
+
+    def test_hash(self):
+        reply = '213 SHA-256 0-2 %s abc.txt' % SHA256_ABC
+        self.assertEqual(parse_hash_reply(reply, 'SHA-256'), SHA256_ABC)
+
+    def test_xmd5(self):
+        self.assertEqual(parse_hash_reply('250 %s' % MD5_ABC.upper(), 'MD5'), MD5_ABC)
+
+    def test_digest_after_name(self):
+        self.assertEqual(parse_hash_reply('213 abc.txt %s' % MD5_ABC, 'MD5'), MD5_ABC)
+
+    def test_hex_looking_name(self):
+        self.assertEqual(parse_hash_reply('213 cafe %s' % MD5_ABC, 'MD5'), MD5_ABC)
+
+    def test_crc_leading_zeros(self):
+        self.assertEqual(parse_hash_reply('250 1A2B3C', 'CRC32'), '001a2b3c')
+
+    def test_wrong_length(self):
+        self.assertIsNone(parse_hash_reply('250 %s' % MD5_ABC, 'SHA-1'))
+
+    def test_no_digest(self):
+        self.assertIsNone(parse_hash_reply('213 Hash computed.', 'MD5'))
+        self.assertIsNone(parse_hash_reply('213', 'MD5'))
+
+
+class FileDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.localpath = tempfile.mkstemp()
+        os.write(fd, 'abc')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.localpath)
+
+    def test_md5(self):
+        self.assertEqual(file_digest(self.localpath, 'MD5'), MD5_ABC)
+
+    def test_sha256(self):
+        self.assertEqual(file_digest(self.localpath, 'SHA-256'), SHA256_ABC)
+
+    def test_crc32(self):
+        self.assertEqual(file_digest(self.localpath, 'CRC32'), '352441c2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+
+from datetime import datetime as dt
+
+from listing import ListItem, parse_timestamp, parse_mlsd_line, parse_list_line, fingerprint
+
+
+class ParseTimestampTest(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_timestamp('20120615103000'), dt(2012, 6, 15, 10, 30))
+
+    def test_fraction(self):
+        self.assertEqual(parse_timestamp('20120615103000.250'),
+                         dt(2012, 6, 15, 10, 30, 0, 250000))
+
+    def test_invalid(self):
+        self.assertIsNone(parse_timestamp('yesterday'))
+
+
+class ParseMLSDLineTest(unittest.TestCase):
+
+    def test_file(self):
+        item = parse_mlsd_line('type=file;size=1024;modify=20120615103000; report.txt')
+        self.assertEqual(item, ListItem('report.txt', False, 1024, dt(2012, 6, 15, 10, 30)))
+
+    def test_directory(self):
+        item = parse_mlsd_line('type=dir;modify=20120615103000; photos')
+        self.assertTrue(item.isdir)
+        self.assertEqual(item.name, 'photos')
+
+    def test_facts_case(self):
+        item = parse_mlsd_line('Type=File;Size=10;Modify=20120615103000; a.txt')
+        self.assertEqual(item, ListItem('a.txt', False, 10, dt(2012, 6, 15, 10, 30)))
+
+    def test_name_with_spaces(self):
+        item = parse_mlsd_line('type=file;size=1; my file.txt')
+        self.assertEqual(item.name, 'my file.txt')
+
+    def test_missing_facts(self):
+        item = parse_mlsd_line('type=file; a.txt')
+        self.assertEqual(item, ListItem('a.txt', False, None, None))
+
+    def test_bad_size(self):
+        self.assertIsNone(parse_mlsd_line('type=file;size=big; a.txt').size)
+
+    def test_current_and_parent(self):
+        self.assertIsNone(parse_mlsd_line('type=cdir;modify=20120615103000; .'))
+        self.assertIsNone(parse_mlsd_line('type=pdir;modify=20120615103000; ..'))
+        self.assertIsNone(parse_mlsd_line('type=dir; ..'))
+
+    def test_links_are_files(self):
+        self.assertFalse(parse_mlsd_line('type=OS.unix=symlink;size=5; link').isdir)
+
+    def test_garbage(self):
+        self.assertIsNone(parse_mlsd_line(''))
+        self.assertIsNone(parse_mlsd_line('type=file;size=1;'))
+
+
+class ParseListLineTest(unittest.TestCase):
+
+    def test_unix_file(self):
+        item = parse_list_line('-rw-r--r--   1 user     group        1024 Jun 15  2012 report.txt')
+        self.assertEqual(item, ListItem('report.txt', False, 1024, None))
+
+    def test_unix_recent_file(self):
+        item = parse_list_line('-rw-r--r--   1 user     group          12 Jun 15 10:30 notes.txt')
+        self.assertEqual(item, ListItem('notes.txt', False, 12, None))
+
+    def test_unix_without_group(self):
+        item = parse_list_line('-rw-r--r--   1 user        7 Jun 15  2012 a.txt')
+        self.assertEqual(item, ListItem('a.txt', False, 7, None))
+
+    def test_unix_directory(self):
+        item = parse_list_line('drwxrwxrwx   1 user     group           0 Jun 15  2012 my photos')
+        self.assertEqual(item, ListItem('my photos', True, 0, None))
+
+    def test_unix_link(self):
+        item = parse_list_line('lrwxrwxrwx   1 user     group          10 Jun 15  2012 link -> target')
+        self.assertEqual(item.name, 'link')
+
+    def test_dos_file(self):
+        item = parse_list_line('06-15-12  10:30AM                 1024 report.txt')
+        self.assertEqual(item, ListItem('report.txt', False, 1024, None))
+
+    def test_dos_directory(self):
+        item = parse_list_line('06-15-2012  10:30PM       <DIR>          photos')
+        self.assertEqual(item, ListItem('photos', True, None, None))
+
+    def test_skipped_lines(self):
+        self.assertIsNone(parse_list_line('total 12'))
+        self.assertIsNone(parse_list_line('drwxr-xr-x   2 user     group        4096 Jun 15  2012 .'))
+        self.assertIsNone(parse_list_line('drwxr-xr-x   2 user     group        4096 Jun 15  2012 ..'))
+
+
+class FingerprintTest(unittest.TestCase):
+
+    items = [ListItem('a.txt', False, 10, dt(2012, 6, 15, 10, 30)),
+             ListItem('sub', True, None, None)]
+
+    def test_order(self):
+        self.assertEqual(fingerprint(self.items), fingerprint(list(reversed(self.items))))
+
+    def test_changes(self):
+        changed = [self.items[0]._replace(size=11), self.items[1]]
+        self.assertNotEqual(fingerprint(self.items), fingerprint(changed))
+
+    def test_unknown_dates(self):
+        self.assertIsNone(fingerprint([ListItem('a.txt', False, 10, None)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import socket
+import unittest
+
+from ftplib import error_perm, error_temp
+
+import pipeline
+
+from pipeline import send_pipelined, send_serial, supports_pipelining
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+        self.timeout = None
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+class FakeFTP(object):
+    """
+    Control connection answering each command with the reply `reply`
+    returns for it, `ftplib` error replies are raised.
+    """
+
+    def __init__(self, reply):
+        self.sock = FakeSocket()
+        self.reply = reply
+        self.received = []
+
+    def commands(self):
+        # Commands written so far whose replies weren't read yet.
+        lines = ''.join(self.sock.sent).split('\r\n')[:-1]
+        return lines[len(self.received):]
+
+    def getresp(self):
+        pending = self.commands()
+        if not pending:
+            raise socket.timeout('No reply')
+        self.received.append(pending[0])
+        reply = self.reply(pending[0])
+        if reply.startswith('4'):
+            raise error_temp(reply)
+        if reply.startswith('5'):
+            raise error_perm(reply)
+        return reply
+
+    def sendcmd(self, command):
+        self.sock.sendall('%s\r\n' % command)
+        return self.getresp()
+
+
+def size_reply(command):
+    filename = command.split(' ', 1)[1]
+    if filename.startswith('missing'):
+        return '550 %s: No such file.' % filename
+    return '213 %d' % len(filename)
+
+
+class SendPipelinedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.depth = pipeline.PIPELINE_DEPTH
+        pipeline.PIPELINE_DEPTH = 3
+
+    def tearDown(self):
+        pipeline.PIPELINE_DEPTH = self.depth
+
+    def test_replies_in_order(self):
+        ftp = FakeFTP(size_reply)
+        replies = send_pipelined(ftp, ['SIZE a', 'SIZE bb', 'SIZE ccc'])
+        self.assertEqual(replies, ['213 1', '213 2', '213 3'])
+        self.assertEqual(ftp.sock.sent, ['SIZE a\r\nSIZE bb\r\nSIZE ccc\r\n'])
+
+    def test_errors_keep_their_place(self):
+        replies = send_pipelined(FakeFTP(size_reply), ['SIZE a', 'SIZE missing', 'SIZE ccc'])
+        self.assertEqual(replies[0], '213 1')
+        self.assertIsInstance(replies[1], error_perm)
+        self.assertEqual(replies[2], '213 3')
+
+    def test_chunks(self):
+        ftp = FakeFTP(size_reply)
+        commands = ['SIZE %s' % ('x' * i) for i in range(1, 8)]
+        replies = send_pipelined(ftp, commands)
+        self.assertEqual(replies, ['213 %d' % i for i in range(1, 8)])
+        self.assertEqual(len(ftp.sock.sent), 3)
+
+    def test_same_as_serial(self):
+        commands = ['SIZE a', 'SIZE missing', 'SIZE ccc', 'SIZE missing too']
+        pipelined = send_pipelined(FakeFTP(size_reply), commands)
+        serial = send_serial(FakeFTP(size_reply), commands)
+        self.assertEqual([str(reply) for reply in pipelined], [str(reply) for reply in serial])
+
+
+class SupportsPipeliningTest(unittest.TestCase):
+
+    def test_both_replies(self):
+        ftp = FakeFTP(lambda command: '200 NOOP ok.')
+        self.assertTrue(supports_pipelining(ftp))
+        self.assertIsNone(ftp.sock.timeout)
+
+    def test_second_reply_missing(self):
+        ftp = FakeFTP(lambda command: '200 NOOP ok.')
+        # The server drops the command sent before the first reply.
+        ftp.sock.sendall = lambda data: FakeSocket.sendall(ftp.sock, data.split('\r\n')[0] + '\r\n')
+        self.assertFalse(supports_pipelining(ftp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,20 +4,31 @@ import time
 import socket
 import platform
 import traceback
+import itertools
 import StringIO
 
+from multiprocessing.pool import ThreadPool
 import engine_tools
 
 from datetime import datetime as dt
 from datetime import timedelta as td
-from ftplib import FTP_TLS, FTP, error_reply, error_perm
+from ftplib import error_reply, error_perm, error_temp
 
 from PySide.QtCore import QObject, Signal, Slot, QTimer, QDir, QThread
-from watchdog.events import FileSystemEventHandler, FileCreatedEvent
+from watchdog.events import FileSystemEventHandler, FileMovedEvent, DirMovedEvent
 from watchdog.observers import Observer
 
-from dbcore import File, FileAction, Session
-from localsettings import DEBUG
+from dbcore import File, FileAction, Directory, ScanWriter, Session, ServerCapabilities, \
+                   HashCache, move_paths, unsettled_dirs
+from ftppool import FTPPool, SerialBatch
+from asyncftp import AsyncFTPTransport
+from filetransfer_abc import open_transfer, ftp_si
+from debouncer import Debouncer, EchoRegistry
+from hashing import DIGEST_LENGTHS
+from compression import worth_compressing
+from listing import parse_mlsd_line, parse_list_line, fingerprint
+from localsettings import DEBUG, FTP_POOL_SIZE, SEGMENTED_DOWNLOAD_SIZE, LOCAL_SCAN_WORKERS, \
+                          ASYNC_CONNECTIONS, TRANSFER_COMPRESSION
 
 
 
@@ -26,9 +37,9 @@ def upload_test(f):
         mockFile = StringIO.StringIO('Test')
 
         try: 
-            self.ftp.storbinary('STOR %s' % self.testFile, mockFile)
+            self.ftp.uploadFile(self.testFile, mockFile)
             testResult = f(self)
-            self.ftp.delete('iqbox.test')
+            self.ftp.deleteFile('iqbox.test')
             return testResult
         except (error_perm, error_reply):
             return False
@@ -37,7 +48,17 @@ def upload_test(f):
 
 def ignore_dirs(f):
     def wrapped(self, event):
-        if event.is_directory:
+        if event.is_directory and not isinstance(event, DirMovedEvent):
+            # Directory moves are kept, they are made with one command on the server.
+            return
+        elif self.echoes.isEcho(getattr(event, 'dest_path', event.src_path)):
+            # Caused by a download or a delete made by the engine.
+            return
+        elif engine_tools.isPartialFile(event.src_path):
+            # Partial downloads are not user's files, a completed
+            # download is moved from its partial file into place.
+            if isinstance(event, FileMovedEvent):
+                self.events.push(event.dest_path, Debouncer.CREATED)
             return
         else:
             print event
@@ -72,6 +93,8 @@ class Watcher(QObject):
     fileDeleted = Signal((str,str,))
     fileAdded = Signal((str,str,))
     fileChanged = Signal((str,str,bool,))
+    # Location, path before and path after the move.
+    fileMoved = Signal((str,str,str,))
     checked = Signal()
     ioError = Signal((str,))
     
@@ -83,6 +106,7 @@ class Watcher(QObject):
         self.fileAdded.connect(self.added)
         self.fileChanged.connect(self.changed)
         self.fileDeleted.connect(self.deleted)
+        self.fileMoved.connect(self.moved)
        
     @Slot()
     def checkout(self):
@@ -107,6 +131,10 @@ class Watcher(QObject):
     @Slot(str, str)
     def deleted(self, location, serverpath):
         print 'Deleted {0}: {1}'.format(self.LOCATION, serverpath)
+        
+    @Slot(str, str, str)
+    def moved(self, location, src, dest):
+        print 'Moved {0}: {1} to {2}'.format(self.LOCATION, src, dest)
 
     def localFromServer(self, serverpath):
         # Removing leading '/' so `os.path.join` doesn't treat
@@ -134,14 +162,18 @@ class ServerWatcher(Watcher):
     fileEventCompleted = Signal()    
     loginCompleted = Signal((bool, str,))
     badFilenameFound = Signal((str,))
+    # Emitted with the server path and whether it succeeded
+    # once a queued delete, download or upload is over.
+    transferFinished = Signal((str, bool,))
 
     LOCATION = 'server'
     TEST_FILE = 'iqbox.test'
     
     def __init__(self, host, ssl, parent=None):
         """
-        Initializes parent class and attributes. Decides
-        whether to use `FTP_TLS` or `FTP` based on the `ssl` param.
+        Initializes parent class and attributes. The connections
+        are made by `open_transfer`, which decides whether to use
+        `FTP_TLS` or `FTP` based on the `ssl` param.
         
         :param host: Location of the FTP server
         :param ssl: Tells whether the FTP needs to support TLS or not
@@ -155,19 +187,46 @@ class ServerWatcher(Watcher):
         self.deleteQueue = []
         self.downloadQueue = []
         self.uploadQueue = []
+        self.moveQueue = []
         self.warnedNames = []
         self.ftp = None 
+        self.pool = None
         self.useSSL = ssl
         self.host = host
         self.preemptiveCheck = False
         self.preemptiveActions = []
         self.testFile = 'iqbox.test'
+        # Whether the server understands MLSD, `None` until the
+        # first listing is requested.
+        self.mlsdSupported = None
+        # Whether the server accepts REST before STOR, `None` until
+        # the first upload is resumed.
+        self.restUploads = None
+        # Uploads that didn't finish, maps server paths to the (size, mtime)
+        # of the local file being sent and the (size, mdate) the server
+        # copy had before, `None` if there was none. Also stored in the
+        # `File` rows, loaded again when the files are uploaded.
+        self.partialUploads = dict()
+        # Progress of the segmented downloads, shared by their segments.
+        self.segmentStatus = dict()
+        # Local changes made by the engine, shared with
+        # the local watcher by `Sync`.
+        self.echoes = EchoRegistry()
+        # Extensions advertised by FEAT, maps them to their parameters.
+        self.features = dict()
+        # Directories known to exist on the server, so `mkpath` doesn't
+        # have to ask. `None` until loaded from the last scan.
+        self.knownDirs = None
+        # Whether metadata commands can be pipelined, set at login.
+        self.pipelining = False
+        # `AsyncFTPTransport` doing listings and transfers, if enabled.
+        self.transport = None
         
     @property
     def currentdir(self):
         """Returns the current working directory at the server"""
         
-        return self.ftp.pwd()
+        return self.ftp.currentdir
         
     def setLocalDir(self, localdir):
         """
@@ -185,306 +244,421 @@ class ServerWatcher(Watcher):
     @Slot()
     def checkout(self):
         """
-        Recursively checks out all files on the server.
-        Returns a dictionary of files on the server with their last modified date.
-        
-        :param download: Indicates whether or not the files should be downloaded
+        Checks out all files on the server, walking the directory tree
+        breadth first. Directory listings are fanned out across the
+        connection pool, results are merged into the database here,
+        in the watcher's thread.
         """
         
         # Check  `self.deleteQueue`, `self.uploadQueue` and `self.downloadQueue` queues.
         # These tasks are done in queues to make sure all FTP commands
         # are done sequentially, in the same thread.
+        if self.knownDirs is None:
+            # Directories found by the last scan.
+            self.knownDirs = set(path for path, in Session().query(Directory.path))
+            self.knownDirs.add('/')
+            
+        # Moves go first, the queued uploads can be meant for their sources.
+        self.moveAll()
         self.deleteAll()
         self.uploadAll()
         self.downloadAll()
         
-        # Handy list to keep track of the checkout process.
-        # This list contain absolute paths only.
-        checked_dirs = list()
-
-        # Sets '/' as initial directory and initializes `downloading_dir`
-        self.ftp.cwd('/')
-        downloading_dir = self.currentdir
         check_date = dt.utcnow()
-
-        sidirlist = list()
-
-        root_cached = False
+        
+        # Listing fingerprints from the previous scan, by directory path.
+        writer = ScanWriter()
+        session = writer.session
+        known = dict((directory.path, directory.fingerprint)
+                     for directory in session.query(Directory))
+        # Directories with files left to sync can't be skipped,
+        # their files need to be checked again.
+        unsettled = unsettled_dirs()
+        # Fingerprints of the directories listed in this scan.
+        fingerprints = dict()
+        
+        if self.transport is not None:
+            listings = self.transport.batch(self.transport.listDir)
+        else:
+            listings = self.batch(self.listDir)
+        self.textStatus.emit('Remote scan- Downloading folder list of /...')
+        listings.put('/')
         
         fileC = 0
-        while True:
-            # Gets the list of sub directories and files inside the 
-            # current directory `downloading_dir`.
-            self.textStatus.emit('Remote scan- Downloading folder list of '+downloading_dir+'...')
-            
-            if root_cached and downloading_dir == '/':
-                dir_subdirs = saved_root_dirs
-                dirfiles = saved_root_files
-            else:
-                
-                dir_subdirs = self.getDirs(downloading_dir)
-            
-                if downloading_dir == '/':
-                    saved_root_dirs = dir_subdirs
-    
-                # sidirlist.extend(dir_subdirs)
-                self.textStatus.emit('Remote scan- Downloading files list of '+downloading_dir+'...')            
-                dirfiles = self.getFiles(downloading_dir)
-     
-                if downloading_dir == '/':
-                    saved_root_files = dirfiles
-                    root_cached = True
+        # Directories that exist, the ones listed and their subdirectories.
+        existing = set(['/'])
+        for (downloading_dir,), items in listings:
+            if items is None:
+                # Listing failed, nothing is known about this directory
+                # so its files and subdirectories are left as they are.
+                continue
                 
+            # Every subdirectory gets listed as soon as a connection is free.
+            for item in items:
+                if item.isdir:
+                    dirpath = QDir.fromNativeSeparators(os.path.join(downloading_dir, item.name))
+                    self.textStatus.emit('Remote scan- Downloading folder list of '+dirpath+'...')
+                    listings.put(dirpath)
+                    existing.add(dirpath)
            
             # Leading '/' in `downloading_dir` breaks the `os.path.join` call
             localdir = os.path.join(self.localdir, downloading_dir[1:])
             if not os.path.exists(localdir):
                 # Creates the directory if it doesn't already exists.
                 os.makedirs(localdir)
+                
+            fingerprints[downloading_dir] = fingerprint(items)
+            if fingerprints[downloading_dir] is not None and \
+               known.get(downloading_dir) == fingerprints[downloading_dir] and \
+               downloading_dir not in unsettled:
+                # Same listing as in the previous scan, there's
+                # nothing to check in this directory.
+                continue
             
-            for file_ in dirfiles:
+            # Rows of all the files in this directory are fetched at once,
+            # so are the dates the listing didn't have.
+            writer.load(downloading_dir)
+            mdates = self.lastModifiedAll(
+                    [QDir.fromNativeSeparators(os.path.join(downloading_dir, item.name))
+                     for item in items if not item.isdir and item.mdate is None])
+            for item in items:
+                if item.isdir:
+                    continue
                                 
                 # `serverpath` is the absolute path of the file on the server,
                 # download it only if it hasn't been already downloaded
-                serverpath = os.path.join(downloading_dir, file_)
+                serverpath = os.path.join(downloading_dir, item.name)
                 serverpath = QDir.fromNativeSeparators(serverpath)
-                server_file = File.fromPath(serverpath)
+                server_file = writer.rows.get(serverpath)
 
                 self.textStatus.emit('Scanning remote file... '+serverpath+'...')
 
-                # How do we know if we should check this server file?
-                # We see if the date last checked is the check start time.
-                if server_file.last_checked_server != check_date:
-                    
-                    # Do this process only once per file
-    
-                    # Added by Simon
-                    # Give feedback on scanning of files.
-                    fileC += 1
-                    if fileC % 1 == 2:
-                        self.textStatus.emit('Scanning remote files for changes, '+str(fileC)+' files scanned.')
-                        
+                # Added by Simon
+                # Give feedback on scanning of files.
+                fileC += 1
+                if fileC % 1 == 2:
+                    self.textStatus.emit('Scanning remote files for changes, '+str(fileC)+' files scanned.')
                     
-                    # STEP: IS THIS THE FIRST TIME WE SAW THE FILE, OR WAS IT ALREADY IN OUR DB?
-                    just_added = not server_file.inserver
+                
+                # STEP: IS THIS THE FIRST TIME WE SAW THE FILE, OR WAS IT ALREADY IN OUR DB?
+                just_added = server_file is None or not server_file.inserver
 
-                    # STEP: IF ITS A NEW FILE, ENSURE WE DONT WANT TO SKIP IT
-                    # Example: If it's a temporary file, or a Unix file with a name we don't support.
-                    
-                    if just_added:    
-                        filename = os.path.basename(serverpath)
-     
-                        if platform.system() == 'Windows':
-                            
-                            badName = False
-                            for chr in ['\\', '/', ':', '?', '"', '<', '>', '|']:
-                                if chr in filename:
-                                    badName = True
-                                    break
-                            if badName:
-                                if filename not in self.warnedNames:
-                                    self.warnedNames.append(filename)
-                                    self.badFilenameFound.emit(filename)
-                                continue
+                # STEP: IF ITS A NEW FILE, ENSURE WE DONT WANT TO SKIP IT
+                # Example: If it's a temporary file, or a Unix file with a name we don't support.
+                
+                if just_added:    
+                    filename = os.path.basename(serverpath)
+ 
+                    if platform.system() == 'Windows':
                         
+                        badName = False
+                        for chr in ['\\', '/', ':', '?', '"', '<', '>', '|']:
+                            if chr in filename:
+                                badName = True
+                                break
+                        if badName:
+                            if filename not in self.warnedNames:
+                                self.warnedNames.append(filename)
+                                self.badFilenameFound.emit(filename)
+                            continue
                     
-                    # STEP: ASSUMING THE FILE DID EXIST IN OUR DB, LETS SAVE THE LAST MODIFICATION DATE
-                    lastmdate = server_file.servermdate
-                    
-                    # STEP: SAVE THE MOD DATE TO A VARIABLE
-                    # Now we get the last mod time.
-                    # We expect this to work fine since this file
-                    # was found on the server
+                server_file = writer.get(serverpath)
+                
+                # STEP: ASSUMING THE FILE DID EXIST IN OUR DB, LETS SAVE THE LAST MODIFICATION DATE
+                lastmdate = server_file.servermdate
+                lastsize = server_file.serversize
+                
+                # STEP: SAVE THE MOD DATE TO A VARIABLE
+                # MLSD listings already carry the last mod time, only ask
+                # for it when the listing didn't have it.
+                # We expect this to work fine since this file
+                # was found on the server
+                servermdate = item.mdate or mdates.get(serverpath)
+                if servermdate is None:
                     servermdate = self.lastModified(serverpath)
+                
+                # STEP: SET BOOL SHOWING THAT IT WAS ON THE SERVER, SINCE WE KNOW IT IS.
+                server_file.inserver = True
+                
+                # STEP: SET THE TIME THE FILE WAS LAST CHECKED TO THE SCAN START TIME
+                server_file.last_checked_server = check_date
+                
+                # STEP: SET THE MOD DATE IN THE DATABASE TO THE ONE WE JUST GOT
+                server_file.servermdate = servermdate
+                if item.size is not None:
+                    server_file.serversize = item.size
+                
+                # STEP: SAVE THIS CHANGE TO THE DATABASE
+                # Changes are committed together, for the whole directory.
+                writer.changed()
+                
+                resized = None not in (lastsize, item.size) and lastsize != item.size
+                if not just_added and server_file.synced_localmdate is not None \
+                   and server_file.synced_servermdate is None and not resized:
+                    # First listing after an upload, that's the date in sync.
+                    server_file.synced_servermdate = servermdate
+                    continue
+                
+                unsynced = server_file.serverChanged()
+                if unsynced is None and server_file.inlocal:
+                    # Never synced, the dates of both copies are compared.
+                    unsynced = server_file.timeDiff() < -Watcher.TOLERANCE
+
+                # Emit the signals after the attributes has been set and committed
+                if just_added is True:
+                    writer.emit(self.fileAdded, ServerWatcher.LOCATION, serverpath)
+                elif server_file.servermdate > lastmdate or unsynced or resized:
+                    # A different size is a change, whatever the modified date says.
+                    writer.emit(self.fileChanged, ServerWatcher.LOCATION, serverpath, False) 
                     
-                    # STEP: SET BOOL SHOWING THAT IT WAS ON THE SERVER, SINCE WE KNOW IT IS.
-                    server_file.inserver = True
-                    
-                    # STEP: SET THE TIME THE FILE WAS LAST CHECKED TO THE SCAN START TIME
-                    server_file.last_checked_server = check_date
-                    
-                    # STEP: SET THE MOD DATE IN THE DATABASE TO THE ONE WE JUST GOT
-                    server_file.servermdate = servermdate
-                    
-                    # STEP: SAVE THIS CHANGE TO THE DATABASE
-                    server_file.session.commit()
-                    
-                    delta = 0
-                    if server_file.inlocal:
-                        delta = server_file.timeDiff()
-
-                    # Emit the signals after the attributes has been set and committed
-                    if just_added is True:
-                        self.fileAdded.emit(ServerWatcher.LOCATION, serverpath)
-                    elif server_file.servermdate > lastmdate or delta < -Watcher.TOLERANCE:
-                        self.fileChanged.emit(ServerWatcher.LOCATION, serverpath, False) 
-            #END FOR            
-            
-            self.textStatus.emit('Remote scan- Finding next folder...')
-            dir_ready = True
-            for dir_ in dir_subdirs:
-                # `dirpath` is the absolute path of the subdirectory on the server,
-                dirpath = QDir.fromNativeSeparators(os.path.join(downloading_dir, dir_))
-                # `downloading_dir` is ready only when all its subdirectory are on the 
-                # `checked_dirs` list.
-                if dirpath not in checked_dirs:
-                    # Found one subdirectory that is not on `checked_dirs`,
-                    # will process it in the next iteration.
-                    downloading_dir = dirpath
-                    dir_ready = False
-                    break
-                    
-            if dir_ready is True:
-                # All subdirectories of `downloading_dir` are already in `checked_dirs`
-                if downloading_dir == '/':
-                    # All directories ready and at '/', means checkout is complete
-                    # So, exit the main While loop!!
-                    break
-                    
-                else:
-                    # Not at '/'. Current directory is ready so is appended to `checked_dirs`
-                    # Back one directory to find directories that are not in `checked_dirs`
-                    checked_dirs.append(downloading_dir)
-                    downloading_dir = os.path.dirname(downloading_dir)
-            
-            self.textStatus.emit('Remote scan- Found Folder...')
-                    
-##### END OF WHILE ################
-###################################################################
-        
-        # Deleted files are the ones whose `last_checked_server` attribute 
-        # didn't get updated in the recursive run.
-        session = Session()
-        deleted = session.query(File).filter(File.last_checked_server < check_date).filter(File.inserver == True)
-        for file_ in deleted:
-            self.fileDeleted.emit(ServerWatcher.LOCATION, file_.path)
+            # Deleted files are the ones in the database that are not in the
+            # listing anymore, including everything inside removed subdirectories.
+            deleted = self.findDeleted(session, downloading_dir, items)
+            for dirpath in deleted[1]:
+                Directory.childrenFilter(session.query(Directory), dirpath, True).delete(
+                        synchronize_session=False)
+                session.query(Directory).filter_by(path=dirpath).delete(synchronize_session=False)
+            self.saveDirectory(session, downloading_dir, check_date, 
+                               fingerprint=fingerprints[downloading_dir])
+            for path in deleted[0]:
+                writer.emit(self.fileDeleted, ServerWatcher.LOCATION, path)
+            writer.commit()
         
         # Wraps up the checkout process, commits to the database.
-        session.commit()
+        writer.commit()
+        self.knownDirs = existing
+        
+    def findDeleted(self, session, path, items):
+        """
+        Compares the listing `items` of the directory `path` with the
+        database. Returns a tuple holding the paths of the files that are
+        gone from the server and the paths of the directories that are gone.
+        
+        :param session: Database session used for the queries
+        :param path: Absolute path of the directory on the server
+        :param items: Listing of the directory
+        """
+        
+        filenames = set(item.name for item in items if not item.isdir)
+        dirnames = set(item.name for item in items if item.isdir)
+        
+        files = Directory.childrenFilter(
+                session.query(File).filter(File.inserver == True), path)
+        deleted_files = [file_.path for file_ in files 
+                         if os.path.basename(file_.path) not in filenames]
+        
+        deleted_dirs = [directory.path for directory in
+                        Directory.childrenFilter(session.query(Directory), path)
+                        if os.path.basename(directory.path) not in dirnames]
+        for dirpath in deleted_dirs:
+            files = Directory.childrenFilter(
+                    session.query(File).filter(File.inserver == True), dirpath, True)
+            deleted_files.extend(file_.path for file_ in files)
+        
+        return deleted_files, deleted_dirs
+        
+    def saveDirectory(self, session, path, check_date, fingerprint=None):
+        """
+        Stores the listing fingerprint of the directory `path` in the database.
+        
+        :param session: Database session used to store the directory
+        :param path: Absolute path of the directory on the server
+        :param check_date: Start time of the current scan
+        :param fingerprint: New listing fingerprint, if it changed
+        """
+        
+        directory = session.query(Directory).filter_by(path=path).first()
+        if directory is None:
+            directory = Directory(path)
+            session.add(directory)
+            
+        if fingerprint is not None:
+            directory.fingerprint = fingerprint
+        directory.last_checked_server = check_date
                 
     @Slot()
     def onLogin(self, username, passwd):
-        ok = True
-        msg = ''
-        error_msg = 'Login failed.'
-        try:
-            if not self.ftp:
-                self.ftp = FTP_TLS(self.host) if self.useSSL is True else FTP(self.host)
-            loginResponse = self.ftp.login(username, passwd)
-        except socket.gaierror:
-            self.ftp = None
-            ok = False
-            msg = 'Server address could not be found.' 
-        except (error_perm, error_reply):
-            info = traceback.format_exception(*sys.exc_info())
-            for i in info: sys.stderr.write(i)
-            ok = False
-            msg = error_msg 
-        else:
-            if '230' in loginResponse:
-                ok = True
-            else:
-                ok = False
-                msg = error_msg
+        if not self.ftp:
+            self.ftp = open_transfer(self.host, self.useSSL)
+        msg = self.ftp.connect(username, passwd)
+        ok = msg == ''
         
         if ok:
-            # Logged in. Now let's do compability tests.
-            if not self.testPermissions():
-                # User doesn't have write permissions, don't bother doing next test.
+            # Logged in. Now let's do compability tests, unless this
+            # server already passed them and still advertises the same features.
+            # Servers that don't allow setting timestamps are fine, each
+            # copy is compared against the date it was last in sync at.
+            self.features = self.readFeatures()
+            with ServerCapabilities.fromLogin(self.host, username) as capabilities:
+                if not capabilities.current(self.features):
+                    # A wrong result would hang the control connection,
+                    # it's tested again along with the features.
+                    capabilities.pipelining = None
+                if not capabilities.fresh(self.features):
+                    capabilities.setFeatures(self.features)
+                    capabilities.writable = self.testPermissions()
+                    capabilities.checked = dt.utcnow()
+                if capabilities.pipelining is None:
+                    capabilities.pipelining = self.testPipelining(username, passwd)
+                self.pipelining = capabilities.pipelining
+                writable = capabilities.writable
+            if not writable:
+                # User doesn't have write permissions.
                 ok = False
                 msg = 'It seems like you do not have write access to this server.' 
-            else:
-                # Permissions test passed, now let's test MFMT for timestamp modification.
-                if not self.testMFMT():
-                    ok = False
-                    msg = 'This server does not support timestamp modification\n \
-                           need by this application.'
+
+        if ok:
+            self.useFeatures()
+            
+        if ok and ASYNC_CONNECTIONS > 0 and isinstance(self.ftp, ftp_si) and not self.useSSL:
+            # Connections of the transport log in as soon as they get tasks.
+            if self.transport is None:
+                self.transport = AsyncFTPTransport(self.host, connections=ASYNC_CONNECTIONS)
+                self.transport.mlsdSupported = self.mlsdSupported
+            self.transport.login(username, passwd)
+            
+        if ok and FTP_POOL_SIZE > 0:
+            # Connections in the pool log in by themselves, as soon
+            # as they get their first task.
+            if self.pool is None:
+                self.pool = FTPPool(self.host, self.useSSL, FTP_POOL_SIZE)
+            self.pool.login(username, passwd)
 
         self.loginCompleted.emit(ok, msg)
         
-    def getFiles(self, path):
+    def batch(self, func):
         """
-        This method simply wraps the `nlst` method with an exception handler,
-        and returns an empty list in case an exception is caught.
+        Returns a batch object that runs `func` across the connection pool,
+        or serially on `self.ftp` when there is no pool.
+        See `ftppool.Batch`.
         
-        :param path: Relative or absolute path on the server
+        :param func: Callable that accepts an `ftp` keyword argument
         """
         
-        try:
-            nlst = self.ftp.nlst(path)
-            dirs = self.getDirs(path)
-            
-            # Files are items in nlst that are not in dirs
-            files = [item for item in nlst if os.path.basename(item) not in dirs]
-            
-            return files
-        except:
-            print 'Exception in ServerWatcher.getDirs'
-            info = traceback.format_exception(*sys.exc_info())
-            for i in info: sys.stderr.write(i)
-            return []
-             
-    def getDirs(self, path):
+        if self.pool is not None:
+            return self.pool.batch(func)
+        
+        return SerialBatch(func, self.ftp)
+        
+    def listDir(self, path, ftp=None):
         """
-        Retrieves a list of the directories inside `path`,
-        uses `retrlines` and the LIST command to retrieve the items.
+        Retrieves the contents of the directory `path` with a single
+        data transfer. Uses the MLSD command, which gives type, size and
+        last modified date of every entry, and falls back to LIST
+        on servers that don't support it.
+        Returns a list of `ListItem` objects, or `None` in case
+        an exception is caught.
         
         :param path: Relative or absolute path on the server
+        :param ftp: Connection to be used, defaults to `self.ftp`
         """
         
-        dirs = list()
-        def handleLine(line):
+        if ftp is None:
+            ftp = self.ftp
+            
+        items = list()
+        def handleLine(parse):
             """
-            Recieves a line from the LIST command.
-            This function is meant to be used as callback for the `retrlines` method.
+            Returns a callback for the listing methods that
+            parses the received lines with `parse`.
             
-            :params line: Line from the LIST command
+            :param parse: Function that parses a single listing line
             """
-
-            if line.startswith('d'):
-                # Only lines starting with 'd' are directories
-                # Parse the directory out of the line; lines look like:
-                # 'drwxrwxrwx   1 user     group           0 Jun 15  2012 dirname'
-                dirname = line[55:].strip()
-                if dirname != '.' and dirname != '..':
-                    # Ignoring '.' and '..' entries
-                    dirs.append(dirname)
-        
+            
+            def handle(line):
+                item = parse(line)
+                if item is not None:
+                    items.append(item)
+                    
+            return handle
+            
         try:
-            self.ftp.retrlines('LIST %s' % path, handleLine)
+            if self.mlsdSupported is not False:
+                try:
+                    ftp.listfiles_mlsd(path, handleLine(parse_mlsd_line))
+                    self.mlsdSupported = True
+                    
+                    return items
+                except error_perm as err:
+                    if self.mlsdSupported is True or str(err)[:3] not in ('500', '502', '504'):
+                        raise
+                    # Command not understood, LIST will be used from now on.
+                    self.mlsdSupported = False
+                    
+            ftp.listfiles_ftpdetails(path, handleLine(parse_list_line))
             
-            return dirs
+            return items
+        except (socket.error, EOFError):
+            # Lost connection, let the caller reconnect.
+            raise
         except:
-            print 'Exception in ServerWatcher.getDirs'
+            print 'Exception in ServerWatcher.listDir'
             info = traceback.format_exception(*sys.exc_info())
             for i in info: sys.stderr.write(i)
-            return []
+            return None
+        
+    def getFiles(self, path):
+        """
+        Retrieves a list of the files inside `path`.
+        
+        :param path: Relative or absolute path on the server
+        """
+        
+        return [item.name for item in self.listDir(path) or [] if not item.isdir]
+             
+    def getDirs(self, path):
+        """
+        Retrieves a list of the directories inside `path`.
+        
+        :param path: Relative or absolute path on the server
+        """
+        
+        return [item.name for item in self.listDir(path) or [] if item.isdir]
     
     @upload_test
     def testPermissions(self):
         # For interface purposes. upload_test takes care of everything.
         return True
 
-    @upload_test
-    def testMFMT(self):
-        # Absurd date to test whether the change really happened.
-        time = dt.utcfromtimestamp(100000000)
+    @Slot(str, str)
+    def onMove(self, src, dest):
+        self.moveQueue.append((src, dest))
+        
+    def moveAll(self):
+        for src, dest in self.moveQueue:
+            moved = self.moveFile(src, dest)
+            self.transferFinished.emit(dest, moved)
+            
+        self.moveQueue = []
+        
+    def moveFile(self, src, dest, ftp=None):
+        """
+        Moves the file or directory `src` to `dest` on the server
+        with the RNFR and RNTO commands, creating the needed directories.
+        Returns `True` if the move succeeded.
+        
+        :param src: Absolute path to the file or directory
+        :param dest: Absolute path it is moved to
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
         try:
-            self.setLastModified(self.testFile, time)
-            otherTime = self.lastModified(self.testFile)
-            diff = (time - otherTime).total_seconds()
-            if abs(diff) < 2:
-                # Let's give it a 2 seconds tolerance.
-                mdtm = True
-            else:
-                mdtm = False
-        except (ValueError, error_reply, error_perm):
-            info = traceback.format_exception(*sys.exc_info())
-            for i in info: sys.stderr.write(i)
-            mdtm = False
+            print 'Moving %s to %s' % (src, dest)
+            self.mkpath(os.path.dirname(dest), ftp)
+            ftp.rename(src, dest)
+            # Moved directories take their subdirectories along.
+            for path in [path for path in self.knownDirs 
+                         if path == src or path.startswith(src + '/')]:
+                self.knownDirs.discard(path)
+                self.knownDirs.add(dest + path[len(src):])
+            return True
+        except (error_reply, error_perm) as ftperr:
+            print 'Error moving %s, %s' % (src, ftperr)
+            return False
         
-        return mdtm
-
     @Slot(str)
     def onDelete(self, filename):
         self.deleteQueue.append(filename)
@@ -495,22 +669,34 @@ class ServerWatcher(Watcher):
             self.deleteFile(next)
     
     def deleteAll(self):
+        if self.transport is not None:
+            deletes = self.transport.batch(self.transport.delete)
+        else:
+            deletes = self.batch(self.deleteFile)
         for filename in self.deleteQueue:
-            self.deleteFile(filename)
+            deletes.put(filename)
+            
+        # Waits for all the deletes to finish.
+        for (filename,), deleted in deletes:
+            self.transferFinished.emit(filename, bool(deleted))
             
         self.deleteQueue = []
     
     @Slot(str)
-    def deleteFile(self, filename):
+    def deleteFile(self, filename, ftp=None):
         """
         Deletes the file `filename` to the server
         
         :param filename: Absolute or relative path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
         """
         
+        if ftp is None:
+            ftp = self.ftp
+        
         try:
             print 'Deleting %s' % filename
-            self.ftp.delete(filename)
+            ftp.deleteFile(filename)
             return True
         except (error_reply, error_perm):
             print 'Error deleting %s' % filename
@@ -528,8 +714,167 @@ class ServerWatcher(Watcher):
             self.downloadFile(next)
             
     def downloadAll(self):
+        """
+        Downloads every file in `self.downloadQueue`, the transfers
+        are spread across the connection pool.
+        """
+        
+        downloads = self.batch(self.retrieveFile)
+        segments = self.batch(self.retrieveSegment)
+        # Maps segmented downloads to their size and
+        # the number of segments not yet completed.
+        segmented = dict()
+        # Sizes from the last scan, no need to ask the server.
+        sizes = File.sizes(self.downloadQueue)
+        unknown = [filename for filename in self.downloadQueue if filename not in sizes]
+        if len(unknown) > 0 and (self.pool is not None or self.transport is not None):
+            sizes.update(self.remoteSizes(unknown))
+        self.checkPartials(self.downloadQueue)
+        if self.transport is not None:
+            self.downloadAsync(sizes)
+            return
+        
+        for filename in self.downloadQueue:
+            size = sizes.get(filename)
+            # Byte ranges can't be asked for in MODE Z.
+            if self.pool is not None and size >= SEGMENTED_DOWNLOAD_SIZE and \
+               not self.compressTransfer(filename, size):
+                segmented[filename] = self.startSegmentedDownload(filename, size, segments)
+            else:
+                downloads.put(filename, None, size)
+            
+        for (filename, localpath, size), mdate in downloads:
+            if mdate is not None:
+                self.downloadCompleted(filename, mdate)
+            self.transferFinished.emit(filename, mdate is not None)
+                
+        failed = list()
+        for (filename, partpath, start, length), ok in segments:
+            status = segmented[filename]
+            status['pending'] -= 1
+            if not ok:
+                status['failed'] = True
+            if status['pending'] > 0:
+                continue
+            
+            del self.segmentStatus[filename]
+            if status['failed']:
+                failed.append(filename)
+                try:
+                    os.remove(partpath)
+                except OSError:
+                    pass
+            else:
+                localpath = self.localFromServer(filename)
+                try:
+                    mdate = self.finishDownload(filename, partpath, localpath)
+                except (IOError, OSError):
+                    mdate = None
+                    self.ioError.emit(localpath)
+                if mdate is not None:
+                    self.downloadCompleted(filename, mdate)
+                self.transferFinished.emit(filename, mdate is not None)
+            self.fileEventCompleted.emit()
+                
+        # Segmented downloads that failed get a second chance
+        # as regular downloads.
+        downloads = self.batch(self.retrieveFile)
+        for filename in failed:
+            downloads.put(filename, None, segmented[filename]['size'])
+            
+        for (filename, localpath, size), mdate in downloads:
+            if mdate is not None:
+                self.downloadCompleted(filename, mdate)
+            self.transferFinished.emit(filename, mdate is not None)
+            
+        self.downloadQueue = []
+    
+    def checkPartials(self, filenames):
+        """
+        Removes the partial files left by downloads of other versions of
+        `filenames` and by their segmented downloads, and records the server
+        copies last listed as the ones their partial files come from.
+        
+        :param filenames: Absolute paths to the files on the server
+        """
+        
+        session = Session()
+        listed = set()
+        for i in range(0, len(filenames), 100):
+            for file_ in session.query(File).filter(File.path.in_(filenames[i:i + 100])):
+                listed.add(file_.path)
+                version = (file_.serversize, file_.servermdate)
+                if file_.servermdate is None or (file_.partialsize, file_.partialmdate) != version:
+                    self.removePartial(file_.path)
+                file_.partialsize, file_.partialmdate = version
+        session.commit()
+        
+        for filename in filenames:
+            if filename not in listed:
+                # Nothing tells which version it is.
+                self.removePartial(filename)
+            # Left by a segmented download that was interrupted.
+            self.removePartial(filename, engine_tools.SEGMENTS_SUFFIX)
+        
+    def removePartial(self, filename, suffix=engine_tools.PARTIAL_SUFFIX):
+        """
+        Removes the partial file of the download of `filename`, if any.
+        
+        :param filename: Absolute path to the file on the server
+        :param suffix: Suffix of the partial file, `SEGMENTS_SUFFIX` for segmented downloads
+        """
+        
+        partpath = self.localFromServer(filename) + suffix
+        try:
+            os.remove(partpath)
+            print 'Removed the stale partial download of %s' % filename
+        except OSError:
+            pass
+        
+    def downloadAsync(self, sizes):
+        """
+        Downloads every file in `self.downloadQueue` through `self.transport`,
+        all the transfers run on its event loop. Partial files are resumed
+        the way `retrieveFile` does.
+        
+        :param sizes: Dict that maps the files to their size on the server
+        """
+        
+        downloads = self.transport.batch(self.transport.retrieve)
         for filename in self.downloadQueue:
-            self.downloadFile(filename)
+            localpath = self.localFromServer(filename)
+            localdir = os.path.dirname(localpath)
+            if not os.path.exists(localdir):
+                os.makedirs(localdir)
+                
+            partpath = localpath + engine_tools.PARTIAL_SUFFIX
+            offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+            if sizes.get(filename) is None or offset > sizes[filename]:
+                offset = 0
+            print 'Downloading: %s to %s' % (filename, localpath)
+            self.fileEvent.emit(filename)
+            downloads.put(filename, partpath, offset)
+            
+        for (filename, partpath, offset), received in downloads:
+            mdate = None
+            if received is not None and received == sizes.get(filename, received):
+                localpath = self.localFromServer(filename)
+                self.downloadProgress.emit(received, received)
+                try:
+                    mdate = self.finishDownload(filename, partpath, localpath)
+                except OSError:
+                    self.ioError.emit(localpath)
+            elif received is not None:
+                # Changed since it was listed, the next attempt starts over.
+                print 'Incomplete download of %s, got %d bytes' % (filename, received)
+                try:
+                    os.remove(partpath)
+                except OSError:
+                    pass
+            if mdate is not None:
+                self.downloadCompleted(filename, mdate)
+            self.transferFinished.emit(filename, mdate is not None)
+            self.fileEventCompleted.emit()
             
         self.downloadQueue = []
     
@@ -544,18 +889,43 @@ class ServerWatcher(Watcher):
         :param localpath: Absolute local path where the file will be saved
         """
         
+        mdate = self.retrieveFile(filename, localpath)
+        if mdate is not None:
+            self.downloadCompleted(filename, mdate)
+            
+        return mdate is not None
+    
+    def retrieveFile(self, filename, localpath=None, size=None, ftp=None):
+        """
+        Transfer part of `downloadFile`, it doesn't touch the database
+        so it can be run by the connection pool workers.
+        Returns the last modified date of the downloaded local file,
+        or `None` if the download failed.
+        
+        :param filename: Relative or absolute path to the file
+        :param localpath: Absolute local path where the file will be saved
+        :param size: Size of the file as last listed, asked to the server if `None`
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        # Download status is kept here, several downloads
+        # can be running at the same time.
+        status = {'size': 0, 'progress': 0}
         def handleChunk(chunk):
             """
             Receives chuncks of data downloaded from the server.
-            This function is meant to be used as callback for the `retrbinary` method.
+            This function is meant to be used as callback for the `downloadFile` method.
             
             :params chunk: Chunk of downloaded bytes to be written into the file
             """
         
-            # Simply writes the received data into the file `self.downloading`
-            self.downloading.write(chunk)
-            self.download_progress += len(chunk)
-            self.downloadProgress.emit(self.download_size, self.download_progress)
+            # Simply writes the received data into the partial file `status['file']`
+            status['file'].write(chunk)
+            status['progress'] += len(chunk)
+            self.downloadProgress.emit(status['size'], status['progress'])
         
         if localpath is None:
             localpath = self.localFromServer(filename)
@@ -565,41 +935,189 @@ class ServerWatcher(Watcher):
             # Creates the directory if it doesn't already exists.
             os.makedirs(localdir)
         
+        # The download is staged in `partpath`, the user's copy at `localpath`
+        # is only replaced once the download is complete. If a previous
+        # attempt left a partial file behind, the download resumes from its end.
+        partpath = localpath + engine_tools.PARTIAL_SUFFIX
+        
         print 'Downloading: %s to %s' % (filename, localpath) 
         try:
-            with open(localpath, 'wb') as f:
-                # Opens the file at `localname` which will hold the downloaded file.
-                # Object attributes regarding download status are updated accordingly.
-                self.fileEvent.emit(filename)
-                self.downloading = f
-                self.download_progress = 0
-
-                self.download_size = int(self.ftp.sendcmd('SIZE %s' % filename).split(' ')[-1])
-                self.ftp.retrbinary('RETR %s' % filename, handleChunk)
-                
-                print 'Download finished'
+            self.fileEvent.emit(filename)
+            status['size'] = size if size is not None else self.remoteSize(filename, ftp)
+            # MODE Z doesn't allow REST, compressed downloads start over.
+            compressed = self.compressTransfer(filename, status['size'])
+            
+            offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+            if offset > status['size'] or compressed:
+                # Leftover of a different version of the file.
+                offset = 0
+            
+            if offset > 0:
+                print 'Resuming download of %s at %d bytes' % (filename, offset)
+                with open(partpath, 'ab') as f:
+                    status['file'] = f
+                    status['progress'] = offset
+                    try:
+                        ftp.downloadFile(filename, handleChunk, rest=offset)
+                    except error_perm:
+                        # REST is not supported, start over.
+                        offset = 0
                 
-                # Let's set the same modified time to that on the server.
-                with File.fromPath(filename) as downloadedfile:
-                    mdate = LocalWatcher.lastModified(localpath)
-                    downloadedfile.localmdate = mdate
-                    downloadedfile.servermdate = mdate
-                    
-                self.setLastModified(filename, mdate)
-
-                downloaded = True
+            if offset == 0:
+                with open(partpath, 'wb') as f:
+                    status['file'] = f
+                    status['progress'] = 0
+                    ftp.downloadFile(filename, handleChunk, compressed=compressed)
+            
+            if os.path.getsize(partpath) != status['size'] and size is not None:
+                # The file could have changed since it was listed.
+                status['size'] = self.remoteSize(filename, ftp)
+            if os.path.getsize(partpath) != status['size']:
+                # Treated like a lost connection, the partial
+                # file is kept and the next attempt resumes it.
+                raise EOFError('Incomplete download, got %d of %d bytes' % (
+                                os.path.getsize(partpath), status['size']))
+            
+            mdate = self.finishDownload(filename, partpath, localpath, ftp)
+        except (socket.error, EOFError):
+            # Lost connection, let the caller reconnect.
+            raise
         except (IOError, OSError):
-            downloaded = False
+            mdate = None
             self.ioError.emit(localpath)
         except (error_reply, error_perm) as ftperr:
             print 'Error downloading %s, %s' % (filename, ftperr)
-            downloaded = False
+            mdate = None
         
         # TODO: Sometimes the file doesn't complete properly.
         # in that case we maybe shouldn't call this?
         self.fileEventCompleted.emit()
         
-        return downloaded
+        return mdate
+    
+    def finishDownload(self, filename, partpath, localpath, ftp=None):
+        """
+        Moves the completed download `partpath` into place.
+        Returns the last modified date of the local file.
+        
+        :param filename: Absolute path to the file on the server
+        :param partpath: Absolute local path of the completed partial file
+        :param localpath: Absolute local path where the file will be saved
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if platform.system() == 'Windows' and os.path.exists(localpath):
+            # `os.rename` can't replace files on Windows.
+            os.remove(localpath)
+        os.rename(partpath, localpath)
+        # The local watcher must not take the new file for a user's change.
+        self.echoes.expect(localpath, Debouncer.stat(localpath))
+            
+        print 'Download finished'
+        
+        return LocalWatcher.lastModified(localpath)
+        
+    def startSegmentedDownload(self, filename, size, segments):
+        """
+        Preallocates the partial file for `filename` and puts one byte range
+        per pool connection into the `segments` batch.
+        Returns the status of the download, shared by all its segments.
+        
+        :param filename: Absolute path to the file on the server
+        :param size: Size of the file on the server
+        :param segments: Batch running `retrieveSegment`
+        """
+        
+        localpath = self.localFromServer(filename)
+        localdir = os.path.dirname(localpath)
+        if not os.path.exists(localdir):
+            # Creates the directory if it doesn't already exists.
+            os.makedirs(localdir)
+            
+        # Different from the partial file used by regular downloads, this
+        # one has the final size from the beginning so it can't be resumed.
+        partpath = localpath + engine_tools.SEGMENTS_SUFFIX
+        with open(partpath, 'wb') as f:
+            f.truncate(size)
+            
+        print 'Downloading: %s to %s in %d segments' % (filename, localpath, self.pool.size)
+        self.fileEvent.emit(filename)
+        
+        # Set before the segments are put, the workers take them right away.
+        status = {'size': size, 'progress': 0, 'pending': 0, 'failed': False}
+        self.segmentStatus[filename] = status
+        length = size / self.pool.size + 1
+        for start in range(0, size, length):
+            status['pending'] += 1
+            segments.put(filename, partpath, start, min(length, size - start))
+        
+        return status
+        
+    def retrieveSegment(self, filename, partpath, start, length, ftp=None):
+        """
+        Downloads `length` bytes of `filename` starting at `start`, and writes
+        them at the same offset of the preallocated file `partpath`.
+        Returns `True` if the whole byte range was written.
+        
+        :param filename: Absolute path to the file on the server
+        :param partpath: Absolute local path of the preallocated partial file
+        :param start: Offset of the byte range
+        :param length: Size of the byte range
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        status = self.segmentStatus[filename]
+        received = [0]
+        try:
+            with open(partpath, 'r+b') as f:
+                f.seek(start)
+                def handleChunk(chunk):
+                    f.write(chunk)
+                    received[0] += len(chunk)
+                    status['progress'] += len(chunk)
+                    self.downloadProgress.emit(status['size'], status['progress'])
+                    
+                ftp.downloadFile(filename, handleChunk, rest=start, length=length)
+        except (socket.error, EOFError):
+            # Lost connection, let the caller reconnect. The
+            # whole segment is downloaded again.
+            status['progress'] -= received[0]
+            raise
+        except (IOError, OSError):
+            self.ioError.emit(partpath)
+            return False
+        except (error_reply, error_perm) as ftperr:
+            print 'Error downloading %s, %s' % (filename, ftperr)
+            return False
+            
+        if received[0] < length:
+            # Treated like a lost connection, the segment is downloaded again.
+            status['progress'] -= received[0]
+            raise EOFError('Incomplete segment of %s at %d' % (filename, start))
+            
+        return True
+    
+    def downloadCompleted(self, filename, mdate):
+        """
+        Database bookkeeping after a successful download.
+        
+        :param filename: Absolute path to the file on the server
+        :param mdate: Last modified date of the downloaded local file
+        """
+        
+        with File.fromPath(filename) as downloadedfile:
+            # The server copy keeps its date, the one it was listed with.
+            downloadedfile.localmdate = mdate
+            downloadedfile.markSynced()
+            try:
+                size = os.path.getsize(self.localFromServer(filename))
+            except OSError:
+                size = downloadedfile.serversize
+            downloadedfile.localsize = size
+            downloadedfile.serversize = size
     
     @Slot(str)
     def onUpload(self, filename):
@@ -611,11 +1129,100 @@ class ServerWatcher(Watcher):
             self.uploadFile(next)
             
     def uploadAll(self):
+        """
+        Uploads every file in `self.uploadQueue`, the transfers
+        are spread across the connection pool.
+        """
+        
+        # Partial uploads from before a restart.
+        self.partialUploads.update(File.partialUploads(self.uploadQueue))
+        if self.transport is not None:
+            self.uploadAsync()
+            return
+        
+        uploads = self.batch(self.storeFile)
         for filename in self.uploadQueue:
-            self.uploadFile(filename)
+            uploads.put(filename)
+            
+        for (filename,), sent in uploads:
+            if sent is not None:
+                self.uploadCompleted(filename, *sent)
+            self.transferFinished.emit(filename, sent is not None)
             
         self.uploadQueue = []
             
+    def uploadAsync(self):
+        """
+        Uploads every file in `self.uploadQueue` through `self.transport`,
+        all the transfers run on its event loop. Interrupted uploads
+        are resumed and checked the way `storeFile` does.
+        """
+        
+        uploads = self.transport.batch(self.transport.store)
+        # Stat results of the local files when they were queued.
+        stats = dict()
+        for filename in self.uploadQueue:
+            localpath = self.localFromServer(filename)
+            try:
+                stats[filename] = os.stat(localpath)
+                self.mkpath(os.path.dirname(filename))
+                identity = (stats[filename].st_size, stats[filename].st_mtime)
+                offset, partial = self.resumeOffset(filename, identity, self.transport)
+            except OSError:
+                self.ioError.emit(localpath)
+                self.transferFinished.emit(filename, False)
+                continue
+            except EOFError:
+                self.transferFinished.emit(filename, False)
+                continue
+            print 'Uploading %s to %s' % (localpath, filename)
+            if offset > 0:
+                print 'Resuming upload of %s at %d bytes' % (filename, offset)
+            self.fileEvent.emit(localpath)
+            uploads.put(filename, localpath, offset, self.partialRecorder(filename, partial))
+            
+        for (filename, localpath, offset, recorder), sent in uploads:
+            stat = stats[filename]
+            uploaded = False
+            if sent == stat.st_size:
+                try:
+                    self.verifyUpload(filename, sent, self.transport)
+                    uploaded = True
+                except (error_reply, error_perm, error_temp, EOFError, ValueError) as err:
+                    print 'Error uploading %s, %s' % (filename, err)
+            elif sent is None and offset > 0:
+                # REST could be what failed, the next attempt starts over.
+                self.partialUploads.pop(filename, None)
+                File.recordPartialUpload(filename, None)
+            if uploaded:
+                print 'Upload finished'
+                self.uploadProgress.emit(sent, sent)
+                self.uploadCompleted(filename, dt.utcfromtimestamp(stat.st_mtime), sent)
+            elif self.knownDirs is not None:
+                # The directory could be gone, `mkpath` checks again next time.
+                self.knownDirs.discard(os.path.dirname(filename))
+            self.transferFinished.emit(filename, uploaded)
+            self.fileEventCompleted.emit()
+            
+        self.uploadQueue = []
+        
+    def partialRecorder(self, filename, partial):
+        """
+        Returns a callback for the blocks sent by an upload of `filename`,
+        it records `partial` in `self.partialUploads` and in the database
+        once the data starts reaching the server.
+        
+        :param filename: Absolute or relative path to the file
+        :param partial: Entry of `self.partialUploads` returned by `resumeOffset`
+        """
+        
+        def record(block):
+            if self.partialUploads.get(filename) != partial:
+                self.partialUploads[filename] = partial
+                File.recordPartialUpload(filename, partial)
+        
+        return record
+        
     @Slot(str)
     def uploadFile(self, filename):
         """
@@ -625,52 +1232,370 @@ class ServerWatcher(Watcher):
         :param filename: Absolute or relative path to the file
         """
         
+        self.partialUploads.update(File.partialUploads([filename]))
+        sent = self.storeFile(filename)
+        if sent is not None:
+            self.uploadCompleted(filename, *sent)
+            
+        return sent is not None
+        
+    def storeFile(self, filename, ftp=None):
+        """
+        Transfer part of `uploadFile`, it doesn't touch the database but
+        to record partial uploads, so it can be run by the connection pool
+        workers. Returns the last modified date and the size of the local file
+        that was sent, or `None` if the upload failed.
+        
+        :param filename: Absolute or relative path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+        
+        # Upload status is kept here, several uploads
+        # can be running at the same time.
+        status = {'size': 0, 'progress': 0, 'partial': None}
         def handle(buf):
-            """This function is meant to be used as callback for the `storbinary` method."""
+            """This function is meant to be used as callback for the `uploadFile` method."""
         
-            self.upload_progress += 1024
-            self.uploadProgress.emit(self.upload_size, self.upload_progress)
+            if status['partial'] is not None:
+                # The server accepted the transfer, from now on its
+                # copy can be the beginning of the local file.
+                self.partialUploads[filename] = status['partial']
+                File.recordPartialUpload(filename, status['partial'])
+                status['partial'] = None
+            status['progress'] += len(buf)
+            self.uploadProgress.emit(status['size'], status['progress'])
         
         
         # Creates the directory where the file will be uploaded to
-        self.mkpath(os.path.dirname(filename))
+        self.mkpath(os.path.dirname(filename), ftp)
         
         localpath = self.localFromServer(filename)
         print 'Uploading %s to %s' % (localpath, filename)
         
         try:
-            # Uploads file and updates its modified date in the server
-            # to match the date in the local filesystem.
-            self.upload_progress = 0
-            self.upload_size = os.path.getsize(localpath)
+            # Uploads file, the date it had is what the server
+            # copy is in sync with.
+            stat = os.stat(localpath)
+            identity = (stat.st_size, stat.st_mtime)
+            status['size'] = stat.st_size
             self.fileEvent.emit(localpath)
-            self.ftp.storbinary('STOR %s' % filename,
-                                open(localpath, 'rb'), 
-                                1024,
-                                handle)
+            
+            # If a previous upload of this same local file was interrupted,
+            # the server keeps what it got so far and the upload continues
+            # from there.
+            # MODE Z doesn't allow REST, compressed uploads start over.
+            compressed = self.compressTransfer(filename, stat.st_size)
+            offset = 0
+            if not compressed:
+                offset, status['partial'] = self.resumeOffset(filename, identity, ftp)
+            
+            with open(localpath, 'rb') as f:
+                if offset == status['size']:
+                    print 'Upload of %s was already complete' % filename
+                elif offset > 0:
+                    print 'Resuming upload of %s at %d bytes' % (filename, offset)
+                    f.seek(offset)
+                    status['progress'] = offset
+                    self.resumeUpload(filename, f, offset, handle, ftp)
+                else:
+                    ftp.uploadFile(filename, f, handle, compressed=compressed)
+                    
+            self.verifyUpload(filename, status['size'], ftp)
             print 'Upload finished'
-            with File.fromPath(filename) as uploaded:
-                modified = uploaded.localmdate
-                uploaded.servermdate = modified
-                
-                self.setLastModified(filename, modified)
             
-            uploaded = True
+            sent = dt.utcfromtimestamp(stat.st_mtime), status['size']
 
+        except (socket.error, EOFError):
+            # Lost connection, let the caller reconnect.
+            raise
         except (IOError, OSError):
-            uploaded = False
+            sent = None
             self.ioError.emit(localpath)
-        except (error_reply, error_perm, OSError) as err:
+        except (error_reply, error_perm) as err:
             print 'Error uploading %s, %s' % (filename, err)
-            uploaded = False
+            sent = None
+            # The directory could be gone, `mkpath` checks again next time.
+            if self.knownDirs is not None:
+                self.knownDirs.discard(os.path.dirname(filename))
             
         # TODO: Sometimes the file doesn't complete properly.
         # in that case we maybe shouldn't call this?            
         self.fileEventCompleted.emit()
         
-        return uploaded
+        return sent
+    
+    def remoteVersion(self, filename, ftp=None):
+        """
+        Returns the size and last modified date of `filename` on
+        the server, `None` if it's not there.
+        
+        :param filename: Relative or absolute path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        try:
+            return self.remoteSize(filename, ftp), self.lastModified(filename, ftp)
+        except (error_reply, error_perm, ValueError):
+            return None
+            
+    def resumeOffset(self, filename, identity, ftp=None):
+        """
+        Returns the offset the upload of `filename` starts from, see
+        `uploadOffset`, and the entry to put in `self.partialUploads`
+        once its data starts reaching the server.
+        
+        :param filename: Absolute or relative path to the file
+        :param identity: Size and mtime of the local file
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        partial = self.partialUploads.get(filename)
+        version = self.remoteVersion(filename, ftp)
+        offset = self.uploadOffset(identity, partial, version)
+        # What the server had before this file was sent, to tell
+        # it apart from a partial upload if this attempt fails.
+        return offset, (identity, partial[1] if offset > 0 else version)
+        
+    def verifyUpload(self, filename, size, ftp=None):
+        """
+        Checks that the server copy of `filename` has the `size` bytes sent.
+        Raises `EOFError` if it doesn't, treated like a lost connection
+        the next attempt resumes the upload.
+        
+        :param filename: Absolute or relative path to the file
+        :param size: Size of the local file that was sent
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        remotesize = self.remoteSize(filename, ftp)
+        if remotesize != size:
+            raise EOFError('Incomplete upload, server has %d of %d bytes' % (remotesize, size))
+        self.partialUploads.pop(filename, None)
+            
+    @staticmethod
+    def uploadOffset(identity, partial, version):
+        """
+        Returns the offset an upload continues from, zero if it starts over.
+        It only resumes when the data of a previous attempt to send the same
+        local file reached the server, and the server copy is not the one
+        that was there before that attempt.
+        
+        :param identity: Size and mtime of the local file
+        :param partial: Entry of `self.partialUploads` for the file, if any
+        :param version: Size and last modified date of the server copy, if any
+        """
+        
+        if partial is None or partial[0] != identity or version is None:
+            return 0
+        if version == partial[1] or version[0] > identity[0]:
+            # Still the old copy, or not a part of this file.
+            return 0
+        
+        return version[0]
+        
+    def resumeUpload(self, filename, f, offset, callback, ftp=None):
+        """
+        Sends the rest of the file object `f` from `offset`, using REST + STOR
+        or APPE when the server doesn't support REST for uploads.
+        
+        :param filename: Absolute or relative path to the file on the server
+        :param f: File object already positioned at `offset`
+        :param offset: Number of bytes the server already has
+        :param callback: Progress callback for the `uploadFile` method
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        if self.restUploads is not False:
+            try:
+                ftp.uploadFile(filename, f, callback, rest=offset)
+                self.restUploads = True
+                return
+            except error_perm:
+                if self.restUploads is True:
+                    raise
+                # REST not accepted before STOR, APPE will be used from now on.
+                self.restUploads = False
+                f.seek(offset)
+                
+        ftp.appendFile(filename, f, callback)
+        
+    def remoteSize(self, filename, ftp=None):
+        """
+        Uses the SIZE FTP command to find the size in bytes of `filename`.
+        Switches to binary mode first, some servers refuse SIZE in ASCII mode.
+        
+        :param filename: Relative or absolute path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        return ftp.fileSize(filename)
+    
+    def readFeatures(self, ftp=None):
+        """
+        Uses the FEAT FTP command to find the extensions supported by
+        the server. Returns a dict that maps the extensions to their
+        parameters, empty if the server doesn't support FEAT.
+        
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        return ftp.features()
+    
+    def testPipelining(self, username, passwd):
+        """
+        Tells whether the server handles pipelined commands, tested on a
+        connection of its own since a failed test leaves it unusable.
+        
+        :param username: Username to log in into the FTP server
+        :param passwd: Password to log in into the FTP server
+        """
+        
+        ftp = open_transfer(self.host, self.useSSL)
+        try:
+            ftp.login(username, passwd)
+            return ftp.supportsPipelining()
+        except (socket.error, EOFError, error_reply, error_perm, error_temp):
+            return False
+        finally:
+            ftp.close()
+        
+    def lastModifiedAll(self, filenames, ftp=None):
+        """
+        Batched `lastModified`. Returns a dict that maps the filenames
+        to their last modified dates, the ones MDTM failed for are left out.
+        
+        :param filenames: Relative or absolute paths to the files
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        # Pipelined when the server allows it.
+        return ftp.lastModifiedAll(filenames, self.pipelining)
+    
+    def remoteSizes(self, filenames, ftp=None):
+        """
+        Batched `remoteSize`. Returns a dict that maps the filenames
+        to their sizes, the ones SIZE failed for are left out.
+        
+        :param filenames: Relative or absolute paths to the files
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        return ftp.fileSizes(filenames, self.pipelining)
+        
+    def useFeatures(self):
+        """
+        Skips the detection of commands `self.features` already tells
+        whether the server supports.
+        """
+        
+        if 'MLST' in self.features and self.mlsdSupported is None:
+            # MLSD comes with MLST, see RFC 3659.
+            self.mlsdSupported = True
+        
+    def compressTransfer(self, filename, size):
+        """
+        Tells whether `filename` is transferred with MODE Z, when the server
+        supports it and its contents are worth compressing, as told by
+        the extension or a sample of the local copy.
+        
+        :param filename: Absolute path to the file on the server
+        :param size: Size of the file in bytes, `None` if not known
+        """
+        
+        if not TRANSFER_COMPRESSION or 'Z' not in self.features.get('MODE', '').upper().split():
+            return False
+        
+        localpath = self.localFromServer(filename)
+        
+        return worth_compressing(filename, size, localpath if os.path.isfile(localpath) else None)
+        
+    def hashAlgorithm(self):
+        """
+        Returns a `(command, algorithm)` tuple with the command used to get
+        digests of the files on the server and the algorithm it uses,
+        `None` if the server advertises none of them.
+        """
+        
+        if 'HASH' in self.features:
+            # Looks like 'SHA-256;SHA-1*;MD5', '*' marks the selected one.
+            algorithms = self.features['HASH'].upper().split(';')
+            selected = [name for name in algorithms if name.endswith('*')]
+            algorithm = (selected or algorithms)[0].rstrip('*')
+            if algorithm in DIGEST_LENGTHS:
+                return 'HASH', algorithm
+            
+        for command, algorithm in (('XSHA1', 'SHA-1'), ('XMD5', 'MD5'), ('XCRC', 'CRC32')):
+            if command in self.features:
+                return command, algorithm
+            
+        return None
+    
+    def remoteHash(self, filename, ftp=None):
+        """
+        Asks the server for the digest of `filename`. Returns an
+        `(algorithm, digest)` tuple, `None` if the server can't tell.
+        
+        :param filename: Relative or absolute path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
+        """
+        
+        if ftp is None:
+            ftp = self.ftp
             
-    def lastModified(self, filename):
+        command = self.hashAlgorithm()
+        if command is None:
+            return None
+        command, algorithm = command
+        
+        try:
+            digest = ftp.fileHash(filename, command, algorithm)
+        except (error_reply, error_perm, error_temp) as ftperr:
+            print 'Error getting the digest of %s, %s' % (filename, ftperr)
+            return None
+        
+        if digest is None:
+            return None
+        
+        return algorithm, digest
+        
+    def uploadCompleted(self, filename, modified, size):
+        """
+        Database bookkeeping after a successful upload.
+        
+        :param filename: Absolute path to the file on the server
+        :param modified: Last modified date of the local file that was sent
+        :param size: Number of bytes sent
+        """
+        
+        with File.fromPath(filename) as uploaded:
+            uploaded.servermdate = modified
+            uploaded.serversize = size
+            uploaded.synced_localmdate = modified
+            # Set by the next scan, the server decided the date.
+            uploaded.synced_servermdate = None
+            # Nothing left to resume.
+            uploaded.uploadsize = uploaded.uploadmtime = None
+            uploaded.uploadbasesize = uploaded.uploadbasemdate = None
+            
+    def lastModified(self, filename, ftp=None):
         """
         Uses the MDTM FTP command to find the last modified timestamp
         of the file `filename`.
@@ -678,92 +1603,76 @@ class ServerWatcher(Watcher):
         last modified date and time.
         
         :param filename: Relative or absolute path to the file
+        :param ftp: Connection to be used, defaults to `self.ftp`
         """
         
-        timestamp = self.ftp.sendcmd('MDTM %s' % filename)
-        if '213 ' not in timestamp:
-            # Second chance was found to be needed in some cases.
-            timestamp = self.ftp.sendcmd('MDTM %s' % filename)
+        if ftp is None:
+            ftp = self.ftp
             
-        timestamp = timestamp.split(' ')[-1]
-        dateformat = '%Y%m%d%H%M%S.%f' if '.' in timestamp else '%Y%m%d%H%M%S'
-        
-        try:
-            mtime = dt.strptime(timestamp, dateformat)
-        except ValueError:
-            mtime = dt.utcnow()
-
-        return mtime
+        return ftp.lastModified(filename)
 
-    def setLastModified(self, serverpath, newtime):
+    def setLastModified(self, serverpath, newtime, ftp=None):
         """
         Uses the MFMT or MDTM FTP commands to set `newtime` as the modified timestamp of the
         file `serverpath` on the server. 
 
         :param serverpath: Relative or absolute path to the file
         :param newtime: datedatime object holding the required time
+        :param ftp: Connection to be used, defaults to `self.ftp`
         """
-        cmds = ['MFMT', 'MDTM']
-        for cmd in cmds:
-            try:
-                self.ftp.sendcmd(
-                        '%s %s %s' % (cmd, newtime.strftime('%Y%m%d%H%M%S'), serverpath))
-                return
-            except (error_perm, error_reply) as e:
-                if cmd == cmds[len(cmds) - 1]:
-                    # If is the last comand, re-raise the exception, else
-                    # keep trying.
-                    raise e
-                else:
-                    continue
+        
+        if ftp is None:
+            ftp = self.ftp
+            
+        ftp.setLastModified(serverpath, newtime)
     
-    def mkpath(self, path):
+    def mkpath(self, path, ftp=None):
         """
         Creates the path `path` on the server by recursively 
-        created folders, if needed.
+        created folders, if needed. Only the folders below the
+        deepest one in `self.knownDirs` are created.
         
         :param path: Absolute path on the server to be created
+        :param ftp: Connection to be used, defaults to `self.ftp`
         """
         
-        try:
-            self.ftp.cwd(path)
-        except error_perm:
-            # `cwd` call failed. Need to create some folders
-            make_dir = '/' 
-            steps = path.split('/')
-            for step in steps:
-                if len(step) == 0:
-                    continue
-                make_dir += '%s/' % step
-                try:
-                    self.ftp.mkd(make_dir)
-                except error_perm:
-                    # Probably already exists
-                    continue
-        else:
-            # `cwd` call succeed. No need to create
-            # any folders
-            self.ftp.cwd('/')
-            return
+        if ftp is None:
+            ftp = self.ftp
+            
+        if self.knownDirs is None:
+            self.knownDirs = set(['/'])
+        steps = [step for step in path.split('/') if len(step) > 0]
+        known = len(steps)
+        while known > 0 and '/' + '/'.join(steps[:known]) not in self.knownDirs:
+            known -= 1
+            
+        make_dir = '/' + '/'.join(steps[:known])
+        for step in steps[known:]:
+            make_dir = make_dir.rstrip('/') + '/' + step
+            try:
+                ftp.makeDir(make_dir)
+            except error_perm:
+                # Probably already exists
+                pass
+            self.knownDirs.add(make_dir)
             
     @Slot(str, str)
     def added(self, location, serverpath):
         super(ServerWatcher, self).added(location, serverpath)
         
         def actionFromPath(serverpath):
-            f = File()
-            fileExistsOnServer = True
-            try:    
-                f.servermdate = self.lastModified(serverpath)
-            except error_perm:
-                fileExistsOnServer = False
-                f.servermdate = 0
+            # The server has been scanned first, its row
+            # has the date and size from the listing.
+            f = Session().query(File).filter(File.path == serverpath).first()
+            if f is None or not f.inserver:
+                return FileAction(serverpath, FileAction.UPLOAD, ServerWatcher.LOCATION)
             
-            f.localmdate = LocalWatcher.lastModified(self.localFromServer(serverpath))
-            diff = f.timeDiff()
+            localpath = self.localFromServer(serverpath)
+            diff = (LocalWatcher.lastModified(localpath) - f.servermdate).total_seconds()
+            resized = f.serversize is not None and f.serversize != os.path.getsize(localpath)
             action = None
-            if abs(diff) > Watcher.TOLERANCE:
-                if not fileExistsOnServer or diff > 0:
+            if abs(diff) > Watcher.TOLERANCE or resized:
+                if diff > 0:
                     action = FileAction(serverpath, FileAction.UPLOAD, ServerWatcher.LOCATION)
                 else:
                     action = FileAction(serverpath, FileAction.DOWNLOAD, LocalWatcher.LOCATION)
@@ -782,19 +1691,9 @@ class ServerWatcher(Watcher):
                         self.preemptiveActions.append(action) 
 
             elif location == LocalWatcher.LOCATION:
-                try:
-                    self.ftp.sendcmd('SIZE %s' % serverpath)
-                except (error_reply, error_perm):
-                    exists = False
-                else:
-                    exists = True
-                if not exists:
-                    action = FileAction(serverpath, FileAction.UPLOAD, LocalWatcher.LOCATION)
-                    self.preemptiveActions.append(action)
-                else:
-                    action = actionFromPath(serverpath)
-                    if action is not None:
-                        self.preemptiveActions.append(action) 
+                action = actionFromPath(serverpath)
+                if action is not None:
+                    self.preemptiveActions.append(action) 
 
     @Slot(str, str)
     def changed(self, location, serverpath):
@@ -817,6 +1716,20 @@ class LocalWatcher(Watcher, FileSystemEventHandler):
         
         self.localdir = localdir
         self.interval = 2000
+        # Local changes made by the engine, shared with
+        # the server watcher by `Sync`.
+        self.echoes = EchoRegistry()
+        # Digests of the local files, set up by `Sync`. Without
+        # an algorithm, scans don't look at the file contents.
+        self.hashes = HashCache()
+        self.hashAlgorithm = None
+        
+        # Watchdog events wait here until their files are stable,
+        # the observer thread only records them.
+        self.events = Debouncer()
+        self.eventTimer = QTimer(self)
+        self.eventTimer.setInterval(1000)
+        self.eventTimer.timeout.connect(self.flushEvents)
         
         self.observer = Observer()
         self.observer.schedule(self, localdir, recursive=True)
@@ -827,12 +1740,29 @@ class LocalWatcher(Watcher, FileSystemEventHandler):
     # Not the same as the realtime change detection
     def checkout(self):
         check_date = dt.utcnow()
+        writer = ScanWriter()
+        # What the database knows about the local files, loaded once.
+        # Files whose stat results match it need no database access.
+        snapshot = writer.localSnapshot()
+        seen = set()
+        # Directories that couldn't be listed, their files are not deleted.
+        unreadable = []
+        # Files not in the snapshot.
+        added = []
         fileC = 0
-        for item in os.walk(self.localdir):
-            directory = item[0]
-            subfiles = item[-1]
-
-            for file_ in subfiles:
+        for directory, subfiles in self.listTree(self.localdir):
+            if subfiles is None:
+                print 'Could not list %s' % directory
+                unreadable.append(self.serverFromLocal(directory) + '/')
+                continue
+            
+            changed = []
+            hashing = []
+            for file_, size, mtime, inode in subfiles:
+                
+                if engine_tools.isPartialFile(file_):
+                    # Download in progress, not a user's file.
+                    continue
 
                 # Added by Simon
                 # Give feedback on scanning of files.
@@ -842,53 +1772,238 @@ class LocalWatcher(Watcher, FileSystemEventHandler):
                     # time.sleep(0.1)
                 
                 localpath = os.path.join(directory, file_)
-                localmdate = LocalWatcher.lastModified(localpath)
                 serverpath = self.serverFromLocal(localpath)
+                localmdate = dt.utcfromtimestamp(mtime)
+                seen.add(serverpath)
+                
+                known = snapshot.get(serverpath)
+                if known is None:
+                    # New files could be moved ones, they are
+                    # handled once the deleted files are known.
+                    added.append((directory, localpath, serverpath, localmdate, size, inode))
+                    continue
+                
+                lastmdate, lastsize, lastinode, inserver, servermdate, syncedmdate = known
+                if (lastmdate, lastsize, lastinode) == (localmdate, size, inode) and inserver:
+                    if syncedmdate is not None and lastmdate == syncedmdate:
+                        # Unchanged since it was last in sync.
+                        continue
+                    if syncedmdate is None and servermdate is not None \
+                       and (lastmdate - servermdate).total_seconds() <= Watcher.TOLERANCE:
+                        # Unchanged and as recent as the server copy.
+                        continue
+                changed.append((localpath, serverpath, localmdate, size, inode))
+                if inserver and self.hashAlgorithm is not None:
+                    hashing.append(localpath)
+                
+            if len(hashing) > 0:
+                # Digests of changed files are computed in bulk, they
+                # are needed to tell whether the contents changed.
+                self.hashes.fetch(hashing, self.hashAlgorithm)
+            self.recordChanges(writer, directory, changed, check_date)
+
+        # Deleted files are the ones known to be local that the scan didn't see.
+        deleted = []
+        for serverpath in snapshot:
+            if serverpath in seen:
+                continue
+            if any(serverpath.startswith(prefix) for prefix in unreadable):
+                continue
+            deleted.append(serverpath)
+            
+        # A deleted file and a new one with the same inode, size and
+        # last modified date are the same file, moved while not watching.
+        gone = dict()
+        for serverpath in deleted:
+            lastmdate, lastsize, lastinode = snapshot[serverpath][:3]
+            if lastinode:
+                gone.setdefault((lastmdate, lastsize, lastinode), []).append(serverpath)
+        moved = set()
+        remaining = []
+        for new in added:
+            directory, localpath, serverpath, localmdate, size, inode = new
+            sources = gone.get((localmdate, size, inode)) if inode else None
+            if sources is None or len(sources) > 1 or sources[0] in moved:
+                remaining.append(new)
+                continue
+            move_paths(sources[0], serverpath)
+            moved.add(sources[0])
+            self.fileMoved.emit(LocalWatcher.LOCATION, sources[0], serverpath)
+            
+        if self.hashAlgorithm is not None and len(remaining) > 0:
+            remaining = self.matchDigests(remaining, deleted, moved, snapshot)
+                    
+        remaining.sort()
+        for directory, files in itertools.groupby(remaining, lambda new: new[0]):
+            self.recordChanges(writer, directory, [new[1:] for new in files], check_date)
+            
+        for serverpath in deleted:
+            if serverpath not in moved:
+                self.fileDeleted.emit(LocalWatcher.LOCATION, serverpath)
+        
+    def matchDigests(self, added, deleted, moved, snapshot):
+        """
+        Finds moves that `checkout` couldn't tell by inode, like files copied
+        and then deleted, or filesystems without inodes. New files are
+        compared with the stored digests of the deleted ones of the same size.
+        Returns the new files that are not moved ones.
+        
+        :param added: New files found by `checkout`
+        :param deleted: Paths of the deleted files
+        :param moved: Paths of the deleted files already known to be moved
+        :param snapshot: Local snapshot taken by `checkout`
+        """
+        
+        candidates = [serverpath for serverpath in deleted if serverpath not in moved]
+        stored = self.hashes.stored([self.localFromServer(serverpath) for serverpath in candidates],
+                                    self.hashAlgorithm)
+        gone = dict()
+        for serverpath in candidates:
+            entry = stored.get(self.localFromServer(serverpath))
+            if entry is None:
+                continue
+            (inode, size, mtime), digest = entry
+            lastmdate, lastsize = snapshot[serverpath][:2]
+            # Only digests of the file as it was last seen are any good.
+            if size == lastsize and dt.utcfromtimestamp(mtime) == lastmdate:
+                gone.setdefault((size, digest), []).append(serverpath)
+        if len(gone) == 0:
+            return added
+        
+        sizes = set(size for size, digest in gone)
+        digests = self.hashes.fetch([new[1] for new in added if new[4] in sizes], self.hashAlgorithm)
+        remaining = []
+        for new in added:
+            directory, localpath, serverpath, localmdate, size, inode = new
+            sources = gone.get((size, digests.get(localpath)))
+            if not sources or len(sources) > 1 or sources[0] in moved:
+                remaining.append(new)
+                continue
+            move_paths(sources[0], serverpath)
+            moved.add(sources[0])
+            self.fileMoved.emit(LocalWatcher.LOCATION, sources[0], serverpath)
+            
+        return remaining
+        
+    def recordChanges(self, writer, directory, changed, check_date):
+        """
+        Writes to the database the files of `directory` found by
+        `checkout` to be new or changed, and emits their signals.
+        
+        :param writer: `ScanWriter` of the scan
+        :param directory: Absolute local path of the directory
+        :param changed: List of `(localpath, serverpath, localmdate, size, inode)` tuples
+        :param check_date: Date the scan started
+        """
+        
+        if len(changed) == 0:
+            return
+        
+        # Rows of the changed files in this directory are fetched at once.
+        writer.load(self.serverFromLocal(directory) or '/')
 
-                flagg = 0
-                if localpath.endswith("local.conf"):
-                    flagg = 1
-                    print "Found local.conf"
+        for localpath, serverpath, localmdate, size, inode in changed:
 
-                file_is_in_server = False
+            flagg = 0
+            if localpath.endswith("local.conf"):
+                flagg = 1
+                print "Found local.conf"
+
+            file_is_in_server = False
+            
+            local_file = writer.get(serverpath)
+            # If the file is not in the local DB,
+            # then it's new- we're just adding it now
+            just_added = not local_file.inlocal                        
+            print "JUST ADDED: " + str(just_added)
+            
+            lastmdate = local_file.localmdate
+            lastsize = local_file.localsize
+            print "LASTMDATE: " + str (lastmdate)
+            
+            # Update values in the DB for this file
+            local_file.inlocal = True
+            local_file.last_checked_local = check_date
+            local_file.localmdate = localmdate
+            local_file.localsize = size
+            local_file.inode = inode
+            # Done updating values, changes are committed
+            # together, for the whole directory.
+            writer.changed()
+            
+            file_is_in_server = local_file.inserver                    
+            unsynced = local_file.localChanged()
+            if unsynced is None and local_file.inserver:
+                # Never synced, the dates of both copies are compared.
+                unsynced = local_file.timeDiff() > Watcher.TOLERANCE
                 
-                with File.fromPath(serverpath) as local_file:
-                    # If the file is not in the local DB,
-                    # then it's new- we're just adding it now
-                    just_added = not local_file.inlocal                        
-                    print "JUST ADDED: " + str(just_added)
-                    
-                    lastmdate = local_file.localmdate
-                    print "LASTMDATE: " + str (lastmdate)
-                    
-                    # Update values in the DB for this file
-                    local_file.inlocal = True
-                    local_file.last_checked_local = check_date
-                    local_file.localmdate = localmdate
-                    # Done updating values
-                    
-                    delta = 0
-                    file_is_in_server = local_file.inserver                    
-                    if local_file.inserver:
-                        delta = local_file.timeDiff()
-                    
-                # Emit the signals after the attributes has been set
-                # and committed.
-                if just_added is True:
-                    self.fileAdded.emit(LocalWatcher.LOCATION, serverpath)
-                elif localmdate > lastmdate or delta > Watcher.TOLERANCE \
-                     or not file_is_in_server:
-                    print "FC_EMIT"
-                    self.fileChanged.emit(LocalWatcher.LOCATION, serverpath, True)
-
-        # Deleted files are the ones whose `last_checked_local` attribute 
-        # didn't get updated in the recursive run.
-        session = Session()
-        deleted = session.query(File).filter(File.last_checked_local < check_date).filter(File.inlocal == True)
-        for file_ in deleted:
-            self.fileDeleted.emit(LocalWatcher.LOCATION, file_.path)
+            # Emit the signals after the attributes has been set
+            # and committed.
+            if just_added is True:
+                writer.emit(self.fileAdded, LocalWatcher.LOCATION, serverpath)
+            elif localmdate > lastmdate or unsynced \
+                 or not file_is_in_server or lastsize is not None and size != lastsize:
+                print "FC_EMIT"
+                writer.emit(self.fileChanged, LocalWatcher.LOCATION, serverpath, True)
+                
+        writer.commit()
+        
+    def listTree(self, top):
+        """
+        Yields a `(directory, files)` tuple for every directory under `top`,
+        as returned by `engine_tools.scan_directory`. `files` is `None` for
+        directories that couldn't be listed.
+        The subtrees of the top level subdirectories are listed in parallel,
+        by up to `LOCAL_SCAN_WORKERS` threads, and yielded as they complete.
+        
+        :param top: Absolute local path of the directory
+        """
+        
+        try:
+            subfiles, subdirs = engine_tools.scan_directory(top)
+        except OSError:
+            yield top, None
+            return
+        yield top, subfiles
+        
+        subtrees = [os.path.join(top, subdir) for subdir in subdirs]
+        if LOCAL_SCAN_WORKERS < 2 or len(subtrees) < 2:
+            for subtree in subtrees:
+                for listing in LocalWatcher.listSubtree(subtree):
+                    yield listing
+            return
+        
+        pool = ThreadPool(min(LOCAL_SCAN_WORKERS, len(subtrees)))
+        try:
+            for listings in pool.imap_unordered(LocalWatcher.listSubtree, subtrees):
+                for listing in listings:
+                    yield listing
+        finally:
+            pool.terminate()
+            pool.join()
+        
+    @staticmethod
+    def listSubtree(top):
+        """
+        Lists every directory under `top` in the calling thread, returns
+        a list of `(directory, files)` tuples like the ones `listTree` yields.
+        
+        :param top: Absolute local path of the directory
+        """
+        
+        listings = []
+        directories = [top]
+        while len(directories) > 0:
+            directory = directories.pop()
+            try:
+                subfiles, subdirs = engine_tools.scan_directory(directory)
+            except OSError:
+                listings.append((directory, None))
+                continue
+            directories.extend(os.path.join(directory, subdir) for subdir in subdirs)
+            listings.append((directory, subfiles))
             
-        session.commit()
+        return listings
         
     @classmethod
     def lastModified(cls, localpath):
@@ -896,6 +2011,7 @@ class LocalWatcher(Watcher, FileSystemEventHandler):
 
     @Slot(str)
     def deleteFile(self, localpath):
+        self.echoes.expect(localpath)
         try:
             os.remove(localpath)
         except (IOError, OSError):
@@ -910,48 +2026,85 @@ class LocalWatcher(Watcher, FileSystemEventHandler):
     @Slot()
     def startObserver(self):
         self.observer.start()
-    
-    # FILESYSTEM WATCHER CALLBACK: on file created    
-    @ignore_dirs
-    def on_created(self, event):
+        self.eventTimer.start()
         
-        serverpath = self.serverFromLocal(event.src_path)
+    @Slot()
+    def flushEvents(self):
+        """Reports the file system events whose files are done changing."""
+        
+        for localpath, kind, source in self.events.ready():
+            if self.echoes.isEcho(localpath):
+                continue
+            if kind == Debouncer.CREATED:
+                self.fileCreated(localpath)
+            elif kind == Debouncer.MODIFIED:
+                self.fileModified(localpath)
+            elif kind == Debouncer.MOVED:
+                self.fileRelocated(source, localpath)
+            else:
+                self.fileDeleted.emit(LocalWatcher.LOCATION, self.serverFromLocal(localpath))
+    
+    def fileCreated(self, localpath):
+        serverpath = self.serverFromLocal(localpath)
         with File.fromPath(serverpath) as added_file:
             # Updating the database.
             # First, ensure the file still exists.
             try:
-                md = LocalWatcher.lastModified(event.src_path)
+                st = os.stat(localpath)
             except:
                 return
-            added_file.localmdate = md            
+            added_file.localmdate = dt.utcfromtimestamp(st.st_mtime)
+            added_file.localsize = st.st_size
+            added_file.inode = st.st_ino
             added_file.inlocal = True
             
         self.fileAdded.emit(LocalWatcher.LOCATION, serverpath)
-
-    @ignore_dirs
-    def on_deleted(self, event):
-        serverpath = self.serverFromLocal(event.src_path)
-        self.fileDeleted.emit(LocalWatcher.LOCATION, serverpath)
-           
-    @ignore_dirs
-    def on_modified(self, event):
-        serverpath = self.serverFromLocal(event.src_path)
+        
+    def fileModified(self, localpath):
+        serverpath = self.serverFromLocal(localpath)
         with File.fromPath(serverpath) as changed_file:
             # Updating the database.
             # Ensure file exists. Excel for example makes temp files.
             try:
-                md=LocalWatcher.lastModified(event.src_path)
+                st = os.stat(localpath)
             except:
                 # File doesn't exist anymore
                 return
-            changed_file.localmdate = md
+            changed_file.localmdate = dt.utcfromtimestamp(st.st_mtime)
+            changed_file.localsize = st.st_size
+            changed_file.inode = st.st_ino
         self.fileChanged.emit(LocalWatcher.LOCATION, serverpath, True)
+    
+    def fileRelocated(self, localsrc, localdest):
+        src = self.serverFromLocal(localsrc)
+        dest = self.serverFromLocal(localdest)
+        # Rows follow the files, so nothing looks deleted or added.
+        move_paths(src, dest)
+        self.fileMoved.emit(LocalWatcher.LOCATION, src, dest)
+        
+        if os.path.isfile(localdest):
+            with File.fromPath(dest) as moved_file:
+                lastmdate = moved_file.localmdate
+            if lastmdate != LocalWatcher.lastModified(localdest):
+                # Also changed since it was last seen.
+                self.fileModified(localdest)
+    
+    # FILESYSTEM WATCHER CALLBACK: on file created    
+    @ignore_dirs
+    def on_created(self, event):
+        self.events.push(event.src_path, Debouncer.CREATED)
+
+    @ignore_dirs
+    def on_deleted(self, event):
+        self.events.push(event.src_path, Debouncer.DELETED)
+           
+    @ignore_dirs
+    def on_modified(self, event):
+        self.events.push(event.src_path, Debouncer.MODIFIED)
         
     @ignore_dirs
     def on_moved(self, event):
-        serverpath_src = self.serverFromLocal(event.src_path) 
-        self.on_created(FileCreatedEvent(event.dest_path))
-        self.fileDeleted.emit(LocalWatcher.LOCATION, serverpath_src)
+        self.events.move(event.src_path, event.dest_path)
 
 
 if __name__ == '__main__':